@@ -10,7 +10,7 @@ import torch
 import torchaudio
 
 from tortoise.api import MODELS_DIR, TextToSpeech
-from tortoise.utils.audio import get_voices, load_voices, load_audio
+from tortoise.utils.audio import get_voices, load_voices, load_audio, CrossfadeStitcher
 from tortoise.utils.text import split_and_recombine_text
 
 parser = argparse.ArgumentParser(
@@ -85,6 +85,20 @@ advanced_group.add_argument(
 advanced_group.add_argument(
     '--batch-size', type=int, default=None,
     help='Batch size to use for inference. If omitted, the batch size is set based on available GPU memory.')
+advanced_group.add_argument(
+    '--memory-budget', type=float, default=None,
+    help='Device memory (in GB) the models may take. Models then stay loaded between uses and are only unloaded, '
+         'least recently used first, when another model needs the room.')
+advanced_group.add_argument(
+    '--pipeline', default=False, action='store_true',
+    help='Overlap the rendering of consecutive clips: the next clip is sampled while the previous one is being '
+         'diffused and vocoded. Keeps all models loaded on the device for the whole run.')
+advanced_group.add_argument(
+    '--max-pending', type=int, default=2,
+    help='With --pipeline, how many clips may wait between two stages. Higher values use more memory.')
+advanced_group.add_argument(
+    '--crossfade-ms', type=int, default=0,
+    help='Length of the crossfade used when joining clips into the combined output, in milliseconds.')
 
 tuning_group = parser.add_argument_group('tuning options (overrides preset settings)')
 tuning_group.add_argument(
@@ -107,6 +121,11 @@ tuning_group.add_argument(
 tuning_group.add_argument(
     '--max-mel-tokens', type=int, default=None,
     help='Restricts the output length. 1 to 600. Each unit is 1/20 of a second.')
+tuning_group.add_argument(
+    '--adaptive-threshold', type=float, default=None,
+    help='Stop sampling a clip once a batch improves the mean CLVP score of the best candidates by no more than this '
+         'fraction, e.g. .01. --num-autoregressive-samples is then the most samples taken per clip, or with --pipeline '
+         'the average, the samples easy clips leave unused going to harder ones after them.')
 tuning_group.add_argument(
     '--cvvp-amount', type=float, default=None,
     help='How much the CVVP model should influence the output.'
@@ -197,6 +216,10 @@ else:
 
 # error out early if pydub isn't installed
 if args.play:
+    if args.candidates > 1:
+        parser.error('--play renders one candidate per segment, so it cannot be combined with --candidates')
+    if args.pipeline:
+        parser.error('--play renders and plays one segment at a time, so it cannot be combined with --pipeline')
     try:
         import pydub
         import pydub.playback
@@ -207,7 +230,7 @@ seed = int(time.time()) if args.seed is None else args.seed
 if not args.quiet:
     print('Loading tts...')
 tts = TextToSpeech(models_dir=args.models_dir, enable_redaction=not args.disable_redaction,
-                   device=args.device, autoregressive_batch_size=args.batch_size)
+                   device=args.device, autoregressive_batch_size=args.batch_size, memory_budget=args.memory_budget)
 gen_settings = {
     'use_deterministic_seed': seed,
     'verbose': not args.quiet,
@@ -216,49 +239,94 @@ gen_settings = {
 }
 tuning_options = [
     'num_autoregressive_samples', 'temperature', 'length_penalty', 'repetition_penalty', 'top_p',
-    'max_mel_tokens', 'cvvp_amount', 'diffusion_iterations', 'cond_free', 'cond_free_k', 'diffusion_temperature']
+    'max_mel_tokens', 'adaptive_threshold', 'cvvp_amount', 'diffusion_iterations', 'cond_free', 'cond_free_k', 'diffusion_temperature']
 for option in tuning_options:
     if getattr(args, option) is not None:
         gen_settings[option] = getattr(args, option)
 total_clips = len(texts) * len(selected_voices)
 regenerate_clips = [int(x) for x in args.regenerate.split(',')] if args.regenerate else None
 for voice_idx, voice in enumerate(selected_voices):
-    audio_parts = []
     voice_samples, conditioning_latents = load_voices(voice, extra_voice_dirs)
+
+    def save_clip(text_idx, gen):
+        clip_name = f'{"-".join(voice)}_{text_idx:02d}'
+        for candidate_idx, audio in enumerate(gen):
+            audio = audio.squeeze(0).cpu()
+            if candidate_idx == 0:
+                audio_parts[text_idx] = audio
+            if args.output_dir:
+                filename = f'{clip_name}_{candidate_idx:02d}.wav'
+                torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
+
+    def play(audio):
+        f = tempfile.NamedTemporaryFile(suffix='.wav', delete=True)
+        torchaudio.save(f.name, audio.reshape(1, -1), 24000)
+        pydub.playback.play(pydub.AudioSegment.from_wav(f.name))
+
+    audio_parts = [None] * len(texts)
+    to_render = []
     for text_idx, text in enumerate(texts):
         clip_name = f'{"-".join(voice)}_{text_idx:02d}'
         if args.output_dir:
             first_clip = os.path.join(args.output_dir, f'{clip_name}_00.wav')
             if (args.skip_existing or (regenerate_clips and text_idx not in regenerate_clips)) and os.path.exists(first_clip):
-                audio_parts.append(load_audio(first_clip, 24000))
+                audio_parts[text_idx] = load_audio(first_clip, 24000)
                 if not args.quiet:
                     print(f'Skipping {clip_name}')
                 continue
-        if not args.quiet:
-            print(f'Rendering {clip_name} ({(voice_idx * len(texts) + text_idx + 1)} of {total_clips})...')
-            print('  ' + text)
-        gen = tts.tts_with_preset(
-            text, voice_samples=voice_samples, conditioning_latents=conditioning_latents, **gen_settings)
-        gen = gen if args.candidates > 1 else [gen]
-        for candidate_idx, audio in enumerate(gen):
-            audio = audio.squeeze(0).cpu()
-            if candidate_idx == 0:
-                audio_parts.append(audio)
-            if args.output_dir:
-                filename = f'{clip_name}_{candidate_idx:02d}.wav'
-                torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
+        to_render.append(text_idx)
+
+    pending = []
+    if args.play:
+        # Play each segment as soon as it is rendered rather than waiting for the whole text. Segments that were
+        # skipped are played from their existing clips, in order.
+        played = 0
+        stream_settings = {k: v for k, v in gen_settings.items() if k not in ('k', 'use_deterministic_seed')}
+        for part in tts.tts_stream([texts[i] for i in to_render], voice_samples=voice_samples,
+                                   conditioning_latents=conditioning_latents, use_deterministic_seed=seed, **stream_settings):
+            text_idx = to_render[part['index']]
+            if not args.quiet:
+                print(f'Playing segment {text_idx + 1} of {len(texts)} (ready after {part["elapsed"]:.1f}s)...')
+                print('  ' + part['text'])
+            save_clip(text_idx, [part['wav'].unsqueeze(0)])
+            for i in range(played, text_idx + 1):
+                play(audio_parts[i])
+            played = text_idx + 1
+        for i in range(played, len(texts)):
+            play(audio_parts[i])
+    else:
+        for text_idx in to_render:
+            text = texts[text_idx]
+            clip_name = f'{"-".join(voice)}_{text_idx:02d}'
+            if args.pipeline:
+                pending.append(text_idx)
+                continue
+            if not args.quiet:
+                print(f'Rendering {clip_name} ({(voice_idx * len(texts) + text_idx + 1)} of {total_clips})...')
+                print('  ' + text)
+            gen = tts.tts_with_preset(
+                text, voice_samples=voice_samples, conditioning_latents=conditioning_latents, **gen_settings)
+            save_clip(text_idx, gen if args.candidates > 1 else [gen])
 
-    audio = torch.cat(audio_parts, dim=-1)
+    if pending:
+        pipeline_settings = {k: v for k, v in gen_settings.items() if k != 'preset'}
+        pipeline_settings = tts.preset_settings(args.preset, max_pending=args.max_pending, **pipeline_settings)
+        for result in tts.tts_pipelined([texts[i] for i in pending], voice_samples=voice_samples,
+                                        conditioning_latents=conditioning_latents, **pipeline_settings):
+            text_idx = pending[result['index']]
+            if not args.quiet:
+                print(f'Rendered {"-".join(voice)}_{text_idx:02d} ({(voice_idx * len(texts) + text_idx + 1)} of {total_clips}, '
+                      f'after {result["elapsed"]:.1f}s)')
+            save_clip(text_idx, [c.unsqueeze(0) for c in result['candidates']])
+
+    stitcher = CrossfadeStitcher(args.crossfade_ms * 24000 // 1000)
+    audio = torch.cat([stitcher.push(part) for part in audio_parts] + [stitcher.flush()], dim=-1)
     if args.output_dir:
         filename = f'{"-".join(voice)}_combined.wav'
         torchaudio.save(os.path.join(args.output_dir, filename), audio, 24000)
     elif args.output:
         filename = args.output if args.output else os.tmp
         torchaudio.save(args.output, audio, 24000)
-    elif args.play:
-        f = tempfile.NamedTemporaryFile(suffix='.wav', delete=True)
-        torchaudio.save(f.name, audio, 24000)
-        pydub.playback.play(pydub.AudioSegment.from_wav(f.name))
 
     if args.produce_debug_state:
         os.makedirs('debug_states', exist_ok=True)
@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from tortoise.models.autoregressive import UnifiedVoice
+from tortoise.models.decoding import GPT2Decoder
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    model = UnifiedVoice(layers=4, model_dim=64, heads=4, max_text_tokens=20, max_mel_tokens=40, checkpointing=False)
+    model.post_init_gpt2_config(kv_cache=True, native_decoding=True)
+    return model.double().eval()
+
+
+def test_greedy_speculation_matches_plain_decoding():
+    model = tiny_model()
+    prompt = torch.randn((2, 6, 64), dtype=torch.float64)
+    kwargs = dict(num_return_sequences=2, do_sample=False, repetition_penalty=2.0)
+    plain = model.native_decoder.generate(prompt, model.start_mel_token, model.stop_mel_token, 30, **kwargs)
+    for lookahead in (1, 3):
+        speculative = GPT2Decoder(model.inference_model, draft_layers=2, lookahead=lookahead)
+        codes = speculative.generate(prompt, model.start_mel_token, model.stop_mel_token, 30, **kwargs)
+        assert torch.equal(codes, plain)
@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip('torch')
+
+from tortoise.utils.scoring import SampleBudget
+
+
+def test_sample_budget_banks_unused_batches():
+    budget = SampleBudget(4)
+    budget.spend(1)
+    assert budget.allowance() == 7
+    budget.spend(7)
+    assert budget.allowance() == 4
+
+
+def test_sample_budget_caps_banked_batches():
+    budget = SampleBudget(4)
+    for _ in range(10):
+        budget.spend(1)
+    assert budget.allowance() == 12
+    budget = SampleBudget(4, max_banked=1)
+    budget.spend(0)
+    assert budget.allowance() == 5
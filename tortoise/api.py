@@ -3,6 +3,7 @@ import random
 import uuid
 import gc
 
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 from urllib import request
 from urllib.request import ProxyHandler, build_opener, install_opener
@@ -14,7 +15,10 @@ import torchaudio
 
 from tortoise.models.classifier import AudioMiniEncoderWithClassifierHead
 from tortoise.models.diffusion_decoder import DiffusionTts
-from tortoise.models.autoregressive import UnifiedVoice
+from tortoise.models.autoregressive import UnifiedVoice, NATIVE_DECODING_KWARGS
+from tortoise.models.decoding import PromptKVCache, kv_cache_report, seeded_generators, tensor_digest
+from tortoise.models.tensor_parallel import TensorParallelDecoder
+from tortoise.models.scheduler import ARScheduler
 from tqdm import tqdm
 
 from tortoise.models.arch_util import TorchMelSpectrogram
@@ -24,8 +28,15 @@ from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.models.bigvgan import BigVGAN
 
-from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
+from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, TACOTRON_MEL_MIN, CrossfadeStitcher
 from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
+from tortoise.utils.distributed import DistributedSampler, candidate_seed
+from tortoise.utils.length import LengthPredictor
+from tortoise.utils.pipeline import Pipeline
+from tortoise.utils.quantization import load_quantized_autoregressive
+from tortoise.utils.residency import ModelResidency
+from tortoise.utils.scoring import BackgroundScorer, RunningTopK, SampleBudget
+from tortoise.utils.text import split_and_recombine_text
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
 
@@ -142,13 +153,13 @@ def pad_or_truncate(t, length):
         return t[..., :length]
 
 
-def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1):
+def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1, cond_free_batched=False):
     """
     Helper function to load a GaussianDiffusion instance configured for use as a vocoder.
     """
     return SpacedDiffusion(use_timesteps=space_timesteps(trained_diffusion_steps, [desired_diffusion_steps]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
-                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+                           conditioning_free=cond_free, conditioning_free_k=cond_free_k, batch_conditioning_free=cond_free_batched)
 
 @torch.inference_mode()
 def format_conditioning(clip, cond_length=132300, device='cuda', sampling_rate=22050):
@@ -195,14 +206,16 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     return codes
 
 @torch.inference_mode()
-def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True, desc=None, sampler="P", input_sample_rate=22050, output_sample_rate=24000):
+def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True, desc=None, sampler="P", input_sample_rate=22050, output_sample_rate=24000, precomputed_embeddings=None):
     """
     Uses the specified diffusion model to convert discrete codes into a spectrogram.
+    :param precomputed_embeddings: Output of diffusion_embeddings() for the same inputs, to skip computing it again.
     """
     with torch.no_grad():
         output_seq_len = latents.shape[1] * 4 * output_sample_rate // input_sample_rate  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
         output_shape = (latents.shape[0], 100, output_seq_len)
-        precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
+        if precomputed_embeddings is None:
+            precomputed_embeddings = diffusion_embeddings(diffusion_model, latents, conditioning_latents, input_sample_rate, output_sample_rate)
 
         noise = torch.randn(output_shape, device=latents.device) * temperature
         
@@ -215,6 +228,61 @@ def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_la
             mel = mel.cpu()
         return mel
 
+@torch.inference_mode()
+def diffusion_embeddings(diffusion_model, latents, conditioning_latents, input_sample_rate=22050, output_sample_rate=24000):
+    """
+    Computes the part of the diffusion model's work that does not depend on the diffusion step, so it can be shared by
+    several do_spectrogram_diffusion() calls for the same latents.
+    """
+    output_seq_len = latents.shape[1] * 4 * output_sample_rate // input_sample_rate
+    return diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
+
+@torch.inference_mode()
+def do_spectrogram_diffusion_batch(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True, desc=None, sampler="P", input_sample_rate=22050, output_sample_rate=24000):
+    """
+    Batched counterpart of do_spectrogram_diffusion(): converts a list of (1,s,d) latents of different lengths into
+    spectrograms with a single sampling loop. Every row is padded to the longest one and a length mask keeps the padding
+    from leaking into the valid frames.
+    :param conditioning_latents: List of diffusion conditioning latents, one per entry of latents.
+    :return: List of (1,100,s) spectrograms.
+    """
+    with torch.no_grad():
+        output_seq_lens = [l.shape[1] * 4 * output_sample_rate // input_sample_rate for l in latents]
+        max_seq_len = max(output_seq_lens)
+        output_shape = (len(latents), 100, max_seq_len)
+
+        # The upsampling in timestep_independent depends on the length of each row, so it can't be done on the padded batch.
+        precomputed_embeddings = torch.cat([
+            F.pad(diffusion_model.timestep_independent(l, c, seq_len, False), (0, max_seq_len - seq_len))
+            for l, c, seq_len in zip(latents, conditioning_latents, output_seq_lens)
+        ], dim=0)
+        mask = torch.arange(max_seq_len, device=precomputed_embeddings.device).unsqueeze(0) < torch.tensor(output_seq_lens, device=precomputed_embeddings.device).unsqueeze(1)
+
+        noise = torch.randn(output_shape, device=precomputed_embeddings.device) * temperature
+
+        diffuser.sampler = sampler.lower()
+        mel = diffuser.sample_loop(diffusion_model, output_shape, noise=noise,
+                                      model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings}, desc=desc, mask=mask)
+
+        mel = denormalize_tacotron_mel(mel)
+        if get_device_name() == "dml":
+            mel = mel.cpu()
+        return [mel[i:i+1, :, :seq_len] for i, seq_len in enumerate(output_seq_lens)]
+
+
+def vocode_batch(vocoder, mels):
+    """
+    Runs the vocoder once over a list of (1,100,s) spectrograms of different lengths. The shorter ones are padded with
+    silence, which is also what the vocoder pads its input with, and the padding is cut from the resulting waveforms.
+    :return: List of (1,1,S) waveforms.
+    """
+    lengths = [mel.shape[-1] for mel in mels]
+    max_length = max(lengths)
+    mel = torch.cat([F.pad(mel, (0, max_length - mel.shape[-1]), value=TACOTRON_MEL_MIN) for mel in mels], dim=0)
+    wav = vocoder.inference(mel)
+    hop_length = wav.shape[-1] // max_length
+    return [wav[i:i+1, :, :length * hop_length] for i, length in enumerate(lengths)]
+
 
 def classify_audio_clip(clip):
     """
@@ -230,7 +298,7 @@ def classify_audio_clip(clip):
     results = F.softmax(classifier(clip), dim=-1)
     return results[0][0]
 
-def migrate_to_device( t, device ):
+def migrate_to_device( t, device, collect=True ):
     if t is None:
         return t
 
@@ -245,7 +313,8 @@ def migrate_to_device( t, device ):
 
     t = t.to(device)
     
-    do_gc()
+    if collect:
+        do_gc()
 
     return t
 
@@ -259,6 +328,10 @@ class TextToSpeech:
         unsqueeze_sample_batches=False,
         input_sample_rate=22050, output_sample_rate=24000,
         autoregressive_model_path=None, diffusion_model_path=None, vocoder_model=None, tokenizer_json=None,
+        memory_budget=None,
+        native_ar_decoding=True, compile_ar_decoding=False, ar_prompt_cache_size=8,
+        ar_draft_layers=None, ar_speculative_lookahead=4, ar_quantize_int8=False, ar_kv_dtype=None,
+        ar_tensor_parallel=None,
 #    ):
         use_deepspeed=False):  # Add use_deepspeed parameter
         """
@@ -271,6 +344,32 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param memory_budget: If set, how much device memory (in GB) the models may take. Models then stay on the device
+                              between uses and are only moved off, least recently used first, when another model needs
+                              the room (see ModelResidency). Overrides minor_optimizations' preloading of models.
+        :param native_ar_decoding: Sample from the autoregressive model with its own decoding loop and a preallocated KV
+                                   cache (see GPT2Decoder) instead of transformers' generate(), whenever the sampling
+                                   arguments allow it.
+        :param compile_ar_decoding: Compile the decoding step of the native loop with torch.compile().
+        :param ar_prompt_cache_size: Number of prompts (voice and text) whose keys and values the native loop keeps on the
+                                     device between calls (see PromptKVCache), so sampling the same line again skips
+                                     the prompt. 0 to disable.
+        :param ar_draft_layers: If set, the native loop decodes speculatively, with the first ar_draft_layers layers of
+                                the autoregressive model drafting ar_speculative_lookahead tokens at a time for the full
+                                model to verify. Codes are distributed the same, but fewer full depth steps are needed.
+                                Works best with few sequences per batch. See speculative_acceptance().
+        :param ar_quantize_int8: On CPU, quantize the transformer and heads of the autoregressive model to int8 with
+                                 dynamic quantization (see quantize_autoregressive()). Its quantized weights are cached in
+                                 models_dir/quantized, keyed by the hash of the checkpoint. Ignored on other devices.
+        :param ar_kv_dtype: Storage of the keys and values of the native loop: None for the dtype sampling runs in, 'bf16',
+                            or 'int8' with a scale per head and position. Halving or quartering their memory lets
+                            larger autoregressive batches fit, see kv_cache_report().
+        :param ar_tensor_parallel: On CPU, split the heads and MLPs of the autoregressive model's transformer over this
+                                   many local processes (see TensorParallelDecoder), which load their shards of it from
+                                   the checkpoint. Lowers the latency of every decoding step, even of a single request,
+                                   by using the cores and memory bandwidth of all of them. Ignored on other devices,
+                                   with ar_quantize_int8, and when the native loop isn't used; disables
+                                   ar_prompt_cache_size and ar_draft_layers for the autoregressive model.
         """ 
         self.loading = True
         if device is None:
@@ -284,16 +383,38 @@ class TextToSpeech:
         self.use_deepspeed = use_deepspeed  # Store use_deepspeed as an instance variable
         print(f'use_deepspeed api_debug {use_deepspeed}')
         # for clarity, it's simpler to split these up and just predicate them on requesting VRAM-consuming optimizations
-        self.preloaded_tensors = minor_optimizations
+        self.preloaded_tensors = minor_optimizations and memory_budget is None
         self.use_kv_cache = minor_optimizations
         if get_device_name() == "dml": # does not work with DirectML
             print("KV caching requested but not supported with the DirectML backend, disabling...")
             self.use_kv_cache = False
+        self.native_ar_decoding = native_ar_decoding and get_device_name() != "dml"
+        self.compile_ar_decoding = compile_ar_decoding
+        self.ar_prompt_cache = PromptKVCache(max_entries=ar_prompt_cache_size) if ar_prompt_cache_size else None
+        self.ar_draft_layers = ar_draft_layers
+        self.ar_speculative_lookahead = ar_speculative_lookahead
+        self.ar_quantize_int8 = ar_quantize_int8 and str(device).startswith('cpu')
+        self.ar_kv_dtype = ar_kv_dtype
+        if ar_quantize_int8 and not self.ar_quantize_int8:
+            print("int8 quantization of the autoregressive model is only supported on CPU, disabling...")
+        self.ar_tensor_parallel = ar_tensor_parallel if str(device).startswith('cpu') and not self.ar_quantize_int8 else None
+        if ar_tensor_parallel and not self.ar_tensor_parallel:
+            print("Tensor parallel autoregressive decoding is only supported on CPU without int8 quantization, disabling...")
 
         self.models_dir = models_dir
         self.autoregressive_batch_size = get_device_batch_size() if autoregressive_batch_size is None or autoregressive_batch_size == 0 else autoregressive_batch_size
         self.enable_redaction = enable_redaction
         self.device = device
+        self.residency = None
+        self.ar_scheduler = None
+        self.sampling_workers = None
+        self.seed = None  # Seed of the last deterministic_state() call.
+        self.best_candidates = None  # Candidate numbers of the last candidates chosen on the sampling workers.
+        self.length_predictor = LengthPredictor()
+        self.length_caps = [0, 0]  # [autoregressive samples, samples that reached their cap without stopping]
+        if memory_budget is not None:
+            self.residency = ModelResidency(self, self.device, budget=int(memory_budget * 1024 ** 3),
+                                            move_fn=lambda model, device: migrate_to_device( model, device, collect=False ))
         if self.enable_redaction:
             self.aligner = Wav2VecAlignment(device='cpu' if get_device_name() == "dml" else self.device)
 
@@ -354,6 +475,8 @@ class TextToSpeech:
         print(f"Loading autoregressive model: {self.autoregressive_model_path}")
 
         if hasattr(self, 'autoregressive'):
+            if isinstance(getattr(self.autoregressive, 'native_decoder', None), TensorParallelDecoder):
+                self.autoregressive.native_decoder.shutdown()
             del self.autoregressive
 
         # XTTS requires a different "dimensionality" for its autoregressive model
@@ -387,9 +510,23 @@ class TextToSpeech:
                 "train_solo_embeddings": False
             }
 
-        self.autoregressive = UnifiedVoice(**dimensionality).cpu().eval()
-        self.autoregressive.load_state_dict(torch.load(self.autoregressive_model_path))
-        self.autoregressive.post_init_gpt2_config(use_deepspeed=self.use_deepspeed, kv_cache=self.use_kv_cache)
+        def build_autoregressive(load_weights=True):
+            model = UnifiedVoice(**dimensionality).cpu().eval()
+            if load_weights:
+                model.load_state_dict(torch.load(self.autoregressive_model_path))
+            return model
+
+        if self.ar_quantize_int8:
+            self.autoregressive = load_quantized_autoregressive(build_autoregressive, self.autoregressive_model_hash,
+                                                                os.path.join(self.models_dir, 'quantized'))
+        else:
+            self.autoregressive = build_autoregressive()
+        self.autoregressive.post_init_gpt2_config(use_deepspeed=self.use_deepspeed, kv_cache=self.use_kv_cache,
+                                                  native_decoding=self.native_ar_decoding, compile_decoding=self.compile_ar_decoding,
+                                                  prompt_cache=self.ar_prompt_cache, model_hash=self.autoregressive_model_hash,
+                                                  draft_layers=self.ar_draft_layers, speculative_lookahead=self.ar_speculative_lookahead,
+                                                  kv_dtype=self.ar_kv_dtype, tensor_parallel=self.ar_tensor_parallel,
+                                                  checkpoint_path=self.autoregressive_model_path)
         if self.preloaded_tensors:
             self.autoregressive = migrate_to_device( self.autoregressive, self.device )
 
@@ -598,6 +735,213 @@ class TextToSpeech:
         with torch.no_grad():
             return self.rlg_auto(torch.tensor([0.0])), self.rlg_diffusion(torch.tensor([0.0]))
 
+    def acquire_models(self, *names):
+        """
+        Moves the named models (attribute names, e.g. 'autoregressive') to the device before they are used.
+        """
+        for name in names:
+            if self.residency is not None:
+                self.residency.acquire(name)
+            else:
+                setattr(self, name, migrate_to_device( getattr(self, name), self.device ))
+
+    def release_models(self, *names):
+        """
+        Called once the named models are no longer needed. Unless models are preloaded, they are moved off the device,
+        or, with a memory budget, left there until the room is needed.
+        """
+        if self.preloaded_tensors:
+            return
+        for name in names:
+            if name == 'autoregressive' and self.ar_scheduler is not None:
+                continue  # Still decoding for the scheduler, see start_ar_scheduler().
+            if self.residency is not None:
+                self.residency.release(name)
+            else:
+                setattr(self, name, migrate_to_device( getattr(self, name), 'cpu' ))
+
+    def start_ar_scheduler(self, max_batch_size=None, half_p=False, kv_cache_memory=None):
+        """
+        Makes the autoregressive sampling of every following tts() call, from any thread, go through one continuously
+        batched decoding loop (see ARScheduler), so concurrent calls share the device step by step rather than queueing
+        behind each other. The autoregressive model stays on the device until stop_ar_scheduler().
+        :param max_batch_size: Number of sequences decoded together. Defaults to autoregressive_batch_size.
+        :param half_p: Decode under fp16 autocast.
+        :param kv_cache_memory: Memory (in GB) the scheduler's paged key/value cache may take. Since sequences only take
+                                blocks for the positions they reach, this can be well below what max_batch_size
+                                sequences of max_mel_tokens would need, but must hold at least one sequence of the
+                                longest prompt and max_mel_tokens.
+        """
+        self.stop_ar_scheduler()
+        self.acquire_models('autoregressive')
+        scheduler = ARScheduler(self.autoregressive,
+                                max_batch_size=max_batch_size or self.autoregressive_batch_size,
+                                kv_cache_memory=kv_cache_memory,
+                                context_fn=lambda: torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p))
+        if kv_cache_memory is not None:
+            dtype = torch.float16 if half_p and str(self.device).startswith('cuda') else next(self.autoregressive.parameters()).dtype
+            needed = scheduler.min_kv_cache_memory(dtype)
+            if kv_cache_memory < needed:
+                scheduler.shutdown()
+                self.release_models('autoregressive')
+                raise ValueError(f'kv_cache_memory ({kv_cache_memory}GB) is too small for one sequence of the longest '
+                                 f'prompt and max_mel_tokens, which needs {needed:.3f}GB')
+        self.ar_scheduler = scheduler
+        return self.ar_scheduler
+
+    def stop_ar_scheduler(self):
+        """
+        Finishes the requests already submitted to the scheduler started by start_ar_scheduler(), then stops it.
+        """
+        if self.ar_scheduler is None:
+            return
+        self.ar_scheduler.shutdown()
+        self.ar_scheduler = None
+        self.release_models('autoregressive')
+
+    def stop_tensor_parallel(self):
+        """
+        Stops the processes the autoregressive model is split over with ar_tensor_parallel, falling back to decoding in
+        this process alone. They are stopped at exit otherwise.
+        """
+        decoder = getattr(getattr(self, 'autoregressive', None), 'native_decoder', None)
+        if not isinstance(decoder, TensorParallelDecoder):
+            return
+        decoder.shutdown()
+        self.ar_tensor_parallel = None
+        self.autoregressive.post_init_gpt2_config(use_deepspeed=self.use_deepspeed, kv_cache=self.use_kv_cache,
+                                                  native_decoding=self.native_ar_decoding, compile_decoding=self.compile_ar_decoding,
+                                                  prompt_cache=self.ar_prompt_cache, model_hash=self.autoregressive_model_hash,
+                                                  draft_layers=self.ar_draft_layers, speculative_lookahead=self.ar_speculative_lookahead,
+                                                  kv_dtype=self.ar_kv_dtype)
+
+    def start_sampling_workers(self, num_workers, threads_per_worker=None, **tts_kwargs):
+        """
+        Makes sample_candidates() (and so tts()) split its autoregressive samples over num_workers local processes,
+        each with its own copy of the models (see DistributedSampler), until stop_sampling_workers(). Candidate i of a
+        line is sampled with the seed candidate_seed(seed, i), seed being that of deterministic_state(), so any one
+        candidate can be sampled again on its own with sample_candidate(). Workers score their own candidates with
+        CLVP/CVVP; the numbers of the chosen ones are left in best_candidates.
+        :param threads_per_worker: Number of torch threads of every worker. Defaults to splitting the cores evenly.
+        :param tts_kwargs: Arguments of the TextToSpeech every worker builds. Defaults to the models of this one, on
+                           the CPU.
+        """
+        self.stop_sampling_workers()
+        kwargs = {'models_dir': self.models_dir, 'device': 'cpu', 'enable_redaction': False,
+                  'autoregressive_model_path': self.autoregressive_model_path,
+                  'autoregressive_batch_size': self.autoregressive_batch_size}
+        kwargs.update(tts_kwargs)
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+        self.sampling_workers = DistributedSampler(num_workers, kwargs, threads_per_worker=threads_per_worker)
+        return self.sampling_workers
+
+    def stop_sampling_workers(self):
+        """
+        Stops the workers started by start_sampling_workers().
+        """
+        if self.sampling_workers is None:
+            return
+        self.sampling_workers.shutdown()
+        self.sampling_workers = None
+
+    @torch.inference_mode()
+    def sample_candidate(self, text_tokens, auto_conditioning, seed, index, temperature=.8, length_penalty=1,
+                         repetition_penalty=2.0, top_p=.8, max_mel_tokens=500, **hf_generate_kwargs):
+        """
+        Samples candidate number index of a line again, as sampled on the workers of start_sampling_workers() with the
+        given seed. Arguments are the same as for sample_candidates().
+        :return: The (1,s) codes.
+        """
+        self.acquire_models('autoregressive')
+        generators = seeded_generators([candidate_seed(seed, index)], self.device)
+        codes = self.autoregressive.inference_speech(migrate_to_device( auto_conditioning, self.device ),
+                                                     migrate_to_device( text_tokens, self.device ),
+                                                     top_p=top_p, temperature=temperature,
+                                                     num_return_sequences=1, length_penalty=length_penalty,
+                                                     repetition_penalty=repetition_penalty,
+                                                     max_generate_length=max_mel_tokens, generators=generators,
+                                                     **{'do_sample': True, **hf_generate_kwargs})
+        self.release_models('autoregressive')
+        return F.pad(codes, (0, max_mel_tokens - codes.shape[1]), value=self.autoregressive.stop_mel_token)
+
+    def speculative_acceptance(self, conditioning_latent=None, reset=False):
+        """
+        Returns the fraction of tokens drafted by speculative decoding (see ar_draft_layers) that the full model
+        accepted, for the voice with the given autoregressive conditioning latent, or over all voices if omitted. None if
+        nothing was drafted.
+        :param reset: Start counting anew afterwards.
+        """
+        decoder = getattr(self.autoregressive, 'native_decoder', None)
+        if decoder is None:
+            return None
+        counts = decoder.acceptance
+        if conditioning_latent is not None:
+            counts = {key: value for key, value in counts.items() if key == tensor_digest(conditioning_latent)}
+        drafted = sum(d for d, _ in counts.values())
+        accepted = sum(a for _, a in counts.values())
+        if reset:
+            decoder.acceptance_rates(reset=True)
+        return accepted / drafted if drafted else None
+
+    def predict_max_mel_tokens(self, text, voice_samples=None, limit=600):
+        """
+        Estimates how many mel codes speaking the text can take (see LengthPredictor), at most limit. With voice_samples,
+        the estimate uses the voice's speaking rate, measured once per voice with the wav2vec2 aligner.
+        """
+        rate = None
+        if voice_samples is not None:
+            if getattr(self, 'aligner', None) is None:
+                self.aligner = Wav2VecAlignment(device='cpu' if get_device_name() == "dml" else self.device)
+            key = tuple(tensor_digest(clip) for clip in voice_samples)
+            rate = self.length_predictor.speaking_rate(voice_samples, self.aligner, key=key, sample_rate=self.input_sample_rate)
+        return self.length_predictor.max_codes(len(text), speaking_rate=rate, limit=limit)
+
+    def record_length_caps(self, codes):
+        """
+        Counts the rows of a batch of autoregressive samples, and those that reached their length cap without emitting
+        the stop token, for length_cap_rate().
+        """
+        capped = (codes != self.autoregressive.stop_mel_token).all(dim=1)
+        self.length_caps[0] += codes.shape[0]
+        self.length_caps[1] += int(capped.sum())
+
+    def length_cap_rate(self, reset=False):
+        """
+        Returns the fraction of autoregressive samples that ran into max_mel_tokens (or the predicted cap, see
+        length_prediction) without finishing, or None if nothing was sampled. A high rate on normal text means the
+        cap is too tight.
+        :param reset: Start counting anew afterwards.
+        """
+        samples, capped = self.length_caps
+        if reset:
+            self.length_caps = [0, 0]
+        return capped / samples if samples else None
+
+    def kv_cache_report(self, memory=None, half_p=False):
+        """
+        Reports how much memory the keys and values of the autoregressive model take per position with each ar_kv_dtype
+        setting, and how many positions, and sequences of the longest possible prompt and output, fit in memory.
+        :param memory: Memory (in GB) to fill. Defaults to the free memory of the device, which must then be CUDA.
+        :param half_p: Whether sampling runs under fp16 autocast.
+        :return: The list of kv_cache_report() entries, one per setting.
+        """
+        if memory is None:
+            memory = torch.cuda.mem_get_info(self.device)[0] / 1024 ** 3
+        model = self.autoregressive
+        sequence_length = model.max_conditioning_inputs + model.max_text_tokens + 3 + model.max_mel_tokens
+        return kv_cache_report(model.layers, model.heads, model.model_dim // model.heads,
+                               torch.float16 if half_p else torch.float32, memory * 1024 ** 3, sequence_length)
+
+    def prefetch_models(self, *names):
+        """
+        With a memory budget, starts moving the named models to the device in the background ahead of their use.
+        """
+        if self.residency is None or get_device_name() == "dml":
+            return
+        for name in names:
+            self.residency.prefetch(name)
+
     def tts_with_preset(self, text, preset='fast', **kwargs):
         """
         Calls TTS with one of a set of preset generation parameters. Options:
@@ -606,6 +950,12 @@ class TextToSpeech:
             'standard': Very good quality. This is generally about as good as you are going to get.
             'high_quality': Use if you want the absolute best. This is not really worth the compute, though.
         """
+        return self.tts(text, **self.preset_settings(preset, **kwargs))
+
+    def preset_settings(self, preset='fast', **kwargs):
+        """
+        Returns the tts() keyword arguments of one of the presets listed in tts_with_preset(), updated with kwargs.
+        """
         # Use generally found best tuning knobs for generation.
         settings = {'temperature': .8, 'length_penalty': 1.0, 'repetition_penalty': 2.0,
                     'top_p': .8,
@@ -619,7 +969,279 @@ class TextToSpeech:
         }
         settings.update(presets[preset])
         settings.update(kwargs) # allow overriding of preset settings with kwargs
-        return self.tts(text, **settings)
+        return settings
+
+    def tts_stream(self, text, preset=None, chunk_size=None, desired_length=200, max_length=300, use_deterministic_seed=None, **kwargs):
+        """
+        Generator counterpart to tts(). Renders the text one segment at a time and yields each segment's audio as soon as
+        it has been vocoded, so playback or writing can start before the rest of the text is done. Breaking out of the
+        loop stops generation before the next segment is started.
+        :param text: Text to be spoken. Either a string, which is split with split_and_recombine_text(), or a list of
+                     already split segments.
+        :param preset: If given, settings are taken from tts_with_preset(), otherwise tts() defaults are used.
+        :param chunk_size: If given, each segment's waveform is yielded in pieces of at most this many samples, instead
+                           of as a single clip.
+        :param desired_length: Passed to split_and_recombine_text() when text is a string.
+        :param max_length: Passed to split_and_recombine_text() when text is a string.
+        :param use_deterministic_seed: Seed shared by every segment. Picked once from time() if omitted.
+        :param kwargs: Forwarded to tts() / tts_with_preset(). k is always 1.
+        :return: Yields dicts with the following keys:
+                 - 'index': index of the segment the audio belongs to.
+                 - 'chunk': index of the piece within the segment (always 0 without chunk_size).
+                 - 'last': whether this is the last piece of the segment.
+                 - 'text': the segment's text.
+                 - 'wav': the waveform, shape (1,S), 24kHz.
+                 - 'offset': position of the first sample of 'wav' within the whole rendered document, in samples.
+                 - 'render_time': seconds spent rendering the segment.
+                 - 'elapsed': seconds since the generator was started.
+        """
+        if isinstance(text, str):
+            texts = split_and_recombine_text(text, desired_length, max_length)
+        else:
+            texts = list(text)
+
+        seed = int(time()) if use_deterministic_seed is None else use_deterministic_seed
+        kwargs['k'] = 1
+        kwargs['return_deterministic_state'] = False
+
+        start_time = time()
+        offset = 0
+        for index, segment in enumerate(texts):
+            check_for_kill_signal()
+            segment_start = time()
+            if preset is not None:
+                wav = self.tts_with_preset(segment, preset=preset, use_deterministic_seed=seed, **kwargs)
+            else:
+                wav = self.tts(segment, use_deterministic_seed=seed, **kwargs)
+            wav = wav.squeeze(0).cpu()
+            render_time = time() - segment_start
+
+            chunks = [wav] if chunk_size is None or chunk_size <= 0 else list(torch.split(wav, chunk_size, dim=-1))
+            for c, chunk in enumerate(chunks):
+                yield {
+                    'index': index,
+                    'chunk': c,
+                    'last': c == len(chunks) - 1,
+                    'text': segment,
+                    'wav': chunk,
+                    'offset': offset,
+                    'render_time': render_time,
+                    'elapsed': time() - start_time,
+                }
+                offset += chunk.shape[-1]
+
+    def tts_progressive(self, text, voice_samples=None, conditioning_latents=None, verbose=True, use_deterministic_seed=None,
+            # autoregressive generation parameters follow
+            num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+            sample_batch_size=None,
+            # CVVP parameters follow
+            cvvp_amount=.0,
+            # diffusion generation parameters follow
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, cond_free_batched=False, diffusion_temperature=1.0,
+            diffusion_sampler="P",
+            breathing_room=8,
+            half_p=False,
+            store_latents=False,
+            diffusion_inputs='latents',
+            # preview parameters follow
+            preview_iterations=10,
+            preview_sampler="DDIM",
+            preview_cond_free=False,
+            **hf_generate_kwargs):
+        """
+        Generator counterpart to tts() for interactive use: renders the best autoregressive candidate twice, first with a
+        cheap diffusion schedule for a quick preview and then with the full one. Both renders share the autoregressive
+        codes, latents and the diffusion model's step-independent embeddings, and the full render starts in the
+        background as soon as the preview is ready. Closing the generator after the preview returns right away; the full
+        render then finishes in the background, and the diffusion model and vocoder stay acquired until it does.
+        :param preview_iterations: Number of diffusion steps used for the preview.
+        :param preview_sampler: Diffusion sampler used for the preview. DDIM holds up best at few steps.
+        :param preview_cond_free: Whether the preview uses conditioning-free guidance, which doubles its cost.
+        The remaining arguments are the same as for tts(), with k=1.
+        :return: Yields two dicts, the preview and then the final render, with the following keys:
+                 - 'stage': 'preview' or 'final'.
+                 - 'wav': the clip, shape (1,S), 24kHz.
+                 - 'elapsed': seconds since the generator was started.
+        """
+        start_time = time()
+        if get_device_name() == "dml" and half_p:
+            print("Float16 requested but not supported with the DirectML backend, disabling...")
+            half_p = False
+
+        self.diffusion.enable_fp16 = half_p
+        self.deterministic_state(seed=use_deterministic_seed)
+        if diffusion_inputs == 'codes':
+            store_latents = False  # Not needed, the autoregressive latents aren't used.
+
+        text_tokens = self.encode_text(text)
+        auto_conditioning, diffusion_conditioning, auto_conds = self.resolve_conditioning_latents(voice_samples, conditioning_latents)
+        self.autoregressive_batch_size = get_device_batch_size() if sample_batch_size is None or sample_batch_size == 0 else sample_batch_size
+
+        best_results, best_latents = self.sample_candidates(text_tokens, auto_conditioning, auto_conds=auto_conds, k=1,
+                                                            num_autoregressive_samples=num_autoregressive_samples,
+                                                            temperature=temperature, length_penalty=length_penalty,
+                                                            repetition_penalty=repetition_penalty, top_p=top_p,
+                                                            max_mel_tokens=max_mel_tokens, cvvp_amount=cvvp_amount,
+                                                            half_p=half_p, store_latents=store_latents, verbose=verbose,
+                                                            **hf_generate_kwargs)
+        latents = self.candidate_latents(text_tokens, best_results, auto_conditioning, best_latents=best_latents, breathing_room=breathing_room,
+                                         diffusion_inputs=diffusion_inputs)[0]
+
+        self.acquire_models('diffusion', 'vocoder')
+        diffusion_conditioning = migrate_to_device( diffusion_conditioning, self.device )
+        embeddings = diffusion_embeddings(self.diffusion, latents, diffusion_conditioning, self.input_sample_rate, self.output_sample_rate)
+
+        @torch.inference_mode()
+        def render(iterations, sampler, guidance, desc):
+            diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=iterations, cond_free=guidance, cond_free_k=cond_free_k,
+                                                       cond_free_batched=cond_free_batched)
+            mel = do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature,
+                                           verbose=verbose, desc=desc, sampler=sampler, input_sample_rate=self.input_sample_rate,
+                                           output_sample_rate=self.output_sample_rate, precomputed_embeddings=embeddings)
+            wav = self.vocoder.inference(mel)
+            return self.potentially_redact(wav, text).squeeze(0).cpu()
+
+        def release(_=None):
+            self.release_models('diffusion', 'vocoder')
+            do_gc()
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        final = None
+        try:
+            preview = render(preview_iterations, preview_sampler, preview_cond_free, "Rendering preview..")
+            final = executor.submit(render, diffusion_iterations, diffusion_sampler, cond_free, "Transforming autoregressive outputs into audio..")
+            yield {'stage': 'preview', 'wav': preview, 'elapsed': time() - start_time}
+            wav = final.result()
+            yield {'stage': 'final', 'wav': wav, 'elapsed': time() - start_time}
+        finally:
+            if final is not None and not final.done():
+                # Closed after the preview: don't wait for the full render, which can't be interrupted. The models
+                # are released once it is done.
+                final.add_done_callback(release)
+                executor.shutdown(wait=False)
+            else:
+                executor.shutdown()
+                release()
+
+    def tts_pipelined(self, texts, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
+            # autoregressive generation parameters follow
+            num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+            sample_batch_size=None,
+            # CVVP parameters follow
+            cvvp_amount=.0,
+            # diffusion generation parameters follow
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, cond_free_batched=False, diffusion_temperature=1.0,
+            diffusion_sampler="P",
+            breathing_room=8,
+            half_p=False,
+            store_latents=False,
+            diffusion_inputs='latents',
+            adaptive_threshold=None, min_autoregressive_samples=None,
+            # pipelining parameters follow
+            max_pending=2,
+            crossfade=0,
+            **hf_generate_kwargs):
+        """
+        Renders a list of text segments with the same voice, running autoregressive sampling and ranking, diffusion,
+        vocoding and redaction as separate pipeline stages (see Pipeline), so that e.g. the next segment is sampled while
+        the previous one is diffused. Every model stays on the device until the generator is exhausted or closed.
+        Clips are distributed like those tts() produces for each segment, but the stages run on concurrent threads that
+        all draw from the global random number generator, in an order that depends on thread scheduling, so runs aren't
+        reproducible, even with a seed.
+        :param texts: List of text segments, e.g. from split_and_recombine_text().
+        :param max_pending: Number of segments that may wait between two stages before the earlier stage blocks. Bounds
+                            the memory held by segments in flight.
+        :param crossfade: Length in samples of the linear crossfade applied where consecutive segments are joined in
+                          the 'stitched' output.
+        :param adaptive_threshold: As for tts(). num_autoregressive_samples is then the average number of samples per
+                                   segment: the samples segments stop short of are left to the segments after them,
+                                   up to twice num_autoregressive_samples (see SampleBudget).
+        The remaining arguments are the same as for tts(), and are shared by every segment.
+        :return: Yields a dict per segment, in order, with the following keys:
+                 - 'index': index of the segment.
+                 - 'text': the segment's text.
+                 - 'wav': the best clip, shape (1,S), 24kHz.
+                 - 'candidates': list of all k clips, best first.
+                 - 'stitched': the part of the joined document that is final once this segment is done, see
+                   CrossfadeStitcher. Concatenating it over all segments gives the whole document.
+                 - 'elapsed': seconds since the generator was started.
+        """
+        if get_device_name() == "dml" and half_p:
+            print("Float16 requested but not supported with the DirectML backend, disabling...")
+            half_p = False
+
+        self.diffusion.enable_fp16 = half_p
+        self.deterministic_state(seed=use_deterministic_seed)
+        if diffusion_inputs == 'codes':
+            store_latents = False  # Not needed, the autoregressive latents aren't used.
+
+        auto_conditioning, diffusion_conditioning, auto_conds = self.resolve_conditioning_latents(voice_samples, conditioning_latents)
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k,
+                                                   cond_free_batched=cond_free_batched)
+        diffuser.sampler = diffusion_sampler.lower()
+        self.autoregressive_batch_size = get_device_batch_size() if sample_batch_size is None or sample_batch_size == 0 else sample_batch_size
+        sample_budget = None
+        if adaptive_threshold is not None:
+            sample_budget = SampleBudget(max(1, num_autoregressive_samples // self.autoregressive_batch_size))
+
+        def sample(item):
+            text_tokens = self.encode_text(item['text'])
+            best_results, best_latents = self.sample_candidates(text_tokens, auto_conditioning, auto_conds=auto_conds, k=k,
+                                                                num_autoregressive_samples=num_autoregressive_samples,
+                                                                temperature=temperature, length_penalty=length_penalty,
+                                                                repetition_penalty=repetition_penalty, top_p=top_p,
+                                                                max_mel_tokens=max_mel_tokens, cvvp_amount=cvvp_amount,
+                                                                half_p=half_p, store_latents=store_latents, verbose=verbose,
+                                                                adaptive_threshold=adaptive_threshold,
+                                                                min_autoregressive_samples=min_autoregressive_samples,
+                                                                sample_budget=sample_budget, **hf_generate_kwargs)
+            item['latents'] = self.candidate_latents(text_tokens, best_results, auto_conditioning, best_latents=best_latents, breathing_room=breathing_room,
+                                                     diffusion_inputs=diffusion_inputs)
+            return item
+
+        def diffuse(item):
+            item['mels'] = [do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning, temperature=diffusion_temperature,
+                                                     verbose=verbose, desc="Transforming autoregressive outputs into audio..", sampler=diffusion_sampler,
+                                                     input_sample_rate=self.input_sample_rate, output_sample_rate=self.output_sample_rate)
+                            for latents in item.pop('latents')]
+            return item
+
+        def vocode(item):
+            item['candidates'] = [self.vocoder.inference(mel) for mel in item.pop('mels')]
+            return item
+
+        def redact(item):
+            item['candidates'] = [self.potentially_redact(wav, item['text']).squeeze(0).cpu() for wav in item['candidates']]
+            return item
+
+        preloaded_tensors = self.preloaded_tensors
+        models = ['autoregressive', 'clvp', 'diffusion', 'vocoder']
+        if cvvp_amount > 0:
+            if self.cvvp is None:
+                self.load_cvvp()
+            models.append('cvvp')
+        if not preloaded_tensors:
+            self.acquire_models(*models)
+            # The stages would otherwise move the models they use off the device while another stage needs them.
+            self.preloaded_tensors = True
+        diffusion_conditioning = migrate_to_device( diffusion_conditioning, self.device )
+
+        start_time = time()
+        stitcher = CrossfadeStitcher(crossfade)
+        pipeline = Pipeline([sample, diffuse, vocode, redact], max_pending=max_pending)
+        try:
+            for item in pipeline.run({'index': i, 'text': text} for i, text in enumerate(texts)):
+                item['wav'] = item['candidates'][0]
+                item['stitched'] = stitcher.push(item['wav'])
+                if item['index'] == len(texts) - 1:
+                    item['stitched'] = torch.cat([item['stitched'], stitcher.flush()], dim=-1)
+                item['elapsed'] = time() - start_time
+                yield item
+        finally:
+            if not preloaded_tensors:
+                self.preloaded_tensors = False
+                self.release_models(*models)
+            do_gc()
 
     @torch.inference_mode()
     def tts(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
@@ -627,16 +1249,23 @@ class TextToSpeech:
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
             sample_batch_size=None,
+            length_prediction=None,
+            prune_every=None, prune_fraction=.5, prune_refill=False,
+            adaptive_threshold=None, min_autoregressive_samples=None,
             autoregressive_model=None,
             diffusion_model=None,
             tokenizer_json=None,
             # CVVP parameters follow
             cvvp_amount=.0,
             # diffusion generation parameters follow
-            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, cond_free_batched=False, diffusion_temperature=1.0,
             diffusion_sampler="P",
             breathing_room=8,
             half_p=False,
+            store_latents=False,
+            batch_diffusion=False,
+            overlap_scoring=False,
+            diffusion_inputs='latents',
             **hf_generate_kwargs):
         """
         Produces an audio clip of the given text being spoken with the given reference voice.
@@ -656,6 +1285,22 @@ class TextToSpeech:
                                    of long silences or "uhhhhhhs", etc.
         :param top_p: P value used in nucleus sampling. (0,1]. Lower values mean the decoder produces more "likely" (aka boring) outputs.
         :param max_mel_tokens: Restricts the output length. (0,600] integer. Each unit is 1/20 of a second.
+        :param length_prediction: Lowers max_mel_tokens to an estimate of how long the text can take to speak (see
+                                  predict_max_mel_tokens()), so samples that never stop are cut short. 'text' estimates
+                                  from the length of the text alone, 'voice' also measures the speaking rate of
+                                  voice_samples. None (default) keeps max_mel_tokens. See length_cap_rate().
+        :param prune_every: Enables pruning: every prune_every codes, the unfinished samples of a batch are scored with
+                            CLVP on the codes they have so far and the worst prune_fraction of them are dropped, so
+                            less time goes into candidates that would be discarded anyway. Only with the native
+                            decoding loop. See check_pruning.py for how it compares with decoding every sample.
+        :param prune_fraction: Fraction of the unfinished samples dropped at every pruning.
+        :param prune_refill: Keep sampling fresh batches after the num_autoregressive_samples ones until as many
+                             samples as those batches started with are complete, or twice as many batches have run.
+        :param adaptive_threshold: Enables adaptive sampling: batches are scored as they are sampled, and sampling stops
+                                   once a batch improves the mean score of the k best candidates by no more than this
+                                   fraction, instead of always taking num_autoregressive_samples, which becomes the
+                                   most that is sampled. Easy lines then take far fewer samples. E.g. .01.
+        :param min_autoregressive_samples: With adaptive_threshold, the fewest samples taken. Defaults to one batch.
         :param typical_sampling: Turns typical sampling on or off. This sampling mode is discussed in this paper: https://arxiv.org/abs/2202.00666
                                  I was interested in the premise, but the results were not as good as I was hoping. This is off by default, but
                                  could use some tuning.
@@ -674,12 +1319,30 @@ class TextToSpeech:
         :param cond_free_k: Knob that determines how to balance the conditioning free signal with the conditioning-present signal. [0,inf].
                             As cond_free_k increases, the output becomes dominated by the conditioning-free signal.
                             Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k
+        :param cond_free_batched: Runs both forward passes of conditioning-free diffusion as a single batch of twice the
+                                  size instead of two sequential calls. Halves the number of diffusion model calls, which
+                                  is noticeably faster on CPU, at the cost of twice the activation memory per call.
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
+        :param diffusion_inputs: What the diffusion model is conditioned on. 'latents' (default) uses the last hidden
+                                 states of the autoregressive model, which takes another autoregressive forward pass over
+                                 the chosen candidates. 'codes' feeds the chosen codes into the diffusion model's own code
+                                 embedding instead, skipping that pass at some cost in quality; see benchmark.py.
         ~~OTHER STUFF~~
+        :param store_latents: Keeps the autoregressive latents of every sample (as float16) while sampling, instead of
+                              running the autoregressive model again over the best candidates to recompute them. Saves a
+                              full transformer pass at the cost of memory.
+        :param batch_diffusion: Runs the diffusion model and vocoder over all k candidates at once, padded to the longest
+                                one, instead of one candidate at a time. Faster when k > 1; the diffusion noise drawn
+                                for each candidate differs from the unbatched path, so outputs are not bit-identical.
+        :param overlap_scoring: Scores each autoregressive batch with CLVP/CVVP on a worker thread while the next one is
+                                being generated, keeping only the running best k candidates, instead of scoring all of
+                                them after sampling. Keeps the scoring models on the device during sampling.
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
                                    here: https://huggingface.co/docs/transformers/internal/generation_utils
+                                   num_beams (with do_sample=False) decodes deterministically with beam search instead of
+                                   sampling, see sample_candidates().
         :return: Generated audio clip(s) as a torch tensor. Shape 1,S if k=1 else, (k,1,S) where S is the sample length.
                  Sample rate is 24kHz.
         """
@@ -706,12 +1369,364 @@ class TextToSpeech:
         elif tokenizer_json != self.tokenizer_json:
             self.load_tokenizer_json(tokenizer_json)
 
+        assert diffusion_inputs in ('latents', 'codes'), f'Unknown diffusion_inputs: {diffusion_inputs}'
+        if diffusion_inputs == 'codes':
+            store_latents = False
+
+        text_tokens = self.encode_text(text)
+        auto_conditioning, diffusion_conditioning, auto_conds = self.resolve_conditioning_latents(voice_samples, conditioning_latents)
+        if length_prediction is not None:
+            max_mel_tokens = self.predict_max_mel_tokens(text, voice_samples if length_prediction == 'voice' else None,
+                                                         limit=max_mel_tokens)
+            if verbose:
+                print(f"Capping autoregressive samples at {max_mel_tokens} codes")
+
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k,
+                                                   cond_free_batched=cond_free_batched)
+
+        self.autoregressive_batch_size = get_device_batch_size() if sample_batch_size is None or sample_batch_size == 0 else sample_batch_size
+
+        with torch.no_grad():
+            best_results, best_latents = self.sample_candidates(text_tokens, auto_conditioning, auto_conds=auto_conds, k=k,
+                                                                num_autoregressive_samples=num_autoregressive_samples,
+                                                                temperature=temperature, length_penalty=length_penalty,
+                                                                repetition_penalty=repetition_penalty, top_p=top_p,
+                                                                max_mel_tokens=max_mel_tokens, cvvp_amount=cvvp_amount,
+                                                                half_p=half_p, store_latents=store_latents,
+                                                                overlap_scoring=overlap_scoring, verbose=verbose,
+                                                                prune_every=prune_every, prune_fraction=prune_fraction,
+                                                                prune_refill=prune_refill, adaptive_threshold=adaptive_threshold,
+                                                                min_autoregressive_samples=min_autoregressive_samples,
+                                                                **hf_generate_kwargs)
+
+            wav_candidates = self.render_candidates(text, text_tokens, best_results, auto_conditioning, diffusion_conditioning, diffuser,
+                                                    diffusion_temperature=diffusion_temperature, diffusion_sampler=diffusion_sampler,
+                                                    breathing_room=breathing_room, best_latents=best_latents, batch_diffusion=batch_diffusion,
+                                                    diffusion_inputs=diffusion_inputs)
+
+            if len(wav_candidates) > 1:
+                res = wav_candidates
+            else:
+                res = wav_candidates[0]
+
+            do_gc()
+
+            if return_deterministic_state:
+                return res, (deterministic_seed, text, voice_samples, conditioning_latents)
+            else:
+                return res
+
+    @torch.inference_mode()
+    def tts_batch(self, requests, k=1, verbose=True, use_deterministic_seed=None,
+            # autoregressive generation parameters follow
+            num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+            sample_batch_size=None,
+            length_prediction=None,
+            # CVVP parameters follow
+            cvvp_amount=.0,
+            # diffusion generation parameters follow
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, cond_free_batched=False, diffusion_temperature=1.0,
+            diffusion_sampler="P",
+            breathing_room=8,
+            half_p=False,
+            store_latents=False,
+            batch_diffusion=False,
+            diffusion_inputs='latents',
+            **hf_generate_kwargs):
+        """
+        Produces audio clips for several (text, voice) requests at once. The autoregressive model samples all of the
+        requests in shared, padded generation batches, which keeps the device busy even when each request only has a
+        short text. Candidate ranking and diffusion are then done per request.
+        :param requests: List of dicts, each with a 'text' key and optionally 'voice_samples' and/or
+                         'conditioning_latents' keys, with the same meaning as the tts() arguments of the same names.
+        :param num_autoregressive_samples: Number of autoregressive samples taken *per request*.
+        :param batch_diffusion: Diffuses and vocodes the chosen candidates of all requests together in one padded batch.
+        :param length_prediction: As for tts(). Requests share their generation batches, so the cap is the largest of
+                                  the requests' estimates.
+        The remaining arguments are the same as for tts(), and are shared by every request.
+        :return: A list with one entry per request, each shaped like the return value of tts().
+        """
+        if get_device_name() == "dml" and half_p:
+            print("Float16 requested but not supported with the DirectML backend, disabling...")
+            half_p = False
+
+        self.diffusion.enable_fp16 = half_p
+        self.deterministic_state(seed=use_deterministic_seed)
+        if diffusion_inputs == 'codes':
+            store_latents = False  # Not needed, the autoregressive latents aren't used.
+
+        texts = [request['text'] for request in requests]
+        text_tokens = [self.encode_text(text) for text in texts]
+        latents = [self.resolve_conditioning_latents(request.get('voice_samples'), request.get('conditioning_latents')) for request in requests]
+        if length_prediction is not None:
+            max_mel_tokens = max(self.predict_max_mel_tokens(request['text'], request.get('voice_samples') if length_prediction == 'voice' else None,
+                                                             limit=max_mel_tokens) for request in requests)
+
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k,
+                                                   cond_free_batched=cond_free_batched)
+
+        self.autoregressive_batch_size = get_device_batch_size() if sample_batch_size is None or sample_batch_size == 0 else sample_batch_size
+
+        with torch.no_grad():
+            stop_mel_token = self.autoregressive.stop_mel_token
+            samples = [[] for _ in requests]
+            sample_latents = [[] for _ in requests]
+
+            self.acquire_models('autoregressive')
+            self.prefetch_models('clvp')
+            auto_conditionings = [migrate_to_device( latent[0], self.device ).reshape(1, -1) for latent in latents]
+            text_tokens = [migrate_to_device( t, self.device ) for t in text_tokens]
+
+            # Requests are packed into groups no larger than the batch size, and every request in a group gets an equal
+            # share of the rows of each generation batch.
+            group_size = min(len(requests), self.autoregressive_batch_size)
+            groups = [list(range(i, min(i + group_size, len(requests)))) for i in range(0, len(requests), group_size)]
+
+            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
+                for group in groups:
+                    rows_per_request = max(1, self.autoregressive_batch_size // len(group))
+                    num_batches = max(1, -(-num_autoregressive_samples // rows_per_request))
+                    conds = torch.cat([auto_conditionings[r] for r in group], dim=0)
+                    tokens = [text_tokens[r] for r in group]
+                    for b in tqdm(range(num_batches), desc=f"Generating autoregressive samples for {len(group)} requests"):
+                        check_for_kill_signal()
+                        codes = self.autoregressive.inference_speech_batch(conds, tokens,
+                                                                           top_p=top_p,
+                                                                           temperature=temperature,
+                                                                           num_return_sequences=rows_per_request,
+                                                                           length_penalty=length_penalty,
+                                                                           repetition_penalty=repetition_penalty,
+                                                                           max_generate_length=max_mel_tokens,
+                                                                           return_latent=store_latents,
+                                                                           **{'do_sample': True, **hf_generate_kwargs})
+                        if store_latents:
+                            codes, codes_latents = codes
+                            codes_latents = F.pad(codes_latents, (0, 0, 0, max_mel_tokens - codes_latents.shape[1]))
+                        self.record_length_caps(codes)
+                        padding_needed = max_mel_tokens - codes.shape[1]
+                        codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                        for i, r in enumerate(group):
+                            samples[r].append(codes[i*rows_per_request:(i+1)*rows_per_request])
+                            if store_latents:
+                                sample_latents[r].append(codes_latents[i*rows_per_request:(i+1)*rows_per_request])
+
+            self.release_models('autoregressive')
+
+            results = []
+            pending_latents, pending_conditioning, pending_requests = [], [], []
+            for r, text in enumerate(texts):
+                auto_conditioning, diffusion_conditioning, auto_conds = latents[r]
+                request_samples = torch.cat(samples[r], dim=0)[:max(num_autoregressive_samples, k)]
+                best_results, best_indices = self.rank_candidates(text_tokens[r], [request_samples], auto_conds=auto_conds, k=k, cvvp_amount=cvvp_amount, half_p=half_p, verbose=verbose, return_indices=True)
+                samples[r] = None
+
+                best_latents = None
+                if store_latents:
+                    best_latents = torch.cat(sample_latents[r], dim=0)[best_indices].float()
+                sample_latents[r] = None
+
+                if batch_diffusion:
+                    # Defer diffusion until every request has been ranked, so all of their candidates share one batch.
+                    request_latents = self.candidate_latents(text_tokens[r], best_results, auto_conditioning, best_latents=best_latents, breathing_room=breathing_room,
+                                                             diffusion_inputs=diffusion_inputs)
+                    pending_latents.extend(request_latents)
+                    pending_conditioning.extend([diffusion_conditioning] * len(request_latents))
+                    pending_requests.extend([r] * len(request_latents))
+                    results.append([])
+                    continue
+
+                wav_candidates = self.render_candidates(text, text_tokens[r], best_results, auto_conditioning, diffusion_conditioning, diffuser,
+                                                        diffusion_temperature=diffusion_temperature, diffusion_sampler=diffusion_sampler,
+                                                        breathing_room=breathing_room, best_latents=best_latents, diffusion_inputs=diffusion_inputs)
+                results.append(wav_candidates if len(wav_candidates) > 1 else wav_candidates[0])
+
+            if batch_diffusion:
+                wavs = self.diffuse_and_vocode(pending_latents, pending_conditioning, diffuser, diffusion_temperature=diffusion_temperature,
+                                               diffusion_sampler=diffusion_sampler, batch_diffusion=True)
+                for r, wav in zip(pending_requests, wavs):
+                    results[r].append(self.potentially_redact(wav, texts[r]))
+                results = [wav_candidates if len(wav_candidates) > 1 else wav_candidates[0] for wav_candidates in results]
+
+            do_gc()
+            return results
+
+    @torch.inference_mode()
+    def sample_candidates(self, text_tokens, auto_conditioning, auto_conds=None, k=1, num_autoregressive_samples=512,
+                          temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+                          cvvp_amount=.0, half_p=False, store_latents=False, overlap_scoring=False, verbose=True,
+                          prune_every=None, prune_fraction=.5, prune_refill=False, adaptive_threshold=None,
+                          min_autoregressive_samples=None, sample_budget=None, **hf_generate_kwargs):
+        """
+        Samples num_autoregressive_samples codes from the autoregressive model in batches of autoregressive_batch_size
+        and keeps the k best according to CLVP/CVVP. Arguments are the same as for tts(). Pruning is skipped when
+        sampling goes through the AR scheduler, and adaptive sampling bypasses the scheduler. Without pruning or
+        adaptive sampling, sampling goes to the workers of start_sampling_workers() if there are any; latents are then
+        not kept. With num_beams (and do_sample=False), decodes a single batch of that many beams instead, since beam
+        search gives the same beams every time, and keeps the k best of them; pruning, adaptive sampling, the scheduler
+        and the workers don't apply.
+        :param sample_budget: With adaptive_threshold, an optional SampleBudget shared with other segments, which then
+                              sets the most batches this one may take instead of num_autoregressive_samples.
+        :return: (best_results, best_latents), the (k,s) best codes and, if store_latents is set, their autoregressive
+                 latents (otherwise None).
+        """
+        if self.sampling_workers is not None and not prune_every and adaptive_threshold is None \
+                and set(hf_generate_kwargs) <= NATIVE_DECODING_KWARGS and hf_generate_kwargs.get('num_beams', 1) == 1:
+            seed = self.seed if self.seed is not None else self.deterministic_state()
+            sampling = {'do_sample': True, 'top_p': top_p, 'temperature': temperature, 'length_penalty': length_penalty,
+                        'repetition_penalty': repetition_penalty, **hf_generate_kwargs}
+            best_results, _, candidates = self.sampling_workers.sample(
+                text_tokens, auto_conditioning, num_autoregressive_samples, k, seed, self.autoregressive_batch_size,
+                max_mel_tokens, sampling, auto_conds=auto_conds, cvvp_amount=cvvp_amount)
+            self.best_candidates = candidates.tolist()
+            if verbose:
+                print(f"Best candidates (seed {seed}): {self.best_candidates}")
+            return migrate_to_device( best_results, self.device ), None
+
+        samples = []
+        sample_latents = []
+        num_batches = num_autoregressive_samples // self.autoregressive_batch_size
+        if num_autoregressive_samples < self.autoregressive_batch_size:
+            num_autoregressive_samples = 1
+        stop_mel_token = self.autoregressive.stop_mel_token
+        batch_size = self.autoregressive_batch_size
+        num_beams = hf_generate_kwargs.get('num_beams', 1)
+        if num_beams > 1:
+            num_batches, batch_size = 1, num_beams
+            k = min(k, num_beams)
+            prune_every, adaptive_threshold = None, None
+
+        adaptive = adaptive_threshold is not None
+        if adaptive:
+            if sample_budget is not None:
+                num_batches = sample_budget.allowance()
+            min_batches = max(1, -(-(min_autoregressive_samples or 0) // self.autoregressive_batch_size))
+        scheduled = self.ar_scheduler is not None and set(hf_generate_kwargs) <= NATIVE_DECODING_KWARGS \
+            and hf_generate_kwargs.get('num_beams', 1) == 1 and not adaptive
+        if not scheduled:
+            self.acquire_models('autoregressive')
+        self.prefetch_models('clvp')
+        auto_conditioning = migrate_to_device( auto_conditioning, self.device )
+        text_tokens = migrate_to_device( text_tokens, self.device )
+
+        prune_fn = None
+        if prune_every and not scheduled:
+            self.acquire_models('clvp')
+            prune_fn = lambda codes: self.clvp(text_tokens.repeat(codes.shape[0], 1), codes, return_loss=False)
+
+        scorer = None
+        if adaptive:
+            # Batches are scored as they come, to know when to stop.
+            score_fn = self.acquire_scoring(text_tokens, auto_conds=auto_conds, cvvp_amount=cvvp_amount)
+            topk = RunningTopK(k)
+            batches_done, best = 0, None
+        elif overlap_scoring:
+            scorer = self.start_background_scoring(text_tokens, auto_conds=auto_conds, k=k, cvvp_amount=cvvp_amount, half_p=half_p)
+
+        if scheduled:
+            # Every batch is its own request, so batches come back (and get scored) as soon as they are done.
+            futures = [self.ar_scheduler.submit(auto_conditioning, text_tokens,
+                                                num_return_sequences=self.autoregressive_batch_size,
+                                                max_generate_length=max_mel_tokens,
+                                                do_sample=hf_generate_kwargs.get('do_sample', True),
+                                                top_k=hf_generate_kwargs.get('top_k', 50),
+                                                top_p=top_p,
+                                                temperature=temperature,
+                                                repetition_penalty=repetition_penalty,
+                                                return_latent=store_latents)
+                       for _ in range(num_batches)]
+            batches = (future.result() for future in futures)
+        else:
+            def sample_batches():
+                complete = 0
+                extra = num_batches if prune_refill and prune_fn is not None else 0
+                for b in range(num_batches + extra):
+                    if b >= num_batches and complete >= num_batches * self.autoregressive_batch_size:
+                        return
+                    codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
+                                                                 **{'do_sample': num_beams == 1, **hf_generate_kwargs},
+                                                                 top_p=top_p,
+                                                                 temperature=temperature,
+                                                                 num_return_sequences=batch_size,
+                                                                 length_penalty=length_penalty,
+                                                                 repetition_penalty=repetition_penalty,
+                                                                 max_generate_length=max_mel_tokens,
+                                                                 return_latent=store_latents,
+                                                                 prune_fn=prune_fn, prune_every=prune_every or 64,
+                                                                 prune_fraction=prune_fraction)
+                    complete += (codes[0] if store_latents else codes).shape[0]
+                    yield codes
+
+            batches = sample_batches()
+
+        try:
+            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
+                for codes in tqdm(batches, total=num_batches, desc="Generating autoregressive samples"):
+                    check_for_kill_signal()
+                    if store_latents:
+                        codes, latents = codes
+                        sample_latents.append(F.pad(latents, (0, 0, 0, max_mel_tokens - latents.shape[1])))
+                    self.record_length_caps(codes)
+                    padding_needed = max_mel_tokens - codes.shape[1]
+                    codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                    if adaptive:
+                        topk.update(score_fn(codes).float(), codes)
+                        batches_done += 1
+                        previous, best = best, topk.scores.mean().item()
+                        if batches_done >= min_batches and previous is not None and best - previous <= adaptive_threshold * abs(previous):
+                            break
+                    elif scorer is not None:
+                        scorer.submit(codes)
+                    else:
+                        samples.append(codes)
+        except BaseException:
+            # Don't leave the scoring thread waiting for batches that will never come, or the models on the device.
+            if scorer is not None:
+                scorer.close()
+            if not scheduled:
+                self.release_models('autoregressive')
+            self.release_models('clvp', 'cvvp')
+            raise
+
+        if not scheduled:
+            self.release_models('autoregressive')
+
+        if adaptive:
+            best_results, best_indices = topk.result()
+            self.release_models('clvp', 'cvvp')
+            self.prefetch_models('diffusion')
+            if sample_budget is not None:
+                sample_budget.spend(batches_done)
+            if verbose:
+                print(f"Stopped autoregressive sampling after {batches_done} of at most {num_batches} batches")
+        elif scorer is not None:
+            best_results, best_indices = self.finish_background_scoring(scorer)
+        else:
+            best_results, best_indices = self.rank_candidates(text_tokens, samples, auto_conds=auto_conds, k=k, cvvp_amount=cvvp_amount, half_p=half_p, verbose=verbose, return_indices=True)
+        del samples
+
+        best_latents = None
+        if store_latents:
+            best_latents = torch.cat(sample_latents, dim=0)[best_indices].float()
+        del sample_latents
+
+        return best_results, best_latents
+
+    def encode_text(self, text):
+        """
+        Tokenizes the given text into the (1,t) tensor the autoregressive model and CLVP expect.
+        """
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0)
         text_tokens = migrate_to_device( text_tokens, self.device )
 
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
+        return text_tokens
 
+    def resolve_conditioning_latents(self, voice_samples=None, conditioning_latents=None):
+        """
+        Returns (autoregressive_conditioning_latent, diffusion_conditioning_latent, autoregressive_conditioning_mels) for
+        the given voice, following the same precedence as tts(). The mels are None unless they are available.
+        """
         auto_conds = None
         if voice_samples is not None:
             auto_conditioning, diffusion_conditioning, auto_conds, _ = self.get_conditioning_latents(voice_samples, return_mels=True, verbose=True)
@@ -723,108 +1738,161 @@ class TextToSpeech:
                 auto_conditioning, diffusion_conditioning, auto_conds, _ = conditioning_latents
         else:
             auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
+        return auto_conditioning, diffusion_conditioning, auto_conds
 
-        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
+    @torch.inference_mode()
+    def rank_candidates(self, text_tokens, samples, auto_conds=None, k=1, cvvp_amount=.0, half_p=False, verbose=True, return_indices=False):
+        """
+        Scores batches of autoregressive outputs against the text with CLVP (and CVVP, if cvvp_amount > 0) and returns
+        the k best codes. The codes are fixed up with fix_autoregressive_output() in place.
+        :param samples: List of (b,s) code tensors, all padded to the same length.
+        :param return_indices: Also return the indices of the best codes within the concatenated samples.
+        """
+        if self.unsqueeze_sample_batches:
+            new_samples = []
+            for batch in samples:
+                 for i in range(batch.shape[0]):
+                    new_samples.append(batch[i].unsqueeze(0))
+            samples = new_samples
+
+        clip_results = []
+
+        with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
+            self.acquire_models('clvp')
+
+            if cvvp_amount > 0:
+                if self.cvvp is None:
+                    self.load_cvvp()
+                self.acquire_models('cvvp')
+            self.prefetch_models('diffusion')
+            
+            desc="Computing best candidates"
+            if verbose:
+                if self.cvvp is None:
+                    desc = "Computing best candidates using CLVP"
+                else:
+                    desc = f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
 
-        self.autoregressive_batch_size = get_device_batch_size() if sample_batch_size is None or sample_batch_size == 0 else sample_batch_size
+            
+            for batch in tqdm(samples, desc=desc):
+                check_for_kill_signal()
+                clip_results.append(self.score_batch(text_tokens, batch, auto_conds=auto_conds, cvvp_amount=cvvp_amount))
 
-        with torch.no_grad():
-            samples = []
-            num_batches = num_autoregressive_samples // self.autoregressive_batch_size
-            if num_autoregressive_samples < self.autoregressive_batch_size:
-                num_autoregressive_samples = 1
-            stop_mel_token = self.autoregressive.stop_mel_token
-            calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+        if not self.preloaded_tensors and auto_conds is not None:
+            auto_conds = migrate_to_device( auto_conds, 'cpu' )
 
-            self.autoregressive = migrate_to_device( self.autoregressive, self.device )
-            auto_conditioning = migrate_to_device( auto_conditioning, self.device )
-            text_tokens = migrate_to_device( text_tokens, self.device )
+        clip_results = torch.cat(clip_results, dim=0)
+        samples = torch.cat(samples, dim=0)
+        if k < samples.shape[0]:
+            best_indices = torch.topk(clip_results, k=k).indices
+        else:
+            best_indices = torch.arange(samples.shape[0], device=samples.device)
+        best_results = samples[best_indices]
+        
+        self.release_models('clvp', 'cvvp')
 
-            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
-                for b in tqdm(range(num_batches), desc="Generating autoregressive samples"):
-                    check_for_kill_signal()
-                    codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
-                                                                 do_sample=True,
-                                                                 top_p=top_p,
-                                                                 temperature=temperature,
-                                                                 num_return_sequences=self.autoregressive_batch_size,
-                                                                 length_penalty=length_penalty,
-                                                                 repetition_penalty=repetition_penalty,
-                                                                 max_generate_length=max_mel_tokens,
-                                                                 **hf_generate_kwargs)
-                    padding_needed = max_mel_tokens - codes.shape[1]
-                    codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                    samples.append(codes)
+        if return_indices:
+            return best_results, best_indices
+        return best_results
 
-            if not self.preloaded_tensors:
-                self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
+    def start_background_scoring(self, text_tokens, auto_conds=None, k=1, cvvp_amount=.0, half_p=False):
+        """
+        Starts scoring autoregressive batches on a worker thread as they are produced, see BackgroundScorer. Submit
+        (b,s) code batches padded to a common length to the returned scorer, then call finish_background_scoring().
+        The scoring models stay on the device alongside the autoregressive model until then.
+        """
+        return BackgroundScorer(self.acquire_scoring(text_tokens, auto_conds=auto_conds, cvvp_amount=cvvp_amount), k,
+                                context_fn=lambda: torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p))
 
+    def acquire_scoring(self, text_tokens, auto_conds=None, cvvp_amount=.0):
+        """
+        Moves the scoring models to the device and returns a function scoring (b,s) code batches with score_batch().
+        Release the models with release_models('clvp', 'cvvp') when done.
+        """
+        if cvvp_amount > 0:
+            if self.cvvp is None:
+                self.load_cvvp()
+            self.acquire_models('cvvp')
+            auto_conds = migrate_to_device( auto_conds, self.device )
+        self.acquire_models('clvp')
+
+        def score(batch):
+            check_for_kill_signal()
             if self.unsqueeze_sample_batches:
-                new_samples = []
-                for batch in samples:
-                     for i in range(batch.shape[0]):
-                        new_samples.append(batch[i].unsqueeze(0))
-                samples = new_samples
+                return torch.cat([self.score_batch(text_tokens, batch[i:i+1], auto_conds=auto_conds, cvvp_amount=cvvp_amount) for i in range(batch.shape[0])], dim=0)
+            return self.score_batch(text_tokens, batch, auto_conds=auto_conds, cvvp_amount=cvvp_amount)
 
-            clip_results = []
-            if auto_conds is not None:
-                auto_conditioning = migrate_to_device( auto_conditioning, self.device )
+        return score
 
-            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
-                if not self.preloaded_tensors:
-                    self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
-                    self.clvp = migrate_to_device( self.clvp, self.device )
-
-                if cvvp_amount > 0:
-                    if self.cvvp is None:
-                        self.load_cvvp()
-                    
-                    if not self.preloaded_tensors:
-                        self.cvvp = migrate_to_device( self.cvvp, self.device )
-                
-                desc="Computing best candidates"
-                if verbose:
-                    if self.cvvp is None:
-                        desc = "Computing best candidates using CLVP"
-                    else:
-                        desc = f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
+    def finish_background_scoring(self, scorer):
+        """
+        Waits for a scorer from start_background_scoring() to finish and returns the best codes and their indices, in
+        the same form as rank_candidates(..., return_indices=True).
+        """
+        try:
+            best_results, best_indices = scorer.finish()
+        finally:
+            self.release_models('clvp', 'cvvp')
+        self.prefetch_models('diffusion')
 
-                
-                for batch in tqdm(samples, desc=desc):
-                    check_for_kill_signal()
-                    for i in range(batch.shape[0]):
-                        batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-
-                    if cvvp_amount != 1:
-                        clvp = self.clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        
-                    if auto_conds is not None and cvvp_amount > 0:
-                        cvvp_accumulator = 0
-                        for cl in range(auto_conds.shape[1]):
-                            cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                        cvvp = cvvp_accumulator / auto_conds.shape[1]
-                        if cvvp_amount == 1:
-                            clip_results.append(cvvp)
-                        else:
-                            clip_results.append(cvvp * cvvp_amount + clvp * (1-cvvp_amount))
-                    else:
-                        clip_results.append(clvp)
+        return best_results, best_indices
 
-            if not self.preloaded_tensors and auto_conds is not None:
-                auto_conds = migrate_to_device( auto_conds, 'cpu' )
+    def score_batch(self, text_tokens, batch, auto_conds=None, cvvp_amount=.0):
+        """
+        Fixes up a (b,s) batch of autoregressive codes in place with fix_autoregressive_output() and scores it with CLVP
+        (and CVVP, if cvvp_amount > 0). The scoring models are expected to be on the device already.
+        :return: (b,) tensor of scores, higher is better.
+        """
+        stop_mel_token = self.autoregressive.stop_mel_token
+        for i in range(batch.shape[0]):
+            batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
+
+        if cvvp_amount != 1:
+            clvp = self.clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
+
+        if auto_conds is not None and cvvp_amount > 0:
+            cvvp_accumulator = 0
+            for cl in range(auto_conds.shape[1]):
+                cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
+            cvvp = cvvp_accumulator / auto_conds.shape[1]
+            if cvvp_amount == 1:
+                return cvvp
+            return cvvp * cvvp_amount + clvp * (1-cvvp_amount)
+        return clvp
 
-            clip_results = torch.cat(clip_results, dim=0)
-            samples = torch.cat(samples, dim=0)
-            if k < num_autoregressive_samples:
-                best_results = samples[torch.topk(clip_results, k=k).indices]
-            else:
-                best_results = samples
-            
-            if not self.preloaded_tensors:
-                self.clvp = migrate_to_device( self.clvp, 'cpu' )
-                self.cvvp = migrate_to_device( self.cvvp, 'cpu' )
-            
+    @torch.inference_mode()
+    def render_candidates(self, text, text_tokens, best_results, auto_conditioning, diffusion_conditioning, diffuser,
+                          diffusion_temperature=1.0, diffusion_sampler="P", breathing_room=8, best_latents=None, batch_diffusion=False,
+                          diffusion_inputs='latents'):
+        """
+        Turns the chosen autoregressive codes into waveforms: recomputes the autoregressive latents the diffusion model is
+        conditioned on, runs the diffusion model and vocoder for every candidate and applies redaction.
+        :param best_latents: Autoregressive latents of best_results that were kept during sampling. When given, they are
+                             used as is and the autoregressive model is not run again.
+        :param batch_diffusion: Diffuse and vocode all candidates together in one padded batch, see diffuse_and_vocode().
+        :param diffusion_inputs: What the diffusion model is conditioned on, see candidate_latents().
+        :return: List of (1,1,S) waveforms, one per row of best_results.
+        """
+        latents = self.candidate_latents(text_tokens, best_results, auto_conditioning, best_latents=best_latents, breathing_room=breathing_room,
+                                         diffusion_inputs=diffusion_inputs)
+        wav_candidates = self.diffuse_and_vocode(latents, diffusion_conditioning, diffuser, diffusion_temperature=diffusion_temperature,
+                                                 diffusion_sampler=diffusion_sampler, batch_diffusion=batch_diffusion)
+        return [self.potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+
+    @torch.inference_mode()
+    def candidate_latents(self, text_tokens, best_results, auto_conditioning, best_latents=None, breathing_room=8, diffusion_inputs='latents'):
+        """
+        Returns the autoregressive latents for each row of best_results, trimmed to the end of speech, as a list of
+        (1,s,d) tensors on the device.
+        :param best_latents: Latents that were kept during sampling. When given, the autoregressive model is not run again.
+        :param diffusion_inputs: 'latents', or 'codes' to return the trimmed (1,s) codes themselves instead, which the
+                                 diffusion model can be conditioned on directly. The autoregressive model is not run.
+        """
+        calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+        use_codes = diffusion_inputs == 'codes'
+        recompute_latents = best_latents is None and not use_codes
 
+        if recompute_latents:
             if get_device_name() == "dml":
                 text_tokens = migrate_to_device( text_tokens, 'cpu' )
                 best_results = migrate_to_device( best_results, 'cpu' )
@@ -832,81 +1900,96 @@ class TextToSpeech:
                 self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
             else:
                 auto_conditioning = auto_conditioning.to(self.device)
-                self.autoregressive = self.autoregressive.to(self.device)
-
-            del samples
+                self.acquire_models('autoregressive')
 
             # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
-            # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            best_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+            # inputs. Re-produce those for the top results, unless they were stored while sampling (see store_latents).
+            best_latents = self.autoregressive(auto_conditioning.repeat(best_results.shape[0], 1), text_tokens.repeat(best_results.shape[0], 1),
                                                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
                                                torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
                                                return_latent=True, clip_inputs=False)
-            
-            diffusion_conditioning = migrate_to_device( diffusion_conditioning, self.device )
 
-            if get_device_name() == "dml":
+        if get_device_name() == "dml":
+            if recompute_latents:
                 self.autoregressive = migrate_to_device( self.autoregressive, self.device )
-                best_results = migrate_to_device( best_results, self.device )
-                best_latents = migrate_to_device( best_latents, self.device )
-                self.vocoder = migrate_to_device( self.vocoder, 'cpu' )
-            else:
-                if not self.preloaded_tensors:
-                    self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
+            best_results = migrate_to_device( best_results, self.device )
+            best_latents = migrate_to_device( best_latents, self.device )
+        else:
+            best_latents = migrate_to_device( best_latents, self.device )
+            if recompute_latents:
+                self.release_models('autoregressive')
+
+        trimmed = []
+        for b in range(best_results.shape[0]):
+            codes = best_results[b].unsqueeze(0)
+            latents = codes if use_codes else best_latents[b].unsqueeze(0)
+
+            # Find the first occurrence of the "calm" token and trim the codes to that.
+            ctokens = 0
+            for k in range(codes.shape[-1]):
+                if codes[0, k] == calm_token:
+                    ctokens += 1
+                else:
+                    ctokens = 0
+                if ctokens > breathing_room:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+                    latents = latents[:, :k]
+                    break
+            trimmed.append(latents)
+        return trimmed
 
-                self.diffusion = migrate_to_device( self.diffusion, self.device )
-                self.vocoder = migrate_to_device( self.vocoder, self.device )
-            
-            del text_tokens
-            del auto_conditioning
-
-            wav_candidates = []
-            for b in range(best_results.shape[0]):
-                codes = best_results[b].unsqueeze(0)
-                latents = best_latents[b].unsqueeze(0)
-
-                # Find the first occurrence of the "calm" token and trim the codes to that.
-                ctokens = 0
-                for k in range(codes.shape[-1]):
-                    if codes[0, k] == calm_token:
-                        ctokens += 1
-                    else:
-                        ctokens = 0
-                    if ctokens > breathing_room:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                        latents = latents[:, :k]
-                        break
+    @torch.inference_mode()
+    def diffuse_and_vocode(self, latents, diffusion_conditioning, diffuser, diffusion_temperature=1.0, diffusion_sampler="P", batch_diffusion=False):
+        """
+        Runs the diffusion model and the vocoder over a list of (1,s,d) autoregressive latents (or (1,s) codes).
+        :param diffusion_conditioning: The diffusion conditioning latent shared by all latents, or a list with one per latent.
+        :param batch_diffusion: Pad all latents to a common length and diffuse and vocode them as a single batch, with a
+                                length mask keeping the padding out of every row. This amortizes the per-step overhead
+                                of the diffusion loop over all of them.
+        :return: List of (1,1,S) waveforms.
+        """
+        if not isinstance(diffusion_conditioning, (list, tuple)):
+            diffusion_conditioning = [diffusion_conditioning] * len(latents)
+        diffusion_conditioning = [migrate_to_device( c, self.device ) for c in diffusion_conditioning]
 
-                mel = do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning,
+        dml = get_device_name() == "dml"
+        if dml:
+            self.vocoder = migrate_to_device( self.vocoder, 'cpu' )
+        else:
+            self.acquire_models('diffusion')
+            self.prefetch_models('vocoder')
+
+        wav_candidates = []
+        if batch_diffusion and len(latents) > 1:
+            mels = do_spectrogram_diffusion_batch(self.diffusion, diffuser, latents, diffusion_conditioning,
+                                                  temperature=diffusion_temperature, desc="Transforming autoregressive outputs into audio..", sampler=diffusion_sampler,
+                                                  input_sample_rate=self.input_sample_rate, output_sample_rate=self.output_sample_rate)
+            if not dml:
+                self.acquire_models('vocoder')
+            wav_candidates = vocode_batch(self.vocoder, mels)
+        else:
+            for latent, conditioning in zip(latents, diffusion_conditioning):
+                mel = do_spectrogram_diffusion(self.diffusion, diffuser, latent, conditioning,
                                                temperature=diffusion_temperature, desc="Transforming autoregressive outputs into audio..", sampler=diffusion_sampler,
                                                input_sample_rate=self.input_sample_rate, output_sample_rate=self.output_sample_rate)
 
+                if not dml:
+                    self.acquire_models('vocoder')
                 wav = self.vocoder.inference(mel)
                 wav_candidates.append(wav)
-            
-            if not self.preloaded_tensors:
-                self.diffusion = migrate_to_device( self.diffusion, 'cpu' )
-                self.vocoder = migrate_to_device( self.vocoder, 'cpu' )
-
-            def potentially_redact(clip, text):
-                if self.enable_redaction:
-                    t = clip.squeeze(1)
-                    t = migrate_to_device( t, 'cpu' if get_device_name() == "dml" else self.device)
-                    return self.aligner.redact(t, text, self.output_sample_rate).unsqueeze(1)
-                return clip
-            wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
+        
+        self.release_models('diffusion', 'vocoder')
 
-            if len(wav_candidates) > 1:
-                res = wav_candidates
-            else:
-                res = wav_candidates[0]
+        return wav_candidates
 
-            do_gc()
-
-            if return_deterministic_state:
-                return res, (deterministic_seed, text, voice_samples, conditioning_latents)
-            else:
-                return res
+    def potentially_redact(self, clip, text):
+        """
+        Removes the bracketed parts of the text from the given (1,1,S) clip, if redaction is enabled.
+        """
+        if self.enable_redaction:
+            t = clip.squeeze(1)
+            t = migrate_to_device( t, 'cpu' if get_device_name() == "dml" else self.device)
+            return self.aligner.redact(t, text, self.output_sample_rate).unsqueeze(1)
+        return clip
 
     def deterministic_state(self, seed=None):
         """
@@ -914,6 +1997,7 @@ class TextToSpeech:
         reproduced.
         """
         seed = int(time()) if seed is None else seed
+        self.seed = seed
         torch.manual_seed(seed)
         random.seed(seed)
         # Can't currently set this because of CUBLAS. TODO: potentially enable it if necessary.
@@ -0,0 +1,134 @@
+import argparse
+import os
+import re
+from time import time
+
+import torch
+import torchaudio
+
+from api import TextToSpeech, MODELS_DIR, load_discrete_vocoder_diffuser
+from utils.audio import load_voices, wav_to_univnet_mel
+from utils.wav2vec_alignment import Wav2VecAlignment
+
+DEFAULT_TEXTS = [
+    "The expressiveness of autoregressive transformers is literally nuts! I absolutely adore them.",
+    "Once upon a time there was a sweet little girl. Everyone who saw her liked her, but most of all her grandmother.",
+    "Thirty five thousand, four hundred and twelve people attended the match on Saturday afternoon.",
+]
+
+
+def log_mel_distance(a, b):
+    """
+    Mean absolute difference between the log mel spectrograms of two (1,S) clips, over the frames both have.
+    """
+    mel_a = wav_to_univnet_mel(a)
+    mel_b = wav_to_univnet_mel(b)
+    frames = min(mel_a.shape[-1], mel_b.shape[-1])
+    return (mel_a[..., :frames] - mel_b[..., :frames]).abs().mean().item()
+
+
+def normalize_transcript(text):
+    """
+    Lower cases text and keeps only letters, apostrophes and single spaces, so punctuation doesn't count as errors.
+    """
+    return ' '.join(re.sub(r"[^a-z' ]", ' ', text.lower()).split())
+
+
+def edit_distance(a, b):
+    """
+    Levenshtein distance between two strings.
+    """
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def character_error_rate(aligner, wav, text):
+    """
+    Character error rate of what wav2vec2 hears in a (1,S) clip against the text it should say.
+    """
+    expected = normalize_transcript(text)
+    heard = normalize_transcript(aligner.transcribe(wav, 24000))
+    return edit_distance(expected, heard) / max(len(expected), 1)
+
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time()
+    result = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares conditioning the diffusion model on autoregressive latents '
+                                                 '(the default) with conditioning it on the codes directly. Both are '
+                                                 'rendered from the same autoregressive samples and with the same seed. '
+                                                 'Each clip is transcribed with wav2vec2 and scored by its character '
+                                                 'error rate against the text.')
+    parser.add_argument('--textfile', type=str, help='A file with one text to render per line. Uses a few built in sentences if omitted.', default=None)
+    parser.add_argument('--voice', type=str, help='Selects the voice to use for generation.', default='pat')
+    parser.add_argument('--preset', type=str, help='Which voice preset to use.', default='fast')
+    parser.add_argument('--output_path', type=str, help='Where to store the rendered clips.', default='results/benchmark/')
+    parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints.', default=MODELS_DIR)
+    parser.add_argument('--seed', type=int, help='Random seed used for both paths.', default=0)
+    args = parser.parse_args()
+    os.makedirs(args.output_path, exist_ok=True)
+
+    if args.textfile is not None:
+        with open(args.textfile, 'r', encoding='utf-8') as f:
+            texts = [l.strip() for l in f.readlines() if l.strip()]
+    else:
+        texts = DEFAULT_TEXTS
+
+    tts = TextToSpeech(models_dir=args.model_dir)
+    settings = tts.preset_settings(args.preset)
+    voice_samples, conditioning_latents = load_voices(args.voice.split('&'))
+    diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=settings['diffusion_iterations'],
+                                              cond_free=settings.get('cond_free', True), cond_free_k=settings['cond_free_k'])
+    aligner = getattr(tts, 'aligner', None) or Wav2VecAlignment()
+
+    modes = ['latents', 'codes']
+    totals = {mode: 0 for mode in modes}
+    errors = {mode: 0 for mode in modes}
+    distances = []
+    for i, text in enumerate(texts):
+        text_tokens = tts.encode_text(text)
+        auto_conditioning, diffusion_conditioning, auto_conds = tts.resolve_conditioning_latents(voice_samples, conditioning_latents)
+        tts.deterministic_state(seed=args.seed)
+        best_results, _ = tts.sample_candidates(text_tokens, auto_conditioning, auto_conds=auto_conds, k=1,
+                                                num_autoregressive_samples=settings['num_autoregressive_samples'],
+                                                temperature=settings['temperature'], length_penalty=settings['length_penalty'],
+                                                repetition_penalty=settings['repetition_penalty'], top_p=settings['top_p'],
+                                                verbose=False)
+
+        wavs = {}
+        for mode in modes:
+            tts.deterministic_state(seed=args.seed)
+
+            def render():
+                inputs = tts.candidate_latents(text_tokens, best_results, auto_conditioning, diffusion_inputs=mode)
+                return tts.diffuse_and_vocode(inputs, diffusion_conditioning, diffuser,
+                                              diffusion_temperature=settings['diffusion_temperature'])[0]
+
+            wav, elapsed = timed(render)
+            wavs[mode] = wav.squeeze(0).cpu()
+            totals[mode] += elapsed
+            torchaudio.save(os.path.join(args.output_path, f'{i}_{mode}.wav'), wavs[mode], 24000)
+            cer = character_error_rate(aligner, wavs[mode], text)
+            errors[mode] += cer
+            print(f'[{i}] {mode}: {elapsed:.2f}s, {wavs[mode].shape[-1] / 24000:.2f}s of audio, CER {cer:.3f}')
+
+        distance = log_mel_distance(wavs['latents'], wavs['codes'])
+        distances.append(distance)
+        print(f'[{i}] log mel distance between the two: {distance:.4f}')
+
+    print(f'latents: {totals["latents"]:.2f}s total, codes: {totals["codes"]:.2f}s total '
+          f'({totals["latents"] / max(totals["codes"], 1e-6):.2f}x), mean log mel distance {sum(distances) / len(distances):.4f}')
+    print(f'mean CER: latents {errors["latents"] / len(texts):.3f}, codes {errors["codes"] / len(texts):.3f}')
@@ -0,0 +1,62 @@
+import argparse
+import os
+
+import torch
+
+from api import TextToSpeech, MODELS_DIR
+from benchmark import timed
+from utils.audio import load_voices
+
+
+def decode(tts, auto_conditioning, text_tokens, batch_size, tokens, do_sample=True):
+    """
+    Decodes exactly tokens codes for every one of batch_size sequences with the native loop (no stop token can end
+    them early).
+    """
+    model = tts.autoregressive
+    emb = model.embed_prompt(auto_conditioning, text_tokens)
+    return model.native_decoder.generate(emb, model.start_mel_token, -1, tokens, num_return_sequences=batch_size,
+                                         do_sample=do_sample, temperature=.8, top_p=.8, repetition_penalty=2.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the per token latency of autoregressive decoding on CPU with '
+                                                 'the transformer split over 1, 2, 4... local processes '
+                                                 '(ar_tensor_parallel), and checks that greedy decoding gives the same '
+                                                 'codes as a single process.')
+    parser.add_argument('--text', type=str, help='Text to decode after.', default='The expressiveness of autoregressive transformers is literally nuts! I absolutely adore them.')
+    parser.add_argument('--voice', type=str, help='Selects the voice to use for generation.', default='pat')
+    parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints.', default=MODELS_DIR)
+    parser.add_argument('--processes', type=str, help='Comma separated numbers of processes to compare.', default='1,2,4')
+    parser.add_argument('--cores', type=int, help='Number of cores split over the processes.', default=os.cpu_count())
+    parser.add_argument('--batch_size', type=int, help='Number of sequences decoded together.', default=1)
+    parser.add_argument('--tokens', type=int, help='Number of codes the latency is measured over.', default=64)
+    parser.add_argument('--seed', type=int, help='Random seed.', default=0)
+    args = parser.parse_args()
+
+    voice_samples, conditioning_latents = load_voices(args.voice.split('&'))
+    latencies = {}
+    reference = None
+    for k in [int(k) for k in args.processes.split(',')]:
+        torch.set_num_threads(max(1, args.cores // k))
+        tts = TextToSpeech(models_dir=args.model_dir, device='cpu', enable_redaction=False, ar_prompt_cache_size=0,
+                           ar_tensor_parallel=k)
+        auto_conditioning, _, _ = tts.resolve_conditioning_latents(voice_samples, conditioning_latents)
+        text_tokens = tts.encode_text(args.text)
+        with torch.inference_mode():
+            decode(tts, auto_conditioning, text_tokens, args.batch_size, 4)  # Warm up.
+            tts.deterministic_state(seed=args.seed)
+            _, short = timed(lambda: decode(tts, auto_conditioning, text_tokens, args.batch_size, args.tokens))
+            tts.deterministic_state(seed=args.seed)
+            _, long = timed(lambda: decode(tts, auto_conditioning, text_tokens, args.batch_size, 2 * args.tokens))
+            # The difference leaves out the prompt, which both runs share.
+            latencies[k] = (long - short) / args.tokens
+            greedy = decode(tts, auto_conditioning, text_tokens, 1, args.tokens, do_sample=False)
+        if reference is None:
+            reference = greedy
+        matching = (greedy == reference).float().cumprod(dim=1).sum().item()
+        baseline = next(iter(latencies.values()))
+        print(f'{k} processes: {latencies[k] * 1000:.1f}ms per token ({baseline / latencies[k]:.2f}x), '
+              f'greedy codes match the first run for {int(matching)} of {args.tokens} tokens')
+        tts.stop_tensor_parallel()
+        del tts
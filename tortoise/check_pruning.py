@@ -0,0 +1,62 @@
+import argparse
+
+import torch
+
+from api import TextToSpeech, MODELS_DIR
+from benchmark import DEFAULT_TEXTS, timed
+from utils.audio import load_voices
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares sampling with CLVP-guided pruning (prune_every) against decoding '
+                                                 'every autoregressive sample to completion: the CLVP scores of the best '
+                                                 'candidates each one finds, and the time spent sampling.')
+    parser.add_argument('--textfile', type=str, help='A file with one text to render per line. Uses a few built in sentences if omitted.', default=None)
+    parser.add_argument('--voice', type=str, help='Selects the voice to use for generation.', default='pat')
+    parser.add_argument('--preset', type=str, help='Which voice preset to use.', default='standard')
+    parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints.', default=MODELS_DIR)
+    parser.add_argument('--seed', type=int, help='Random seed used for both modes.', default=0)
+    parser.add_argument('--k', type=int, help='Number of best candidates compared.', default=3)
+    parser.add_argument('--prune_every', type=int, help='Number of codes between prunings.', default=64)
+    parser.add_argument('--prune_fraction', type=float, help='Fraction of the unfinished samples dropped at every pruning.', default=.5)
+    parser.add_argument('--prune_refill', action='store_true', help='Refill with fresh batches, see tts().')
+    args = parser.parse_args()
+
+    if args.textfile is not None:
+        with open(args.textfile, 'r', encoding='utf-8') as f:
+            texts = [l.strip() for l in f.readlines() if l.strip()]
+    else:
+        texts = DEFAULT_TEXTS
+
+    tts = TextToSpeech(models_dir=args.model_dir)
+    settings = tts.preset_settings(args.preset)
+    voice_samples, conditioning_latents = load_voices(args.voice.split('&'))
+    auto_conditioning, _, auto_conds = tts.resolve_conditioning_latents(voice_samples, conditioning_latents)
+
+    modes = {
+        'full': {},
+        'pruned': {'prune_every': args.prune_every, 'prune_fraction': args.prune_fraction, 'prune_refill': args.prune_refill},
+    }
+    scores = {mode: [] for mode in modes}
+    sampling_time = {mode: 0 for mode in modes}
+    with torch.inference_mode():
+        for i, text in enumerate(texts):
+            text_tokens = tts.encode_text(text)
+            for mode, pruning in modes.items():
+                tts.deterministic_state(seed=args.seed)
+                (best_results, _), elapsed = timed(lambda: tts.sample_candidates(
+                    text_tokens, auto_conditioning, auto_conds=auto_conds, k=args.k,
+                    num_autoregressive_samples=settings['num_autoregressive_samples'], temperature=settings['temperature'],
+                    length_penalty=settings['length_penalty'], repetition_penalty=settings['repetition_penalty'],
+                    top_p=settings['top_p'], verbose=False, **pruning))
+                sampling_time[mode] += elapsed
+                tts.acquire_models('clvp')
+                scores[mode].append(tts.score_batch(text_tokens, best_results.clone()).mean().item())
+                tts.release_models('clvp')
+            print(f'[{i}] mean CLVP score of the best {args.k}: full {scores["full"][-1]:.3f}, '
+                  f'pruned {scores["pruned"][-1]:.3f}')
+
+    mean_score = {mode: sum(s) / len(s) for mode, s in scores.items()}
+    print(f'sampling: full {sampling_time["full"]:.2f}s, pruned {sampling_time["pruned"]:.2f}s '
+          f'({sampling_time["full"] / max(sampling_time["pruned"], 1e-6):.2f}x)')
+    print(f'mean CLVP score: full {mean_score["full"]:.3f}, pruned {mean_score["pruned"]:.3f}')
@@ -0,0 +1,93 @@
+import argparse
+import os
+import sys
+
+import torch
+import torchaudio
+
+from api import TextToSpeech, MODELS_DIR, load_discrete_vocoder_diffuser
+from benchmark import DEFAULT_TEXTS, log_mel_distance, timed
+from utils.audio import load_voices
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the int8 autoregressive model (ar_quantize_int8) against the fp32 '
+                                                 'one on CPU: CLVP scores of the candidates each one samples, the waveforms '
+                                                 'rendered from the same codes with the latents of each, and the sampling '
+                                                 'throughput. Exits with an error if a threshold is exceeded.')
+    parser.add_argument('--textfile', type=str, help='A file with one text to render per line. Uses a few built in sentences if omitted.', default=None)
+    parser.add_argument('--voice', type=str, help='Selects the voice to use for generation.', default='pat')
+    parser.add_argument('--preset', type=str, help='Which voice preset to use.', default='ultra_fast')
+    parser.add_argument('--output_path', type=str, help='Where to store the rendered clips.', default='results/quantization/')
+    parser.add_argument('--model_dir', type=str, help='Where to find pretrained model checkpoints.', default=MODELS_DIR)
+    parser.add_argument('--seed', type=int, help='Random seed used for both models.', default=0)
+    parser.add_argument('--max_clvp_drop', type=float, help='Largest allowed relative drop of the mean CLVP score of the chosen candidates.', default=.05)
+    parser.add_argument('--max_mel_distance', type=float, help='Largest allowed mean log mel distance between clips rendered from the same codes.', default=.3)
+    args = parser.parse_args()
+    os.makedirs(args.output_path, exist_ok=True)
+
+    if args.textfile is not None:
+        with open(args.textfile, 'r', encoding='utf-8') as f:
+            texts = [l.strip() for l in f.readlines() if l.strip()]
+    else:
+        texts = DEFAULT_TEXTS
+
+    models = {
+        'fp32': TextToSpeech(models_dir=args.model_dir, device='cpu', enable_redaction=False),
+        'int8': TextToSpeech(models_dir=args.model_dir, device='cpu', enable_redaction=False, ar_quantize_int8=True),
+    }
+    reference = models['fp32']
+    settings = reference.preset_settings(args.preset)
+    voice_samples, conditioning_latents = load_voices(args.voice.split('&'))
+    diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=settings['diffusion_iterations'],
+                                              cond_free=settings.get('cond_free', True), cond_free_k=settings['cond_free_k'])
+    auto_conditioning, diffusion_conditioning, auto_conds = reference.resolve_conditioning_latents(voice_samples, conditioning_latents)
+
+    clvp_scores = {name: [] for name in models}
+    sampling_time = {name: 0 for name in models}
+    distances = []
+    with torch.inference_mode():
+        for i, text in enumerate(texts):
+            text_tokens = reference.encode_text(text)
+            candidates = {}
+            for name, tts in models.items():
+                tts.deterministic_state(seed=args.seed)
+                (best_results, _), elapsed = timed(lambda: tts.sample_candidates(
+                    text_tokens, auto_conditioning, auto_conds=auto_conds, k=1,
+                    num_autoregressive_samples=settings['num_autoregressive_samples'], temperature=settings['temperature'],
+                    length_penalty=settings['length_penalty'], repetition_penalty=settings['repetition_penalty'],
+                    top_p=settings['top_p'], verbose=False))
+                sampling_time[name] += elapsed
+                candidates[name] = best_results
+                # Both sets of candidates are scored by the same (fp32) CLVP.
+                clvp_scores[name].append(reference.score_batch(text_tokens, best_results.clone()).mean().item())
+
+            # Render the fp32 model's codes with the latents of each model, so only the quantization error differs.
+            wavs = {}
+            for name, tts in models.items():
+                tts.deterministic_state(seed=args.seed)
+                latents = tts.candidate_latents(text_tokens, candidates['fp32'], auto_conditioning)
+                wav = tts.diffuse_and_vocode(latents, diffusion_conditioning, diffuser,
+                                             diffusion_temperature=settings['diffusion_temperature'])[0]
+                wavs[name] = wav.squeeze(0).cpu()
+                torchaudio.save(os.path.join(args.output_path, f'{i}_{name}.wav'), wavs[name], 24000)
+            distances.append(log_mel_distance(wavs['fp32'], wavs['int8']))
+            print(f'[{i}] CLVP fp32 {clvp_scores["fp32"][-1]:.3f}, int8 {clvp_scores["int8"][-1]:.3f}, '
+                  f'log mel distance {distances[-1]:.4f}')
+
+    mean_clvp = {name: sum(scores) / len(scores) for name, scores in clvp_scores.items()}
+    clvp_drop = (mean_clvp['fp32'] - mean_clvp['int8']) / max(abs(mean_clvp['fp32']), 1e-6)
+    mean_distance = sum(distances) / len(distances)
+    print(f'sampling: fp32 {sampling_time["fp32"]:.2f}s, int8 {sampling_time["int8"]:.2f}s '
+          f'({sampling_time["fp32"] / max(sampling_time["int8"], 1e-6):.2f}x)')
+    print(f'mean CLVP score: fp32 {mean_clvp["fp32"]:.3f}, int8 {mean_clvp["int8"]:.3f} ({clvp_drop * 100:.1f}% drop)')
+    print(f'mean log mel distance: {mean_distance:.4f}')
+
+    failed = False
+    if clvp_drop > args.max_clvp_drop:
+        print(f'FAIL: CLVP score dropped by more than {args.max_clvp_drop * 100:.1f}%')
+        failed = True
+    if mean_distance > args.max_mel_distance:
+        print(f'FAIL: log mel distance is above {args.max_mel_distance}')
+        failed = True
+    sys.exit(1 if failed else 0)
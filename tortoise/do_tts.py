@@ -24,6 +24,12 @@ if __name__ == '__main__':
     parser.add_argument('--cvvp_amount', type=float, help='How much the CVVP model should influence the output.'
                                                           'Increasing this can in some cases reduce the likelihood of multiple speakers. Defaults to 0 (disabled)', default=.0)
     parser.add_argument('--temperature', type=float, help='The softmax temperature of the autoregressive model.', default=.8)
+    parser.add_argument('--draft_layers', type=int, help='Decode the autoregressive model speculatively, drafting tokens with this many of its first layers. '
+                                                         'Output is distributed the same. Disabled if omitted.', default=None)
+    parser.add_argument('--length_prediction', type=str, choices=['text', 'voice'], help='Cap the length of autoregressive samples at an estimate of how long the text takes to speak, '
+                                                                                       'from the text alone or also from the speaking rate of the voice. Disabled if omitted.', default=None)
+    parser.add_argument('--kv_dtype', type=str, choices=['bf16', 'int8'], help='Store the keys and values of the autoregressive model in bf16 or int8, '
+                                                                             'and report the memory they take. Full precision if omitted.', default=None)
     
     parser.add_argument('--autoregressive_samples', type=int, help='umber of samples taken from the autoregressive model, all of which are filtered using CLVP. As Tortoise is a probabilistic model, more samples means a higher probability of creating something "great".')
     parser.add_argument('--diffusion_iterations', type=int, help='Number of diffusion steps to perform. [0,4000]. More steps means the network has more chances to iteratively refine the output, which should theoretically mean a higher quality output. Generally a value above 250 is not noticeably better, however.')
@@ -39,7 +45,12 @@ if __name__ == '__main__':
 
     os.makedirs(args.output_path, exist_ok=True)
     #print(f'use_deepspeed do_tts_debug {use_deepspeed}')
-    tts = TextToSpeech(models_dir=args.model_dir, use_deepspeed=args.use_deepspeed)
+    tts = TextToSpeech(models_dir=args.model_dir, use_deepspeed=args.use_deepspeed, ar_draft_layers=args.draft_layers,
+                       ar_kv_dtype=args.kv_dtype)
+    if args.kv_dtype and torch.cuda.is_available():
+        for entry in tts.kv_cache_report():
+            print(f"KV cache {entry['kv_dtype'] or 'native'}: {entry['bytes_per_token'] / 1024:.1f}KB per position, "
+                  f"{entry['tokens']} positions or {entry['sequences']} full length sequences fit in free memory")
 
     selected_voices = args.voice.split(',')
     for k, selected_voice in enumerate(selected_voices):
@@ -52,12 +63,22 @@ if __name__ == '__main__':
         if (hasattr(args, "autoregressive_samples") and args.autoregressive_samples is not None) or (hasattr(args, "diffusion_iterations") and args.diffusion_iterations is not None):
             gen, dbg_state = tts.tts_with_preset(args.text, k=args.candidates, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
                                       use_deterministic_seed=args.seed, return_deterministic_state=True, cvvp_amount=args.cvvp_amount,
-                                      temperature=args.temperature,
+                                      temperature=args.temperature, length_prediction=args.length_prediction,
                                       num_autoregressive_samples=args.autoregressive_samples, diffusion_iterations=args.diffusion_iterations)
         else:
             gen, dbg_state = tts.tts_with_preset(args.text, k=args.candidates, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
                                       preset=args.preset, use_deterministic_seed=args.seed, return_deterministic_state=True, cvvp_amount=args.cvvp_amount,
-                                      temperature=args.temperature)
+                                      temperature=args.temperature, length_prediction=args.length_prediction)
+
+        if args.draft_layers:
+            acceptance = tts.speculative_acceptance(reset=True)
+            if acceptance is not None:
+                print(f'Speculative decoding accepted {acceptance * 100:.1f}% of drafted tokens for voice {selected_voice}')
+        cap_rate = tts.length_cap_rate(reset=True)
+        if cap_rate is not None:
+            print(f'{cap_rate * 100:.1f}% of autoregressive samples for voice {selected_voice} reached the length cap without stopping')
+        if args.kv_dtype and getattr(tts.autoregressive, 'native_decoder', None) is not None:
+            print(f'Keys and values of the last autoregressive batch took {tts.autoregressive.native_decoder.kv_cache_bytes / 1024 ** 2:.1f}MB')
 
         timestamp = int(time.time())
         outdir = f"{args.output_path}/{selected_voice}/{timestamp}/"
@@ -41,6 +41,31 @@ def normalization(channels):
     return GroupNorm32(groups, channels)
 
 
+def masked_group_norm(norm, x, mask=None):
+    """
+    Applies the given GroupNorm to a padded [N x C x T] batch, computing the statistics only over the positions where
+    mask is set, so padding does not change the result for the valid positions. Padded positions come out as 0.
+
+    :param norm: an nn.GroupNorm.
+    :param mask: an [N x T] tensor which is 1 for valid positions and 0 for padding. If None, norm is simply applied.
+    """
+    if mask is None:
+        return norm(x)
+    dtype = x.dtype
+    x = x.float()
+    b, c, t = x.shape
+    g = norm.num_groups
+    m = mask.float().reshape(b, 1, 1, t)
+    xg = x.reshape(b, g, c // g, t)
+    count = (m.sum(dim=-1, keepdim=True) * (c // g)).clamp(min=1)
+    mean = (xg * m).sum(dim=(2, 3), keepdim=True) / count
+    var = (((xg - mean) * m) ** 2).sum(dim=(2, 3), keepdim=True) / count
+    x = ((xg - mean) / torch.sqrt(var + norm.eps)).reshape(b, c, t)
+    if norm.affine:
+        x = x * norm.weight.float().reshape(1, c, 1) + norm.bias.float().reshape(1, c, 1)
+    return (x * m.reshape(b, 1, t)).type(dtype)
+
+
 class QKVAttentionLegacy(nn.Module):
     """
     A module which performs QKV attention. Matches legacy QKVAttention + input/output heads shaping
@@ -50,11 +75,13 @@ class QKVAttentionLegacy(nn.Module):
         super().__init__()
         self.n_heads = n_heads
 
-    def forward(self, qkv, mask=None, rel_pos=None):
+    def forward(self, qkv, mask=None, rel_pos=None, padding_mask=None):
         """
         Apply QKV attention.
 
         :param qkv: an [N x (H * 3 * C) x T] tensor of Qs, Ks, and Vs.
+        :param padding_mask: an optional [N x T] tensor which is 0 for padded positions. Padded keys are excluded before
+                             the softmax, so they receive no attention at all.
         :return: an [N x (H * C) x T] tensor after attention.
         """
         bs, width, length = qkv.shape
@@ -67,6 +94,10 @@ class QKVAttentionLegacy(nn.Module):
         )  # More stable with f16 than dividing afterwards
         if rel_pos is not None:
             weight = rel_pos(weight.reshape(bs, self.n_heads, weight.shape[-2], weight.shape[-1])).reshape(bs * self.n_heads, weight.shape[-2], weight.shape[-1])
+        if padding_mask is not None:
+            # A large finite value rather than -inf, which doesn't work properly on CPUs.
+            key_mask = padding_mask.bool().repeat_interleave(self.n_heads, 0).unsqueeze(1)
+            weight = weight.masked_fill(~key_mask, torch.finfo(weight.dtype).min)
         weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
         if mask is not None:
             # The proper way to do this is to mask before the softmax using -inf, but that doesn't work properly on CPUs.
@@ -114,11 +145,16 @@ class AttentionBlock(nn.Module):
         else:
             self.relative_pos_embeddings = None
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, padding_mask=None):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
-        h = self.attention(qkv, mask, self.relative_pos_embeddings)
+        if padding_mask is None:
+            qkv = self.qkv(self.norm(x))
+            h = self.attention(qkv, mask, self.relative_pos_embeddings)
+        else:
+            qkv = self.qkv(masked_group_norm(self.norm, x, padding_mask))
+            h = self.attention(qkv, mask, self.relative_pos_embeddings, padding_mask=padding_mask)
+            h = h * padding_mask.unsqueeze(1).to(h.dtype)
         h = self.proj_out(h)
         return (x + h).reshape(b, c, *spatial)
 
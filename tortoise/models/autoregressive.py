@@ -7,12 +7,17 @@ from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.utils.model_parallel_utils import get_device_map, assert_device_map
 from tortoise.models.arch_util import AttentionBlock
+from tortoise.models.decoding import GPT2Decoder, tensor_digest
+from tortoise.models.tensor_parallel import TensorParallelDecoder
 from tortoise.utils.typical_sampling import TypicalLogitsWarper
 
 from tortoise.utils.device import get_device_count
 
 import tortoise.utils.torch_intermediary as ml
 
+# generate() arguments the native decoding loop (see GPT2Decoder) reproduces; anything else falls back to generate().
+NATIVE_DECODING_KWARGS = {'do_sample', 'temperature', 'top_k', 'top_p', 'repetition_penalty', 'length_penalty', 'num_beams'}
+
 def null_position_embeddings(range, dim):
     return torch.zeros((range.shape[0], range.shape[1], dim), device=range.device)
 
@@ -50,6 +55,13 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.device_map = None
         self.cached_mel_emb = None
 
+        # Optional capture of the final-norm hidden state of every generated position, see start_latent_capture()
+        self.capture_latents = False
+        self.captured_latents = None
+        self.capture_dtype = torch.float16
+        self.capture_length = 0
+        self.capture_index = 0
+
     def parallelize(self, device_map=None):
         self.device_map = (
             get_device_map(len(self.transformer.h), range(get_device_count()))
@@ -77,6 +89,41 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
+    def start_latent_capture(self, max_length, dtype=torch.float16):
+        """
+        Makes the following generate() call keep the final-norm hidden state that produced each sampled token. Up to the
+        stop token, these are the latents UnifiedVoice.forward(..., return_latent=True) would recompute for the generated
+        codes. Past it they are conditioned on stop/pad tokens rather than on the codes fix_autoregressive_output() puts
+        there. The states are written into a buffer of max_length steps, allocated in the given dtype on the first
+        forward pass.
+        """
+        self.capture_latents = True
+        self.captured_latents = None
+        self.capture_dtype = dtype
+        self.capture_length = max_length
+        self.capture_index = 0
+
+    def stop_latent_capture(self):
+        """
+        Stops capturing and returns the captured latents as a (b,s,d) tensor, s being the number of generated tokens.
+        """
+        latents = self.captured_latents
+        if latents is not None:
+            latents = latents[:, :self.capture_index]
+        self.capture_latents = False
+        self.captured_latents = None
+        self.capture_index = 0
+        return latents
+
+    def _capture(self, normed_states):
+        # Only the last position produces a token; on the first step the prompt positions are skipped.
+        if self.captured_latents is None:
+            self.captured_latents = torch.zeros((normed_states.shape[0], self.capture_length, normed_states.shape[-1]),
+                                                dtype=self.capture_dtype, device=normed_states.device)
+        if self.capture_index < self.capture_length:
+            self.captured_latents[:, self.capture_index] = normed_states[:, -1].to(self.capture_dtype)
+            self.capture_index += 1
+
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
 
         token_type_ids = kwargs.get("token_type_ids", None)
@@ -165,7 +212,12 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
-        lm_logits = self.lm_head(hidden_states)
+        if self.capture_latents:
+            hidden_states = self.lm_head[0](hidden_states)
+            self._capture(hidden_states)
+            lm_logits = self.lm_head[1](hidden_states)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -185,11 +237,18 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         This function is used to re-order the :obj:`past_key_values` cache if
         :meth:`~transformers.PreTrainedModel.beam_search` or :meth:`~transformers.PreTrainedModel.beam_sample` is
         called. This is required to match :obj:`past_key_values` with the correct beam_idx at every generation step.
+        The cache is reordered in place, and only for the beams whose parent changed: the past of every step is a new
+        tensor that nothing else holds on to, so it doesn't need copying as a whole.
         """
-        return tuple(
-            tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
-            for layer_past in past
-        )
+        beam_idx = beam_idx.to(past[0][0].device)
+        moved = (beam_idx != torch.arange(beam_idx.shape[0], device=beam_idx.device)).nonzero().squeeze(1)
+        if moved.shape[0] == 0:
+            return past
+        parents = beam_idx[moved]
+        for layer_past in past:
+            for past_state in layer_past:
+                past_state[moved] = past_state[parents]
+        return past
 
 
 class ConditioningEncoder(nn.Module):
@@ -354,7 +413,9 @@ class UnifiedVoice(nn.Module):
         for module in embeddings:
             module.weight.data.normal_(mean=0.0, std=.02)
 
-    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False):
+    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, native_decoding=False, compile_decoding=False,
+                              prompt_cache=None, model_hash=None, draft_layers=None, speculative_lookahead=4,
+                              kv_dtype=None, tensor_parallel=None, checkpoint_path=None):
         seq_length = self.max_mel_tokens + self.max_text_tokens + self.max_prompt_tokens
         gpt_config = GPT2Config(vocab_size=self.max_mel_tokens,
                                 n_positions=seq_length,
@@ -377,6 +438,78 @@ class UnifiedVoice(nn.Module):
             self.inference_model = self.inference_model.eval()
             
         self.gpt.wte = self.mel_embedding
+        # The native loop runs the HF blocks itself, which deepspeed's injected kernels replace.
+        use_native = native_decoding and not (use_deepspeed and torch.cuda.is_available())
+        if isinstance(getattr(self, 'native_decoder', None), TensorParallelDecoder):
+            self.native_decoder.shutdown()
+        if use_native and tensor_parallel and tensor_parallel > 1:
+            # Shards of the blocks are loaded from checkpoint_path by the other processes, see TensorParallelDecoder.
+            self.native_decoder = TensorParallelDecoder(self.inference_model, tensor_parallel, checkpoint_path,
+                                                        model_hash=model_hash, kv_dtype=kv_dtype)
+        else:
+            self.native_decoder = GPT2Decoder(self.inference_model, compile=compile_decoding, prompt_cache=prompt_cache,
+                                              model_hash=model_hash, draft_layers=draft_layers,
+                                              lookahead=speculative_lookahead, kv_dtype=kv_dtype) if use_native else None
+
+    def can_decode_natively(self, input_tokens=None, typical_sampling=False, **hf_generate_kwargs):
+        """
+        Whether inference_speech() can use the native decoding loop rather than generate() for these arguments. Beam
+        search is native as long as it doesn't sample and isn't typical.
+        """
+        beams = hf_generate_kwargs.get('num_beams', 1) > 1
+        return getattr(self, 'native_decoder', None) is not None and input_tokens is None \
+            and not self.inference_model.model_parallel and set(hf_generate_kwargs) <= NATIVE_DECODING_KWARGS \
+            and not (beams and (typical_sampling or hf_generate_kwargs.get('do_sample', self.inference_model.config.do_sample)))
+
+    def prompt_keys(self, speech_conditioning_latents, text_inputs):
+        """
+        Returns the keys identifying each (conditioning latent, text) prompt in the native decoder's prompt cache, or
+        None if it has no cache.
+        """
+        if self.native_decoder.prompt_cache is None:
+            return None
+        return [(tensor_digest(cond), tuple(text.reshape(-1).tolist()))
+                for cond, text in zip(speech_conditioning_latents, text_inputs)]
+
+    def voice_keys(self, speech_conditioning_latents):
+        """
+        Returns the keys the native decoder records the acceptance of speculative drafts under for each conditioning
+        latent (see GPT2Decoder.acceptance_rates()), or None when it doesn't decode speculatively.
+        """
+        if not self.native_decoder.draft_layers:
+            return None
+        return [tensor_digest(cond) for cond in speech_conditioning_latents]
+
+    def native_generate(self, emb, max_new_tokens, attention_mask=None, num_return_sequences=1, typical_mass=None,
+                        return_latent=False, latent_dtype=torch.float16, prompt_keys=None, voice_keys=None,
+                        prune_fn=None, prune_every=64, prune_fraction=.5, generators=None, **hf_generate_kwargs):
+        """
+        Samples with the native decoding loop, taking the same arguments as generate() and using the same defaults.
+        Typical sampling is given as typical_mass rather than as a TypicalLogitsWarper, so the loop can fuse it.
+        The prune_* arguments and generators are those of GPT2Decoder.generate(). With num_beams, decodes with
+        GPT2Decoder.beam_search() instead, which ignores them.
+        """
+        config = self.inference_model.config
+        num_beams = hf_generate_kwargs.get('num_beams', config.num_beams)
+        if num_beams > 1:
+            return self.native_decoder.beam_search(emb, self.start_mel_token, self.stop_mel_token, max_new_tokens,
+                                                   prompt_mask=attention_mask, num_beams=num_beams,
+                                                   num_return_sequences=num_return_sequences,
+                                                   length_penalty=hf_generate_kwargs.get('length_penalty', config.length_penalty),
+                                                   repetition_penalty=hf_generate_kwargs.get('repetition_penalty', config.repetition_penalty),
+                                                   return_latent=return_latent, latent_dtype=latent_dtype,
+                                                   prompt_keys=prompt_keys)
+        return self.native_decoder.generate(emb, self.start_mel_token, self.stop_mel_token, max_new_tokens,
+                                            prompt_mask=attention_mask, num_return_sequences=num_return_sequences,
+                                            do_sample=hf_generate_kwargs.get('do_sample', config.do_sample),
+                                            temperature=hf_generate_kwargs.get('temperature', config.temperature),
+                                            top_k=hf_generate_kwargs.get('top_k', config.top_k),
+                                            top_p=hf_generate_kwargs.get('top_p', config.top_p),
+                                            repetition_penalty=hf_generate_kwargs.get('repetition_penalty', config.repetition_penalty),
+                                            typical_mass=typical_mass, return_latent=return_latent,
+                                            latent_dtype=latent_dtype, prompt_keys=prompt_keys, voice_keys=voice_keys,
+                                            prune_fn=prune_fn, prune_every=prune_every, prune_fraction=prune_fraction,
+                                            generators=generators)
 
     def build_aligned_inputs_and_targets(self, input, start_token, stop_token):
         inp = F.pad(input, (1,0), value=start_token)
@@ -494,19 +627,31 @@ class UnifiedVoice(nn.Module):
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_text.mean(), loss_mel.mean(), mel_logits
 
+    def embed_prompt(self, speech_conditioning_latent, text_inputs):
+        """
+        Embeds the (b,d) conditioning latents and (b,t) text tokens into the (b,p,d) prompt mel codes are generated after.
+        """
+        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+        text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+        conds = speech_conditioning_latent.unsqueeze(1).to(text_emb.dtype)
+        return torch.cat([conds, text_emb], dim=1)
+
     def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latent=False, latent_dtype=torch.float16,
+                         prune_fn=None, prune_every=64, prune_fraction=.5, generators=None, **hf_generate_kwargs):
+        """
+        Samples num_return_sequences mel codes for the given prompt. With prune_fn, the native decoding loop drops the
+        worst sequences along the way (see GPT2Decoder.generate()) and fewer rows are returned; generate() ignores it.
+        generators, one per sequence, seed every sequence on its own and need the native decoding loop.
+        """
         seq_length = self.max_mel_tokens + self.max_text_tokens + self.max_prompt_tokens
         if not hasattr(self, 'inference_model'):
             self.post_init_gpt2_config(kv_cache=self.kv_cache)
             
 
-        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs, text_targets = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
-        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
-
+        emb = self.embed_prompt(speech_conditioning_latent, text_inputs)
         conds = speech_conditioning_latent.unsqueeze(1)
-        emb = torch.cat([conds, text_emb], dim=1)
         self.inference_model.store_mel_emb(emb)
 
         fake_inputs = torch.full((emb.shape[0], conds.shape[1] + emb.shape[1],), fill_value=1, dtype=torch.long,
@@ -523,9 +668,89 @@ class UnifiedVoice(nn.Module):
 
         logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
         max_length = trunc_index + self.max_mel_tokens - 1  if max_generate_length is None else trunc_index + max_generate_length
-        gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        if self.can_decode_natively(input_tokens, typical_sampling=typical_sampling, **hf_generate_kwargs):
+            return self.native_generate(emb, max_length - trunc_index, num_return_sequences=num_return_sequences,
+                                        typical_mass=typical_mass if typical_sampling else None,
+                                        return_latent=return_latent, latent_dtype=latent_dtype,
+                                        prompt_keys=self.prompt_keys(speech_conditioning_latent, text_inputs),
+                                        voice_keys=self.voice_keys(speech_conditioning_latent),
+                                        prune_fn=prune_fn, prune_every=prune_every, prune_fraction=prune_fraction,
+                                        generators=generators, **hf_generate_kwargs)
+        assert generators is None, "Seeding every sequence on its own needs the native decoding loop"
+        if return_latent:
+            assert input_tokens is None, "Latents can only be captured when generating from the prompt alone"
+            assert hf_generate_kwargs.get('num_beams', 1) == 1, "Latents cannot be captured with beam search"
+            self.inference_model.start_latent_capture(max_length - trunc_index, dtype=latent_dtype)
+        try:
+            gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        finally:
+            latents = self.inference_model.stop_latent_capture() if return_latent else None
+        if return_latent:
+            return gen[:, trunc_index:], latents
+        return gen[:, trunc_index:]
+
+    def inference_speech_batch(self, speech_conditioning_latents, text_inputs, num_return_sequences=1,
+                               max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latent=False, latent_dtype=torch.float16,
+                               **hf_generate_kwargs):
+        """
+        Like inference_speech(), but generates for several (conditioning latent, text) prompts in a single pass.
+
+        Each prompt is embedded on its own and left-padded to the longest one, with the padding hidden from the
+        transformer through the attention mask. Since every prompt ends at the same position, the mel tokens of all
+        rows share their positions and the rest of the generation is identical to the single prompt case.
+
+        speech_conditioning_latents: float tensor (r,d), or a list of r (1,d) / (d,) tensors.
+        text_inputs: list of r int tensors of shape (1,t) or (t,). Lengths may differ.
+        Returns codes of shape (r*num_return_sequences, s). Rows [i*num_return_sequences:(i+1)*num_return_sequences]
+        belong to prompt i. With return_latent, the captured latents (see GPT2InferenceModel.start_latent_capture()) are
+        returned as well.
+        """
+        if not hasattr(self, 'inference_model'):
+            self.post_init_gpt2_config(kv_cache=self.kv_cache)
+
+        if isinstance(speech_conditioning_latents, (list, tuple)):
+            speech_conditioning_latents = torch.cat([c.reshape(1, -1) for c in speech_conditioning_latents], dim=0)
+        assert speech_conditioning_latents.shape[0] == len(text_inputs), "Every text needs its own conditioning latent"
+
+        embs = [self.embed_prompt(cond.reshape(1, -1), text.reshape(1, -1))
+                for cond, text in zip(speech_conditioning_latents, text_inputs)]
+
+        prompt_len = max([e.shape[1] for e in embs])
+        device = embs[0].device
+        emb = torch.zeros((len(embs), prompt_len, embs[0].shape[-1]), dtype=embs[0].dtype, device=device)
+        attention_mask = torch.zeros((len(embs), prompt_len + 1), dtype=torch.long, device=device)
+        for i, e in enumerate(embs):
+            emb[i, prompt_len - e.shape[1]:] = e[0]
+            attention_mask[i, prompt_len - e.shape[1]:] = 1
+        self.inference_model.store_mel_emb(emb)
+
+        inputs = torch.full((emb.shape[0], prompt_len + 1), fill_value=1, dtype=torch.long, device=device)
+        inputs[:, -1] = self.start_mel_token
+        trunc_index = inputs.shape[1]
+
+        logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
+        max_length = trunc_index + self.max_mel_tokens - 1 if max_generate_length is None else trunc_index + max_generate_length
+        if self.can_decode_natively(typical_sampling=typical_sampling, **hf_generate_kwargs):
+            return self.native_generate(emb, max_length - trunc_index, attention_mask=attention_mask[:, :-1],
+                                        num_return_sequences=num_return_sequences,
+                                        typical_mass=typical_mass if typical_sampling else None, return_latent=return_latent, latent_dtype=latent_dtype,
+                                        prompt_keys=self.prompt_keys(speech_conditioning_latents, text_inputs),
+                                        voice_keys=self.voice_keys(speech_conditioning_latents),
+                                        **hf_generate_kwargs)
+        if return_latent:
+            assert hf_generate_kwargs.get('num_beams', 1) == 1, "Latents cannot be captured with beam search"
+            self.inference_model.start_latent_capture(max_length - trunc_index, dtype=latent_dtype)
+        try:
+            gen = self.inference_model.generate(inputs, attention_mask=attention_mask, bos_token_id=self.start_mel_token,
+                                                pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        finally:
+            latents = self.inference_model.stop_latent_capture() if return_latent else None
+        if return_latent:
+            return gen[:, trunc_index:], latents
         return gen[:, trunc_index:]
 
 
@@ -0,0 +1,1103 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+
+def process_logits(logits, seen, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, logits_processor=None,
+                   typical_mass=None):
+    """
+    Applies the same logit processing as transformers' generate() does when sampling, in the same order: repetition
+    penalty, any extra logits_processor, typical filtering, temperature, top-k and top-p.
+    The parameters are either numbers, or (b,1) tensors giving every row its own value. A top_k of 0 and a top_p of 1
+    disable those filters.
+    :param logits: (b,v) logits of the next token.
+    :param seen: (b,v) bool tensor of the tokens each row has seen so far, which the repetition penalty applies to.
+    :param typical_mass: If set, applies typical_filter(), which filters like TypicalLogitsWarper.
+    """
+    per_row = torch.is_tensor
+    if per_row(repetition_penalty) or repetition_penalty != 1.0:
+        penalized = torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+        logits = torch.where(seen, penalized, logits)
+    if logits_processor is not None:
+        for processor in logits_processor:
+            logits = processor(None, logits)
+    if typical_mass is not None:
+        logits = typical_filter(logits, typical_mass)
+    if per_row(temperature) or temperature != 1.0:
+        logits = logits / temperature
+    if per_row(top_k):
+        k = min(int(top_k.max()), logits.shape[-1])
+        if k > 0:
+            top = torch.topk(logits, k)[0]
+            threshold = top.gather(1, (top_k.clamp(1, k) - 1).long())
+            logits = logits.masked_fill((logits < threshold) & (top_k > 0), -float("Inf"))
+    elif top_k is not None and top_k > 0:
+        top_k = min(top_k, logits.shape[-1])
+        threshold = torch.topk(logits, top_k)[0][..., -1, None]
+        logits = logits.masked_fill(logits < threshold, -float("Inf"))
+    if per_row(top_p) or (top_p is not None and top_p < 1.0):
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        # Shift right so the first token above the threshold is kept too.
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = False
+        if per_row(top_p):
+            sorted_indices_to_remove &= top_p < 1.0
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        logits = logits.masked_fill(indices_to_remove, -float("Inf"))
+    return logits
+
+
+def sample_tokens(logits, do_sample=True, noise=None):
+    """
+    Draws the next token of every row from the processed (b,v) logits, or takes the most likely one without do_sample.
+    do_sample may also be a (b,) bool tensor choosing per row.
+    :param noise: Optional (b,v) noise from row_noise(), which the draw is then made with (see gumbel_argmax()).
+    """
+    if noise is not None:
+        sampled = gumbel_argmax(logits, noise)
+        if torch.is_tensor(do_sample):
+            return torch.where(do_sample, sampled, torch.argmax(logits, dim=-1))
+        return sampled if do_sample else torch.argmax(logits, dim=-1)
+    if torch.is_tensor(do_sample):
+        probs = F.softmax(logits.float(), dim=-1)
+        return torch.where(do_sample, torch.multinomial(probs, num_samples=1).squeeze(1), torch.argmax(logits, dim=-1))
+    if not do_sample:
+        return torch.argmax(logits, dim=-1)
+    probs = F.softmax(logits.float(), dim=-1)
+    return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+
+KV_DTYPES = (None, 'bf16', 'int8')
+KV_SCALE_DTYPE = torch.float16
+
+
+def kv_storage_dtype(kv_dtype, dtype):
+    """
+    Returns the dtype keys and values are stored in for a kv_dtype setting (see KV_DTYPES), dtype being the one they
+    are computed in.
+    """
+    return {'bf16': torch.bfloat16, 'int8': torch.int8}.get(kv_dtype, dtype)
+
+
+def quantize_kv(x, kv_dtype):
+    """
+    Converts (b,h,t,d) keys or values to their storage dtype. With int8 every head of every position is scaled by its
+    own absolute maximum, so one outlier only costs precision within its head.
+    :return: (stored, scales), scales being the (b,h,t,1) dequantization factors for int8 and None otherwise.
+    """
+    if kv_dtype == 'int8':
+        scales = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+        return (x.float() / scales).round().to(torch.int8), scales.to(KV_SCALE_DTYPE)
+    return x.to(kv_storage_dtype(kv_dtype, x.dtype)), None
+
+
+def dequantize_kv(x, scales, dtype):
+    """
+    Inverse of quantize_kv(), returning keys or values in dtype for attention.
+    """
+    if scales is not None:
+        return x.to(dtype) * scales.to(dtype)
+    return x.to(dtype)
+
+
+def kv_bytes_per_token(layers, heads, head_dim, dtype, kv_dtype=None):
+    """
+    Returns the memory the keys and values of one position take across all layers.
+    """
+    size = head_dim * torch.empty((), dtype=kv_storage_dtype(kv_dtype, dtype)).element_size()
+    if kv_dtype == 'int8':
+        size += torch.empty((), dtype=KV_SCALE_DTYPE).element_size()
+    return 2 * layers * heads * size
+
+
+def kv_cache_report(layers, heads, head_dim, dtype, memory, sequence_length):
+    """
+    Lists, for every kv_dtype setting, how much memory a position takes and how many positions and whole sequences fit
+    in the given memory.
+    :param memory: Memory available for keys and values, in bytes.
+    :param sequence_length: Length of a sequence (prompt and codes) counted as a whole.
+    :return: A list of dicts with keys kv_dtype, bytes_per_token, tokens and sequences.
+    """
+    report = []
+    for kv_dtype in KV_DTYPES:
+        per_token = kv_bytes_per_token(layers, heads, head_dim, dtype, kv_dtype)
+        tokens = int(memory) // per_token
+        report.append({'kv_dtype': kv_dtype, 'bytes_per_token': per_token, 'tokens': tokens,
+                       'sequences': tokens // sequence_length})
+    return report
+
+
+def typical_filter(logits, mass, prefilter=256):
+    """
+    Keeps the tokens TypicalLogitsWarper keeps: those whose surprisal is closest to the entropy of their row, up to a
+    cumulative probability of mass. Rather than sorting the whole vocabulary, only the prefilter closest tokens are
+    ranked with topk(); rows whose mass isn't reached within them (a nearly flat distribution) fall back to ranking
+    every token.
+    :param logits: (b,v) logits, without -inf entries.
+    """
+    normalized = F.log_softmax(logits, dim=-1)
+    probs = normalized.exp()
+    entropy = -(normalized * probs).nansum(-1, keepdim=True)
+    shifted = (-normalized - entropy).abs()
+    vocab = logits.shape[-1]
+    for k in (min(prefilter, vocab), vocab):
+        scores, indices = torch.topk(-shifted, k)
+        cumulative_probs = probs.gather(1, indices).cumsum(dim=-1)
+        if k == vocab or bool((cumulative_probs[:, -1] >= mass).all()):
+            break
+    last = (cumulative_probs < mass).sum(dim=1, keepdim=True).clamp(max=k - 1)
+    return logits.masked_fill(shifted > -scores.gather(1, last), -float("Inf"))
+
+
+def gumbel_argmax(logits, noise=None):
+    """
+    Draws one index per row of (b,n) logits, distributed as softmax(logits), by adding Gumbel noise and taking the
+    maximum. Unlike multinomial() it needs neither the softmax nor its cumulative sum.
+    :param noise: Optional (b,n) standard exponential noise to draw with (the Gumbel noise being -log(noise)), e.g.
+                  from row_noise(). Drawn from the global generator if omitted.
+    """
+    if noise is None:
+        noise = torch.empty_like(logits).exponential_()
+    return torch.argmax(logits - noise.clamp(min=torch.finfo(noise.dtype).tiny).log(), dim=-1)
+
+
+def row_noise(generators, size, device):
+    """
+    Returns (b,size) standard exponential noise for sampling, every row drawn from its own torch.Generator, so a row's
+    draws don't depend on the other rows of the batch: a sequence sampled with a seeded generator comes out the same
+    whether it is sampled alone or with others.
+    """
+    return torch.stack([torch.empty((size,), device=device).exponential_(generator=g) for g in generators])
+
+
+def seeded_generators(seeds, device):
+    """
+    Returns a torch.Generator on device for each seed, for generate()'s generators.
+    """
+    return [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+
+
+def _top_p_sorted(values, log_total, top_p):
+    """
+    Top-p filtering of (b,k) logits sorted in descending order, log_total being the log of the softmax denominator of
+    each row over the whole vocabulary.
+    """
+    remove = (values - log_total).exp().cumsum(dim=-1) > top_p
+    remove[..., 1:] = remove[..., :-1].clone()
+    remove[..., 0] = False
+    if torch.is_tensor(top_p):
+        remove &= top_p < 1.0
+    return values.masked_fill(remove, -float("Inf"))
+
+
+def sample_next(logits, seen, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, typical_mass=None,
+                do_sample=True, prefilter=256, noise=None):
+    """
+    Draws the next token of every row from the same distribution as sample_tokens(process_logits(...)), but fused
+    into one pass that never sorts the vocabulary: top-k and top-p only look at the candidates topk() returns, typical
+    filtering ranks a prefilter of tokens (see typical_filter()), and the draw is a Gumbel-max over the candidates.
+
+    Top-p without top-k is only exact when the prefilter most likely tokens of every row already hold top_p of the
+    probability, which is checked; otherwise the step falls back to process_logits() and sample_tokens().
+    Arguments are those of process_logits() and sample_tokens(). Given noise over the whole vocabulary, the token drawn
+    only depends on the row's logits and noise, whichever path is taken.
+    :return: (b,) tokens.
+    """
+    per_row = torch.is_tensor
+    logits = logits.float()
+    if per_row(repetition_penalty) or repetition_penalty != 1.0:
+        logits = torch.where(seen, torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty), logits)
+    if typical_mass is not None:
+        logits = typical_filter(logits, typical_mass, prefilter)
+    if not per_row(do_sample) and not do_sample:
+        return torch.argmax(logits, dim=-1)
+    if per_row(temperature) or temperature != 1.0:
+        logits = logits / temperature
+
+    vocab = logits.shape[-1]
+    filter_p = per_row(top_p) or (top_p is not None and top_p < 1.0)
+    if per_row(top_k):
+        k = int(top_k.max()) if bool((top_k > 0).all()) else -1
+    else:
+        k = top_k if top_k is not None and top_k > 0 else 0
+    if k > 0:
+        values, indices = torch.topk(logits, min(k, vocab))
+        if per_row(top_k):
+            values = values.masked_fill(torch.arange(values.shape[1], device=values.device) >= top_k, -float("Inf"))
+        if filter_p:
+            values = _top_p_sorted(values, torch.logsumexp(values, dim=-1, keepdim=True), top_p)
+    elif k == 0 and filter_p:
+        values, indices = torch.topk(logits, min(prefilter, vocab))
+        log_total = torch.logsumexp(logits, dim=-1, keepdim=True)
+        if vocab > prefilter and not bool(((values - log_total).exp().sum(dim=-1, keepdim=True) > top_p).all()):
+            return sample_tokens(process_logits(logits, seen, top_k=top_k, top_p=top_p), do_sample, noise)
+        values = _top_p_sorted(values, log_total, top_p)
+    elif k == 0:
+        sampled = gumbel_argmax(logits, noise)
+        return torch.where(do_sample, sampled, torch.argmax(logits, dim=-1)) if per_row(do_sample) else sampled
+    else:
+        # Some rows filter with top-k and others don't.
+        return sample_tokens(process_logits(logits, seen, top_k=top_k, top_p=top_p), do_sample, noise)
+
+    sampled = indices.gather(1, gumbel_argmax(values, None if noise is None else noise.gather(1, indices)).unsqueeze(1)).squeeze(1)
+    return torch.where(do_sample, sampled, indices[:, 0]) if per_row(do_sample) else sampled
+
+
+def attention(q, k, v, mask):
+    """
+    Attention of the (b,h,t,d) queries over the (b,h,s,d) keys and values, where the (b,1,t,s) bool mask allows it.
+    """
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    weights = torch.matmul(q, k.transpose(-1, -2)) / (v.shape[-1] ** 0.5)
+    weights = weights.masked_fill(~mask, torch.finfo(weights.dtype).min)
+    return torch.matmul(weights.softmax(dim=-1), v)
+
+
+class StaticKVCache:
+    """
+    Key/value buffers for every layer of the transformer, allocated once for the longest sequence the decoding loop can
+    produce and filled in place, instead of being concatenated onto at every step. The buffers of a layer are allocated
+    on its first write; keys and values are read back in the dtype they were written in (which depends on autocast).
+
+    :param batch_size: Number of rows. If omitted, taken from the first write.
+    :param kv_dtype: Stores keys and values in 'bf16', or in 'int8' with a scale per head and position (see
+                     quantize_kv()), dequantizing them on every read. None keeps the dtype they are written in.
+    """
+    def __init__(self, layers, max_length, batch_size=None, kv_dtype=None):
+        self.keys = [None] * layers
+        self.values = [None] * layers
+        self.key_scales = [None] * layers
+        self.value_scales = [None] * layers
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.kv_dtype = kv_dtype
+        self.dtype = None
+
+    def write(self, layer, pos, k, v, rows=None):
+        """
+        Writes the (b,h,t,d) keys and values at positions [pos, pos+t). If rows (a slice) is given, only those rows are
+        written, with k and v broadcast over them.
+        """
+        if self.keys[layer] is None:
+            b = self.batch_size if self.batch_size is not None else k.shape[0]
+            _, h, _, d = k.shape
+            self.dtype = k.dtype
+            storage = kv_storage_dtype(self.kv_dtype, k.dtype)
+            self.keys[layer] = torch.zeros((b, h, self.max_length, d), dtype=storage, device=k.device)
+            self.values[layer] = torch.zeros((b, h, self.max_length, d), dtype=storage, device=v.device)
+            if self.kv_dtype == 'int8':
+                self.key_scales[layer] = torch.zeros((b, h, self.max_length, 1), dtype=KV_SCALE_DTYPE, device=k.device)
+                self.value_scales[layer] = torch.zeros((b, h, self.max_length, 1), dtype=KV_SCALE_DTYPE, device=v.device)
+        for buffers, scale_buffers, x in ((self.keys, self.key_scales, k), (self.values, self.value_scales, v)):
+            x, scales = quantize_kv(x, self.kv_dtype)
+            self._put(buffers[layer], pos, x, rows)
+            if scales is not None:
+                self._put(scale_buffers[layer], pos, scales, rows)
+
+    @staticmethod
+    def _put(buffer, pos, x, rows):
+        if rows is not None:
+            buffer[rows, :, pos:pos + x.shape[2]] = x
+        elif torch.is_tensor(pos):
+            # Positions given as a tensor keep the shapes independent of the step, for torch.compile().
+            buffer.index_copy_(2, pos + torch.arange(x.shape[2], device=x.device), x)
+        else:
+            buffer[:, :, pos:pos + x.shape[2]] = x
+
+    def read(self, layer, end):
+        k, v = self.keys[layer][:, :, :end], self.values[layer][:, :, :end]
+        if self.kv_dtype is None:
+            return k, v
+        k_scales, v_scales = self.key_scales[layer], self.value_scales[layer]
+        if k_scales is not None:
+            k_scales, v_scales = k_scales[:, :, :end], v_scales[:, :, :end]
+        return dequantize_kv(k, k_scales, self.dtype), dequantize_kv(v, v_scales, self.dtype)
+
+    def select_rows(self, rows):
+        """
+        Keeps only the given rows of the batch, e.g. to drop sequences that are done.
+        """
+        select = lambda buffers: [x if x is None else x.index_select(0, rows) for x in buffers]
+        self.keys, self.values = select(self.keys), select(self.values)
+        self.key_scales, self.value_scales = select(self.key_scales), select(self.value_scales)
+
+    def reorder_rows(self, rows, parents, start, end):
+        """
+        Overwrites, in place, positions [start, end) of the given rows with those of their parents (rows of the batch
+        as it was before the call). Beam search only needs the rows whose parent changed and the positions generated
+        since the prompt, which all beams of a prompt share, rather than a copy of the whole cache at every step.
+        """
+        for buffers in (self.keys, self.values, self.key_scales, self.value_scales):
+            for x in buffers:
+                if x is not None:
+                    x[rows, :, start:end] = x[parents, :, start:end]
+
+    def nbytes(self):
+        """
+        Returns the memory taken by the buffers allocated so far.
+        """
+        buffers = self.keys + self.values + self.key_scales + self.value_scales
+        return sum(x.numel() * x.element_size() for x in buffers if x is not None)
+
+
+class PagedKVCache:
+    """
+    Key/value cache for a number of slots (sequences of different lengths) that draws its memory from a shared pool of
+    fixed size blocks, so memory is taken in proportion to the length sequences actually reach rather than to the
+    longest they could get. Each slot has a block table mapping its positions to blocks; attention reads gather a
+    slot's blocks back into one sequence. Block 0 is never handed out: unused table entries point to it, and whatever
+    it holds is masked out.
+
+    Blocks are reserved explicitly (see reserve()) before positions are written, so the owner can decide what to do
+    when the pool runs out. Slots in use are kept contiguous at the front (see move()), the first `active` of them
+    being read.
+
+    :param dtype: Dtype keys and values are computed in, and read back in.
+    :param block_size: Number of positions per block.
+    :param num_blocks: Size of the pool. Defaults to enough blocks for every slot to reach max_length.
+    :param kv_dtype: Storage of keys and values, see StaticKVCache.
+    """
+    def __init__(self, layers, slots, max_length, heads, head_dim, dtype, device, block_size=16, num_blocks=None,
+                 kv_dtype=None):
+        self.block_size = block_size
+        self.blocks_per_slot = (max_length + block_size - 1) // block_size
+        self.max_length = max_length
+        self.dtype = dtype
+        self.kv_dtype = kv_dtype
+        if num_blocks is None:
+            num_blocks = slots * self.blocks_per_slot
+        pool = lambda d, dt: [torch.zeros((num_blocks + 1, heads, block_size, d), dtype=dt, device=device) for _ in range(layers)]
+        storage = kv_storage_dtype(kv_dtype, dtype)
+        self.keys = pool(head_dim, storage)
+        self.values = pool(head_dim, storage)
+        self.key_scales = pool(1, KV_SCALE_DTYPE) if kv_dtype == 'int8' else [None] * layers
+        self.value_scales = pool(1, KV_SCALE_DTYPE) if kv_dtype == 'int8' else [None] * layers
+        self.free = list(range(num_blocks, 0, -1))
+        self.tables = [[] for _ in range(slots)]
+        self.table = torch.zeros((slots, self.blocks_per_slot), dtype=torch.long, device=device)
+        self.active = 0
+        self.offset = 0  # First slot written by writes given a rows slice, see GPT2Decoder.prefill_prompts().
+
+    @staticmethod
+    def bytes_per_block(layers, heads, head_dim, dtype, block_size=16, kv_dtype=None):
+        return block_size * kv_bytes_per_token(layers, heads, head_dim, dtype, kv_dtype)
+
+    def reserve(self, slot, length):
+        """
+        Makes sure the slot has blocks for its first length positions.
+        :return: False, reserving nothing, if the pool doesn't have enough free blocks.
+        """
+        needed = (length + self.block_size - 1) // self.block_size - len(self.tables[slot])
+        if needed <= 0:
+            return True
+        if needed > len(self.free) or length > self.max_length:
+            return False
+        blocks = [self.free.pop() for _ in range(needed)]
+        start = len(self.tables[slot])
+        self.tables[slot] += blocks
+        self.table[slot, start:start + needed] = torch.tensor(blocks, dtype=torch.long)
+        return True
+
+    def free_slot(self, slot):
+        """
+        Returns the blocks of the slot to the pool.
+        """
+        self.free += self.tables[slot]
+        self.tables[slot] = []
+        self.table[slot] = 0
+
+    def move(self, src, dst):
+        """
+        Hands the blocks of slot src over to slot dst, which must be empty. No keys or values are copied.
+        """
+        self.tables[dst], self.tables[src] = self.tables[src], []
+        self.table[dst] = self.table[src]
+        self.table[src] = 0
+
+    def write(self, layer, pos, k, v, rows=None):
+        """
+        Writes keys and values either for a slice of rows (shifted by offset) at the same positions, or, when pos is a
+        (n,) tensor, one position per active slot. The positions must have been reserved.
+        """
+        if rows is not None:
+            rows = slice(rows.start + self.offset, rows.stop + self.offset)
+            positions = torch.arange(pos, pos + k.shape[2], device=k.device)
+            blocks = self.table[rows][:, positions // self.block_size]
+            offsets = positions % self.block_size
+        else:
+            blocks = self.table[torch.arange(pos.shape[0], device=pos.device), pos // self.block_size]
+            offsets = pos % self.block_size
+        for buffer, scale_buffer, x in ((self.keys[layer], self.key_scales[layer], k),
+                                        (self.values[layer], self.value_scales[layer], v)):
+            x, scales = quantize_kv(x, self.kv_dtype)
+            # (b,h,t,d) -> (b,t,h,d), the layout of buffer[blocks, :, offsets].
+            buffer[blocks, :, offsets] = (x.transpose(1, 2) if rows is not None else x[:, :, 0]).to(buffer.dtype)
+            if scales is not None:
+                scale_buffer[blocks, :, offsets] = scales.transpose(1, 2) if rows is not None else scales[:, :, 0]
+
+    def read(self, layer, end):
+        blocks = self.table[:self.active, :(end + self.block_size - 1) // self.block_size]
+        n, b = blocks.shape
+        gather = lambda pool: pool[blocks].transpose(1, 2).reshape(n, pool.shape[1], b * self.block_size, -1)[:, :, :end]
+        k, v = gather(self.keys[layer]), gather(self.values[layer])
+        if self.kv_dtype is None:
+            return k, v
+        k_scales, v_scales = self.key_scales[layer], self.value_scales[layer]
+        if k_scales is not None:
+            k_scales, v_scales = gather(k_scales), gather(v_scales)
+        return dequantize_kv(k, k_scales, self.dtype), dequantize_kv(v, v_scales, self.dtype)
+
+
+def tensor_digest(t):
+    """
+    Returns a digest of the contents of a tensor, for use in cache keys.
+    """
+    return hashlib.sha1(t.detach().float().cpu().numpy().tobytes()).hexdigest()
+
+
+class PromptKVCache:
+    """
+    Least recently used cache of the keys and values of prompts, so that generating from the same prompt again (a
+    repeated line, a retry, another round of candidates) skips running it through the transformer. Entries stay on the
+    device they were computed on.
+
+    :param max_entries: Number of prompts kept.
+    """
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class BeamHypotheses:
+    """
+    The num_beams best finished hypotheses of one prompt during beam search, scored like transformers' BeamHypotheses:
+    their summed log probabilities over their length (prompt included) to the power of length_penalty. A hypothesis
+    is kept as the beam it was finished from and its length, see GPT2Decoder.backtrack().
+    """
+    def __init__(self, num_beams, length_penalty=1.0):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.beams = []  # (score, beam, step, ended by the stop token)
+        self.worst_score = 1e9
+
+    def add(self, sum_logprobs, length, beam, step, stopped):
+        score = sum_logprobs / (length ** self.length_penalty)
+        if len(self.beams) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, beam, step, stopped))
+            if len(self.beams) > self.num_beams:
+                ranked = sorted((s, i) for i, (s, _, _, _) in enumerate(self.beams))
+                del self.beams[ranked[0][1]]
+                self.worst_score = ranked[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs, length):
+        """
+        Whether no beam still running can do better than the worst hypothesis kept.
+        """
+        if len(self.beams) < self.num_beams:
+            return False
+        return self.worst_score >= best_sum_logprobs / length ** self.length_penalty
+
+    def best(self, n):
+        return sorted(self.beams, key=lambda h: h[0], reverse=True)[:n]
+
+
+class GPT2Decoder:
+    """
+    Sampling loop for GPT2InferenceModel that replaces transformers' generate(). It runs the blocks of the HF GPT-2
+    model directly against a StaticKVCache and only computes logits for the last position. Sampling follows generate()
+    (see process_logits() and its fused version sample_next()), so both produce the same distribution of outputs.
+
+    :param model: The GPT2InferenceModel, which provides the transformer, embeddings and heads.
+    :param compile: Wrap the single token decoding step in torch.compile(), where available. The step then attends over
+                    the whole cache with a mask rather than over the filled part, so that its shapes never change.
+    :param compaction_threshold: Rows that emitted the stop token are dropped from the batch (and the cache) once they
+                                 make up this fraction of the rows still being decoded, so the remaining steps only run
+                                 over the unfinished ones. None to keep every row until all are done. Compacting changes
+                                 the batch size, so it is skipped when the decoding step is compiled.
+    :param prompt_cache: Optional PromptKVCache shared with other decoders, holding the keys and values of prompts
+                         across calls to generate().
+    :param model_hash: Identifies the model's weights in the keys of prompt_cache.
+    :param draft_layers: Enables self-speculative decoding (see speculate()) with a draft model made of this many of the
+                         first blocks of the transformer, followed by the final layer norm and heads.
+    :param lookahead: Number of tokens the draft proposes before the full model verifies them.
+    :param kv_dtype: Storage of the keys and values of the sequences being decoded: None, 'bf16' or 'int8', see
+                     StaticKVCache. Prompt keys and values held in prompt_cache are kept in full precision.
+    """
+    def __init__(self, model, compile=False, compaction_threshold=.25, prompt_cache=None, model_hash=None,
+                 draft_layers=None, lookahead=4, kv_dtype=None):
+        if kv_dtype not in KV_DTYPES:
+            raise ValueError(f'Unsupported kv_dtype {kv_dtype}, expected one of {KV_DTYPES}')
+        self.model = model
+        self.kv_dtype = kv_dtype
+        self.kv_cache_bytes = 0  # Memory taken by the keys and values of the last call to generate().
+        self.draft_layers = draft_layers
+        self.lookahead = lookahead
+        self.acceptance = {}  # Key given to generate() -> [drafted tokens, accepted tokens]
+        self.prompt_cache = prompt_cache
+        self.model_hash = model_hash if model_hash is not None else id(model)
+        self.transformer = model.transformer
+        self.heads = self.transformer.config.n_head
+        self.dim = self.transformer.config.n_embd
+        self.static = compile and hasattr(torch, 'compile')
+        self.compaction_threshold = None if self.static else compaction_threshold
+        self.decode_step = torch.compile(self._decode_step, dynamic=False) if self.static else self._decode_step
+
+    def _attention(self, q, k, v, mask):
+        return attention(q, k, v, mask)
+
+    def forward(self, x, pos, cache, mask, end):
+        """
+        Runs the transformer over x, the (b,t,d) embeddings of positions [pos, pos+t), reading and filling cache.
+        :param mask: (b,1,t,end) bool tensor of the keys each position may attend to.
+        :param end: Number of cache positions attended over.
+        :return: The (b,t,d) output of the final layer norm.
+        """
+        return self.transformer.ln_f(self.run_layers(x, pos, cache, mask, end))
+
+    def run_layers(self, x, pos, cache, mask, end, first=0, last=None):
+        """
+        Like forward(), but only runs blocks [first, last) and returns their output without the final layer norm.
+        """
+        b, t, _ = x.shape
+        head_dim = self.dim // self.heads
+        blocks = self.transformer.h[first:last]
+        for i, block in enumerate(blocks, start=first):
+            h = block.ln_1(x)
+            q, k, v = block.attn.c_attn(h).split(self.dim, dim=2)
+            q = q.view(b, t, self.heads, head_dim).transpose(1, 2)
+            k = k.view(b, t, self.heads, head_dim).transpose(1, 2)
+            v = v.view(b, t, self.heads, head_dim).transpose(1, 2)
+            cache.write(i, pos, k, v)
+            k, v = cache.read(i, end)
+            h = self._attention(q, k, v, mask)
+            h = h.transpose(1, 2).reshape(b, t, self.dim)
+            x = x + block.attn.c_proj(h)
+            x = x + block.mlp(block.ln_2(x))
+        return x
+
+    def new_cache(self, max_length, batch_size):
+        """
+        Returns the cache generate() decodes batch_size rows of up to max_length positions into.
+        """
+        return StaticKVCache(len(self.transformer.h), max_length, batch_size=batch_size, kv_dtype=self.kv_dtype)
+
+    def _decode_step(self, x, pos, cache, key_valid):
+        if self.static:
+            end = cache.max_length
+            mask = key_valid[:, None, None, :] & (torch.arange(end, device=x.device) <= pos)[None, None, None, :]
+        else:
+            end = pos + 1
+            mask = key_valid[:, None, None, :end]
+        return self.forward(x, pos, cache, mask, end)
+
+    def head(self, hidden):
+        """
+        Returns (logits, latents) for (b,d) final layer norm outputs, latents being the states fed to mel_head.
+        """
+        latents = self.model.lm_head[0](hidden)
+        return self.model.lm_head[1](latents), latents
+
+    def prefill(self, prompt_emb, prompt_mask, cache):
+        """
+        Runs the prompt through the transformer, filling the start of the cache.
+        :return: The (b,d) final layer norm output of the last prompt position.
+        """
+        b, p, _ = prompt_emb.shape
+        causal = torch.ones((p, p), dtype=torch.bool, device=prompt_emb.device).tril()
+        mask = (prompt_mask[:, None, None, :] & causal[None, None]) | torch.eye(p, dtype=torch.bool, device=prompt_emb.device)[None, None]
+        return self.forward(prompt_emb, 0, cache, mask, p)[:, -1]
+
+    def prefill_prompts(self, x, prompt_mask, cache, num_return_sequences, prompt_keys=None):
+        """
+        Fills the start of cache with the keys and values of the (r,p,d) prompts x, every prompt being shared by
+        num_return_sequences adjacent rows of the cache. Each prompt is run through the transformer once and its keys
+        and values copied to all of its rows, or it is not run at all when prompt_cache already holds it. The keys and
+        values of a prompt don't depend on how much it is padded, since the transformer has no position embeddings of
+        its own.
+        :param prompt_mask: (r,p) bool tensor, False for padding.
+        :param prompt_keys: Optional list of r keys identifying the prompts in prompt_cache, None for prompts not to cache.
+        :return: The (b,d) final layer norm output of the last prompt position of every row.
+        """
+        r, p, _ = x.shape
+        keys = [None] * r
+        if self.prompt_cache is not None and prompt_keys is not None:
+            keys = [None if k is None else (self.model_hash, str(x.device), str(x.dtype), torch.is_autocast_enabled(), k)
+                    for k in prompt_keys]
+        entries = [None if k is None else self.prompt_cache.get(k) for k in keys]
+
+        missing = [i for i, e in enumerate(entries) if e is None]
+        if missing:
+            index = torch.tensor(missing, device=x.device)
+            mask = prompt_mask.index_select(0, index)
+            scratch = StaticKVCache(len(self.transformer.h), p)
+            hidden = self.prefill(x.index_select(0, index), mask, scratch)
+            lengths = mask.sum(dim=1).tolist()
+            for j, i in enumerate(missing):
+                start = p - lengths[j]
+                kv = [(k[j:j + 1, :, start:], v[j:j + 1, :, start:]) for k, v in zip(scratch.keys, scratch.values)]
+                entry = (kv, hidden[j:j + 1])
+                if keys[i] is not None:
+                    # Clone, so the entry doesn't keep the whole scratch cache alive.
+                    entry = ([(k.clone(), v.clone()) for k, v in kv], hidden[j:j + 1].clone())
+                    self.prompt_cache.put(keys[i], entry)
+                entries[i] = entry
+
+        n = num_return_sequences
+        for i, (kv, _) in enumerate(entries):
+            for layer, (k, v) in enumerate(kv):
+                cache.write(layer, p - k.shape[2], k, v, rows=slice(i * n, (i + 1) * n))
+        return torch.cat([hidden for _, hidden in entries], dim=0).repeat_interleave(n, 0)
+
+    def embed_prompt(self, prompt_emb, start_token):
+        """
+        Appends the start token, at mel position 0, to the (b,p,d) prompt embeddings.
+        """
+        start = torch.full((prompt_emb.shape[0], 1), start_token, dtype=torch.long, device=prompt_emb.device)
+        start_emb = self.model.embeddings(start) + self.model.text_pos_embedding.get_fixed_embedding(1, prompt_emb.device)
+        return torch.cat([prompt_emb, start_emb.to(prompt_emb.dtype)], dim=1)
+
+    def embed_tokens(self, tokens, mel_pos):
+        """
+        Embeds the (b,) tokens at the given mel position.
+        """
+        emb = self.model.embeddings(tokens.unsqueeze(1))
+        return emb + self.model.text_pos_embedding.get_fixed_embedding(mel_pos + 1, tokens.device)
+
+    @torch.no_grad()
+    def generate(self, prompt_emb, start_token, stop_token, max_new_tokens, prompt_mask=None, num_return_sequences=1,
+                 do_sample=True, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, logits_processor=None,
+                 return_latent=False, latent_dtype=torch.float16, prompt_token_ids=(1,), prompt_keys=None, voice_keys=None,
+                 typical_mass=None, prune_fn=None, prune_every=64, prune_fraction=.5, generators=None):
+        """
+        Samples up to max_new_tokens mel codes after the given prompts.
+        :param prompt_emb: (r,p,d) prompt embeddings (conditioning latent and text), left-padded if lengths differ.
+        :param prompt_mask: (r,p) bool tensor, False for padding. None if nothing is padded.
+        :param num_return_sequences: Number of rows sampled for each prompt. Rows of the same prompt are adjacent.
+        :param prompt_token_ids: Token ids generate() sees in place of the prompt, which its repetition penalty applies to.
+        :param prompt_keys: Optional list of r keys identifying the prompts in prompt_cache, see prefill_prompts().
+        :param voice_keys: Optional list of r keys under which the acceptance of drafted tokens is recorded when decoding
+                           speculatively, see acceptance_rates().
+        :param typical_mass: Enables typical sampling with this mass, see typical_filter(). Tokens are drawn with the
+                             fused sample_next() unless an arbitrary logits_processor is given.
+        :param prune_fn: Enables pruning: every prune_every steps, the (n,t) codes generated so far by the n unfinished
+                         rows are passed to prune_fn, which returns (n,) scores (higher is better), and the worst
+                         prune_fraction of those rows are dropped from the batch. Pruned rows are left out of the
+                         returned codes and latents. Rows are decoded without speculation when given.
+        :param generators: Optional list of b torch.Generators (see seeded_generators()), one per row, that the row's
+                           tokens are drawn with (see row_noise()) rather than the global generator. Rows are decoded
+                           without speculation when given.
+        :return: (b,s) codes, rows finished early padded with stop_token, and with return_latent the (b,s,d) latents
+                 that produced them (see GPT2InferenceModel.start_latent_capture()). Rows dropped from the batch (see
+                 compaction_threshold) repeat the last latent they were decoded with from then on.
+        """
+        if prompt_mask is None:
+            prompt_mask = torch.ones(prompt_emb.shape[:2], dtype=torch.bool, device=prompt_emb.device)
+        x = self.embed_prompt(prompt_emb, start_token)
+        r, p, _ = x.shape
+        b = r * num_return_sequences
+        device = x.device
+
+        key_valid = torch.ones((r, p + max_new_tokens), dtype=torch.bool, device=device)
+        key_valid[:, :p - 1] = prompt_mask.bool()
+        cache = self.new_cache(p + max_new_tokens, b)
+        hidden = self.prefill_prompts(x, key_valid[:, :p], cache, num_return_sequences, prompt_keys)
+        self.kv_cache_bytes = cache.nbytes()
+        key_valid = key_valid.repeat_interleave(num_return_sequences, 0)
+
+        logits, latents = self.head(hidden)
+        seen = torch.zeros((b, logits.shape[-1]), dtype=torch.bool, device=device)
+        seen[:, list(prompt_token_ids) + [start_token]] = True
+        unfinished = torch.ones((b,), dtype=torch.bool, device=device)
+        tokens = torch.full((b, max_new_tokens), stop_token, dtype=torch.long, device=device)
+        captured = torch.zeros((b, max_new_tokens, latents.shape[-1]), dtype=latent_dtype, device=device) if return_latent else None
+
+        rows = torch.arange(b, device=device)  # Row of the output each row of the batch is decoded into.
+        if self.draft_layers and prune_fn is None and generators is None:
+            # speculate() draws from the global generator and can't prune, so either falls back to the plain loop.
+            params = {'temperature': temperature, 'top_k': top_k, 'top_p': top_p,
+                      'repetition_penalty': repetition_penalty, 'logits_processor': logits_processor,
+                      'typical_mass': typical_mass}
+            row_keys = None if voice_keys is None else [key for key in voice_keys for _ in range(num_return_sequences)]
+            length = self.speculate(cache, key_valid, p, logits, latents, seen, tokens, captured, rows, stop_token,
+                                    do_sample, params, row_keys)
+            if return_latent:
+                return tokens[:, :length], captured[:, :length]
+            return tokens[:, :length]
+
+        length = 0
+        kept = torch.ones((b,), dtype=torch.bool, device=device)  # Output rows that weren't pruned.
+        row_generators = list(generators) if generators is not None else None
+        for step in range(max_new_tokens):
+            if return_latent:
+                captured[rows, step] = latents.to(latent_dtype)
+            noise = row_noise(row_generators, logits.shape[-1], device) if row_generators is not None else None
+            if logits_processor:
+                logits = process_logits(logits.float(), seen, temperature=temperature, top_k=top_k, top_p=top_p,
+                                        repetition_penalty=repetition_penalty, logits_processor=logits_processor,
+                                        typical_mass=typical_mass)
+                next_tokens = sample_tokens(logits, do_sample, noise)
+            else:
+                next_tokens = sample_next(logits, seen, temperature=temperature, top_k=top_k, top_p=top_p,
+                                          repetition_penalty=repetition_penalty, typical_mass=typical_mass,
+                                          do_sample=do_sample, noise=noise)
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(unfinished, stop_token, dtype=torch.long))
+            tokens[rows, step] = next_tokens
+            seen.scatter_(1, next_tokens.unsqueeze(1), True)
+            unfinished &= next_tokens != stop_token
+            length = step + 1
+            pruned = False
+            if prune_fn is not None and length % prune_every == 0 and length < max_new_tokens:
+                pruned = self.prune(prune_fn, prune_fraction, tokens, rows, unfinished, kept, length)
+            active = int(unfinished.sum())
+            if step == max_new_tokens - 1 or active == 0:
+                break
+            if self.compaction_threshold is not None and (pruned or rows.shape[0] - active >= self.compaction_threshold * rows.shape[0]):
+                keep = unfinished.nonzero().squeeze(1)
+                if return_latent:
+                    self.repeat_last_latent(captured, rows[~unfinished], step)
+                cache.select_rows(keep)
+                rows, key_valid, seen, unfinished, next_tokens = rows[keep], key_valid[keep], seen[keep], unfinished[keep], next_tokens[keep]
+                if row_generators is not None:
+                    row_generators = [row_generators[i] for i in keep.tolist()]
+            pos = torch.tensor(p + step, device=device) if self.static else p + step
+            hidden = self.decode_step(self.embed_tokens(next_tokens, step + 1), pos, cache, key_valid)
+            logits, latents = self.head(hidden[:, -1])
+
+        if prune_fn is not None:
+            tokens = tokens[kept]
+            captured = captured[kept] if return_latent else None
+        if return_latent:
+            return tokens[:, :length], captured[:, :length]
+        return tokens[:, :length]
+
+    @staticmethod
+    def repeat_last_latent(captured, rows, step):
+        """
+        Fills the latents of the given output rows past step with their latent at step, for rows dropped from the batch
+        there, so that the positions after their stop token the diffusion model is conditioned on aren't zero.
+        """
+        if rows.numel() > 0:
+            captured[rows, step + 1:] = captured[rows, step:step + 1]
+
+    @staticmethod
+    def prune(prune_fn, fraction, tokens, rows, unfinished, kept, length):
+        """
+        Scores the first length codes of the unfinished rows of the batch with prune_fn and marks the worst fraction of
+        them finished, and not kept, in place.
+        :return: Whether any row was pruned.
+        """
+        candidates = unfinished.nonzero().squeeze(1)
+        drop = int(candidates.shape[0] * fraction)
+        if drop == 0:
+            return False
+        scores = prune_fn(tokens[rows[candidates], :length].clone())
+        worst = candidates[torch.topk(scores.to(candidates.device), drop, largest=False).indices]
+        unfinished[worst] = False
+        kept[rows[worst]] = False
+        return True
+
+    @torch.no_grad()
+    def beam_search(self, prompt_emb, start_token, stop_token, max_new_tokens, prompt_mask=None, num_beams=4,
+                    num_return_sequences=1, length_penalty=1.0, repetition_penalty=1.0, logits_processor=None,
+                    return_latent=False, latent_dtype=torch.float16, prompt_token_ids=(1,), prompt_keys=None,
+                    prompt_length=None):
+        """
+        Deterministic beam search over mel codes, following transformers' beam_search() (log softmax, then repetition
+        penalty and any logits_processor, hypotheses ranked by BeamHypotheses), with num_beams rows per prompt.
+
+        Rather than copying every layer's keys and values into the order of the new beams at every step, each step
+        only records the parent of every beam and its token: the cache is reordered in place for the beams whose parent
+        changed, over the positions generated so far (see StaticKVCache.reorder_rows()), and codes and latents are
+        gathered once at the end by walking the parents back (see backtrack()). The top-k over beams and vocabulary is
+        split in two: the best 2*num_beams codes of every beam, then the best of those, instead of one top-k over
+        num_beams times the 8194 codes.
+        :param prompt_length: Length of the prompt generate() sees, which hypotheses are normalized by along with their
+                              codes. Defaults to the length of the prompt embeddings plus the start token.
+        Other arguments are those of generate().
+        :return: (r*num_return_sequences, s) codes, best first for every prompt and padded with stop_token, and with
+                 return_latent the (r*num_return_sequences, s, d) latents that produced them.
+        """
+        assert num_return_sequences <= num_beams, "Beam search can't return more sequences than it has beams"
+        if prompt_mask is None:
+            prompt_mask = torch.ones(prompt_emb.shape[:2], dtype=torch.bool, device=prompt_emb.device)
+        x = self.embed_prompt(prompt_emb, start_token)
+        r, p, _ = x.shape
+        b = r * num_beams
+        device = x.device
+        prompt_length = p if prompt_length is None else prompt_length
+
+        key_valid = torch.ones((r, p + max_new_tokens), dtype=torch.bool, device=device)
+        key_valid[:, :p - 1] = prompt_mask.bool()
+        cache = self.new_cache(p + max_new_tokens, b)
+        hidden = self.prefill_prompts(x, key_valid[:, :p], cache, num_beams, prompt_keys)
+        self.kv_cache_bytes = cache.nbytes()
+        key_valid = key_valid.repeat_interleave(num_beams, 0)
+
+        logits, latents = self.head(hidden)
+        seen = torch.zeros((b, logits.shape[-1]), dtype=torch.bool, device=device)
+        seen[:, list(prompt_token_ids) + [start_token]] = True
+        parents = torch.zeros((b, max_new_tokens), dtype=torch.long, device=device)
+        tokens = torch.full((b, max_new_tokens), stop_token, dtype=torch.long, device=device)
+        captured = torch.zeros((b, max_new_tokens, latents.shape[-1]), dtype=latent_dtype, device=device) if return_latent else None
+
+        # Only the first beam of every prompt starts out in the running, the others being copies of it.
+        beam_scores = torch.full((r, num_beams), -1e9, device=device)
+        beam_scores[:, 0] = 0
+        beam_scores = beam_scores.view(-1)
+        hypotheses = [BeamHypotheses(num_beams, length_penalty) for _ in range(r)]
+        done = [False] * r
+        identity = torch.arange(b, device=device)
+        step = 0
+        for step in range(max_new_tokens):
+            if return_latent:
+                captured[:, step] = latents.to(latent_dtype)
+            scores = process_logits(F.log_softmax(logits.float(), dim=-1), seen, top_k=0, top_p=1.0,
+                                    repetition_penalty=repetition_penalty, logits_processor=logits_processor)
+            scores = scores + beam_scores[:, None]
+            row_scores, row_tokens = torch.topk(scores, 2 * num_beams, dim=1)
+            row_scores, best = torch.topk(row_scores.view(r, -1), 2 * num_beams, dim=1)
+            next_tokens = row_tokens.view(r, -1).gather(1, best)
+            next_parents = best // (2 * num_beams) + identity.view(r, num_beams)[:, :1]
+
+            new_scores, new_tokens, new_parents = [], [], []
+            for g, (group_scores, group_tokens, group_parents) in enumerate(zip(row_scores.tolist(), next_tokens.tolist(),
+                                                                                next_parents.tolist())):
+                if done[g]:
+                    new_scores += [0.0] * num_beams
+                    new_tokens += [stop_token] * num_beams
+                    new_parents += list(range(g * num_beams, (g + 1) * num_beams))
+                    continue
+                kept = 0
+                for rank, (score, token, parent) in enumerate(zip(group_scores, group_tokens, group_parents)):
+                    if token == stop_token:
+                        if rank < num_beams:
+                            hypotheses[g].add(score, prompt_length + step, parent, step, True)
+                    else:
+                        new_scores.append(score)
+                        new_tokens.append(token)
+                        new_parents.append(parent)
+                        kept += 1
+                    if kept == num_beams:
+                        break
+                done[g] = hypotheses[g].is_done(max(group_scores), prompt_length + step)
+
+            beam_scores = torch.tensor(new_scores, device=device)
+            new_tokens = torch.tensor(new_tokens, device=device)
+            new_parents = torch.tensor(new_parents, device=device)
+            tokens[:, step] = new_tokens
+            parents[:, step] = new_parents
+            if all(done) or step == max_new_tokens - 1:
+                break
+
+            moved = (new_parents != identity).nonzero().squeeze(1)
+            if moved.shape[0]:
+                cache.reorder_rows(moved, new_parents[moved], p, p + step)
+                seen = seen.index_select(0, new_parents)
+            seen.scatter_(1, new_tokens.unsqueeze(1), True)
+            pos = torch.tensor(p + step, device=device) if self.static else p + step
+            hidden = self.decode_step(self.embed_tokens(new_tokens, step + 1), pos, cache, key_valid)
+            logits, latents = self.head(hidden[:, -1])
+
+        for g in range(r):
+            if done[g]:
+                continue
+            # Beams still running when the length runs out are hypotheses too.
+            for i in range(num_beams):
+                beam = g * num_beams + i
+                hypotheses[g].add(beam_scores[beam].item(), prompt_length + step + 1, beam, step + 1, False)
+
+        best = [h for g in range(r) for h in hypotheses[g].best(num_return_sequences)]
+        beams = torch.tensor([beam for _, beam, _, _ in best], device=device)
+        lengths = torch.tensor([length for _, _, length, _ in best], device=device)
+        stopped = [stop for _, _, _, stop in best]
+        out_tokens, out_latents = self.backtrack(parents, tokens, captured, beams, lengths, stop_token)
+        width = max(length + stop for length, stop in zip(lengths.tolist(), stopped))
+        width = min(width, max_new_tokens)
+        if return_latent:
+            return out_tokens[:, :width], out_latents[:, :width]
+        return out_tokens[:, :width]
+
+    @staticmethod
+    def backtrack(parents, tokens, captured, beams, lengths, stop_token):
+        """
+        Gathers the codes of beam search hypotheses by walking the parents of their beams back. Hypothesis i is beam
+        beams[i] after lengths[i] steps, followed by the stop token.
+        :param parents: (b,n) beam every beam came from at every step, the beams as they were before that step.
+        :param tokens: (b,n) code every beam was extended with at every step.
+        :param captured: Optional (b,n,d) latents of every beam before every step.
+        :return: The (h,n) codes and, with captured, the (h,n,d) latents of the hypotheses.
+        """
+        n = tokens.shape[1]
+        out = torch.full((beams.shape[0], n), stop_token, dtype=torch.long, device=tokens.device)
+        latents = None
+        if captured is not None:
+            latents = torch.zeros((beams.shape[0], n, captured.shape[-1]), dtype=captured.dtype, device=captured.device)
+            # The latent the stop token was picked from.
+            ends = (lengths < n).nonzero().squeeze(1)
+            latents[ends, lengths[ends]] = captured[beams[ends], lengths[ends]]
+        beam = beams.clone()
+        for step in range(int(lengths.max()) - 1, -1, -1):
+            active = lengths > step
+            parent = parents[beam, step]
+            out[:, step] = torch.where(active, tokens[beam, step], out[:, step])
+            if latents is not None:
+                latents[active, step] = captured[parent[active], step]
+            beam = torch.where(active, parent, beam)
+        return out, latents
+
+    def speculate(self, cache, key_valid, p, logits, latents, seen, tokens, captured, rows, stop_token, do_sample, params,
+                  row_keys=None):
+        """
+        Self-speculative version of the decoding loop of generate(). Every round, a draft made of the first draft_layers
+        blocks (followed by the final layer norm and heads) proposes up to lookahead tokens, one at a time. The full
+        model then verifies all of them in a single forward pass, picking up from the draft's hidden states so the first
+        blocks aren't run twice, and their keys and values are shared with the draft. Drafted tokens are accepted with
+        the usual speculative sampling rule (with probability min(1, p/q), the first rejected one being replaced by a
+        sample of max(0, p-q)), so codes are distributed exactly as without speculation. Greedily, drafted tokens are
+        accepted while they match the full model's argmax, which then replaces the first one that doesn't, so the codes
+        are the same as without speculation.
+
+        Rows of a batch accept different numbers of tokens, but share their positions: a round advances every row by
+        the fewest tokens any unfinished row accepted, plus one. The rows that accepted more keep their next accepted
+        token, which is already distributed like the full model's, so the speed up shrinks as batches get larger.
+
+        Arguments are the state set up by generate(), params holding the arguments of process_logits().
+        :return: Number of tokens generated.
+        """
+        b_out, max_new_tokens = tokens.shape
+        device = tokens.device
+        drafted = torch.zeros((b_out,), dtype=torch.long, device=device)
+        accepted = torch.zeros((b_out,), dtype=torch.long, device=device)
+
+        # The first token comes from the prompt, like in generate().
+        if captured is not None:
+            captured[rows, 0] = latents.to(captured.dtype)
+        pending = sample_tokens(process_logits(logits.float(), seen, **params), do_sample)
+        tokens[rows, 0] = pending
+        seen.scatter_(1, pending.unsqueeze(1), True)
+        unfinished = pending != stop_token
+
+        length = 1
+        while length < max_new_tokens:
+            active = int(unfinished.sum())
+            if active == 0:
+                break
+            if self.compaction_threshold is not None and rows.shape[0] - active >= self.compaction_threshold * rows.shape[0]:
+                keep = unfinished.nonzero().squeeze(1)
+                if captured is not None:
+                    self.repeat_last_latent(captured, rows[~unfinished], length - 1)
+                cache.select_rows(keep)
+                rows, key_valid, seen, unfinished, pending = rows[keep], key_valid[keep], seen[keep], unfinished[keep], pending[keep]
+
+            lookahead = min(self.lookahead, max_new_tokens - length - 1)
+            start = p + length - 1  # Cache position of the pending token.
+            drafts, hidden, draft_probs = [pending], [], []
+            draft_seen = seen.clone()
+            for i in range(lookahead + 1):
+                pos = start + i
+                h = self.run_layers(self.embed_tokens(drafts[i], length + i), pos, cache, key_valid[:, None, None, :pos + 1],
+                                    pos + 1, last=self.draft_layers)
+                hidden.append(h)
+                if i == lookahead:
+                    break
+                draft_logits = self.head(self.transformer.ln_f(h[:, -1]))[0]
+                q = F.softmax(process_logits(draft_logits.float(), draft_seen, **params), dim=-1)
+                d = torch.multinomial(q, num_samples=1).squeeze(1) if do_sample else q.argmax(dim=-1)
+                draft_seen.scatter_(1, d.unsqueeze(1), True)
+                draft_probs.append(q)
+                drafts.append(d)
+
+            end = start + lookahead + 1
+            causal = torch.arange(end, device=device).unsqueeze(0) <= torch.arange(start, end, device=device).unsqueeze(1)
+            mask = key_valid[:, None, None, :end] & causal[None, None]
+            out = self.transformer.ln_f(self.run_layers(torch.cat(hidden, dim=1), start, cache, mask, end,
+                                                        first=self.draft_layers))
+            full_logits, full_latents = self.head(out)
+            target_seen = seen.clone()
+            target_probs = []
+            for i in range(lookahead + 1):
+                target_probs.append(F.softmax(process_logits(full_logits[:, i].float(), target_seen, **params), dim=-1))
+                if i < lookahead:
+                    target_seen.scatter_(1, drafts[i + 1].unsqueeze(1), True)
+
+            num_accepted = torch.zeros_like(pending)
+            still = torch.ones_like(unfinished)
+            for i in range(lookahead):
+                d = drafts[i + 1].unsqueeze(1)
+                if do_sample:
+                    ratio = target_probs[i].gather(1, d).squeeze(1) / draft_probs[i].gather(1, d).squeeze(1)
+                    still &= torch.rand_like(ratio) < ratio
+                else:
+                    still &= target_probs[i].argmax(dim=-1) == d.squeeze(1)
+                num_accepted += still
+            num_accepted = torch.where(unfinished, num_accepted, torch.full_like(num_accepted, lookahead))
+            advance = int(num_accepted.min())
+
+            target = target_probs[advance]
+            if do_sample:
+                if advance < lookahead:
+                    residual = (target - draft_probs[advance]).clamp(min=0)
+                    total = residual.sum(dim=-1, keepdim=True)
+                    target = torch.where(total > 0, residual / total.clamp(min=1e-12), target)
+                correction = torch.multinomial(target, num_samples=1).squeeze(1)
+            else:
+                # Greedily, the full model's pick stands, whatever the draft proposed.
+                correction = target.argmax(dim=-1)
+            if advance < lookahead:
+                correction = torch.where(num_accepted > advance, drafts[advance + 1], correction)
+
+            drafted[rows] += lookahead * unfinished
+            accepted[rows] += num_accepted * unfinished
+            for c, token in enumerate(drafts[1:advance + 1] + [correction]):
+                token = torch.where(unfinished, token, torch.full_like(token, stop_token))
+                tokens[rows, length + c] = token
+                if captured is not None:
+                    captured[rows, length + c] = full_latents[:, c].to(captured.dtype)
+                seen.scatter_(1, token.unsqueeze(1), True)
+                unfinished = unfinished & (token != stop_token)
+            pending = tokens[rows, length + advance]
+            length += advance + 1
+
+        if row_keys is not None:
+            for key, d, a in zip(row_keys, drafted.tolist(), accepted.tolist()):
+                stats = self.acceptance.setdefault(key, [0, 0])
+                stats[0] += d
+                stats[1] += a
+        return length
+
+    def acceptance_rates(self, reset=False):
+        """
+        Returns the fraction of drafted tokens that were accepted, by the voice keys given to generate().
+        :param reset: Start counting anew afterwards.
+        """
+        rates = {key: a / d for key, (d, a) in self.acceptance.items() if d > 0}
+        if reset:
+            self.acceptance = {}
+        return rates
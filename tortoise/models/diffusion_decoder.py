@@ -7,7 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import autocast
 
-from tortoise.models.arch_util import normalization, AttentionBlock
+from tortoise.models.arch_util import normalization, masked_group_norm, AttentionBlock
 from tortoise.utils.device import get_device_name
 
 import tortoise.utils.torch_intermediary as ml
@@ -50,10 +50,10 @@ class TimestepBlock(nn.Module):
 
 
 class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
-    def forward(self, x, emb):
+    def forward(self, x, emb, mask=None):
         for layer in self:
             if isinstance(layer, TimestepBlock):
-                x = layer(x, emb)
+                x = layer(x, emb) if mask is None else layer(x, emb, mask=mask)
             else:
                 x = layer(x)
         return x
@@ -107,7 +107,9 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = nn.Conv1d(channels, self.out_channels, eff_kernel, padding=eff_padding)
 
-    def forward(self, x, emb):
+    def forward(self, x, emb, mask=None):
+        if mask is not None:
+            return self._masked_forward(x, emb, mask)
         h = self.in_layers(x)
         emb_out = self.emb_layers(emb).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
@@ -122,6 +124,25 @@ class ResBlock(TimestepBlock):
             h = self.out_layers(h)
         return self.skip_connection(x) + h
 
+    def _masked_forward(self, x, emb, mask):
+        # Same as forward(), but for a padded batch: normalization only sees valid positions and padding is zeroed
+        # before every convolution, so each row matches what it would be if it were run on its own.
+        m = mask.unsqueeze(1).to(x.dtype)
+        x = x * m
+        h = masked_group_norm(self.in_layers[0], x, mask)
+        h = self.in_layers[2](self.in_layers[1](h) * m)
+        emb_out = self.emb_layers(emb).type(h.dtype)
+        while len(emb_out.shape) < len(h.shape):
+            emb_out = emb_out[..., None]
+        if self.use_scale_shift_norm:
+            scale, shift = torch.chunk(emb_out, 2, dim=1)
+            h = masked_group_norm(self.out_layers[0], h, mask) * (1 + scale) + shift
+        else:
+            h = masked_group_norm(self.out_layers[0], h + emb_out, mask)
+        h = self.out_layers[2](self.out_layers[1](h))
+        h = self.out_layers[3](h * m)
+        return (self.skip_connection(x) + h) * m
+
 
 class DiffusionLayer(TimestepBlock):
     def __init__(self, model_channels, dropout, num_heads):
@@ -129,9 +150,12 @@ class DiffusionLayer(TimestepBlock):
         self.resblk = ResBlock(model_channels, model_channels, dropout, model_channels, dims=1, use_scale_shift_norm=True)
         self.attn = AttentionBlock(model_channels, num_heads, relative_pos_embeddings=True)
 
-    def forward(self, x, time_emb):
-        y = self.resblk(x, time_emb)
-        return self.attn(y)
+    def forward(self, x, time_emb, mask=None):
+        if mask is None:
+            y = self.resblk(x, time_emb)
+            return self.attn(y)
+        y = self.resblk(x, time_emb, mask=mask)
+        return self.attn(y, padding_mask=mask)
 
 
 class DiffusionTts(nn.Module):
@@ -265,7 +289,7 @@ class DiffusionTts(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
-    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False, mask=None):
         """
         Apply the model to an input batch.
 
@@ -275,10 +299,23 @@ class DiffusionTts(nn.Module):
         :param conditioning_latent: a pre-computed conditioning latent; see get_conditioning().
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  Can also be an [N] bool Tensor selecting the rows this applies to, which lets both passes of
+                                  conditioning-free guidance share one batch. Requires precomputed_aligned_embeddings.
+        :param mask: an optional [N x T] Tensor which is 1 for the valid frames of each row and 0 for padding, for batches
+                     of different lengths padded to a common one. Padding does not affect the valid frames and is 0 in
+                     the output. Only supported together with precomputed_aligned_embeddings.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_latent is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
+        if torch.is_tensor(conditioning_free):
+            assert precomputed_aligned_embeddings is not None
+            precomputed_aligned_embeddings = torch.where(conditioning_free.view(-1, 1, 1), self.unconditioned_embedding,
+                                                         precomputed_aligned_embeddings)
+            conditioning_free = False
+        if mask is not None:
+            assert precomputed_aligned_embeddings is not None or conditioning_free
+            return self._masked_forward(x, timesteps, precomputed_aligned_embeddings, conditioning_free, mask)
 
         unused_params = []
         if conditioning_free:
@@ -325,6 +362,29 @@ class DiffusionTts(nn.Module):
             return out, mel_pred
         return out
 
+    def _masked_forward(self, x, timesteps, precomputed_aligned_embeddings, conditioning_free, mask):
+        # Inference-only counterpart of forward() for padded batches, see the mask argument of forward().
+        m = mask.unsqueeze(1).to(x.dtype)
+        if conditioning_free:
+            code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
+        else:
+            code_emb = precomputed_aligned_embeddings
+        code_emb = code_emb * m
+
+        time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
+        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb, mask=mask)
+        x = self.inp_block(x * m)
+        x = torch.cat([x, code_emb], dim=1)
+        x = self.integrating_conv(x)
+        for i, lyr in enumerate(self.layers):
+            with autocast(device_type='cuda', enabled=self.enable_fp16 and i != 0):
+                x = lyr(x, time_emb, mask=mask)
+
+        x = x.float()
+        x = masked_group_norm(self.out[0], x, mask)
+        out = self.out[2](self.out[1](x) * m)
+        return out * m
+
 
 if __name__ == '__main__':
     clip = torch.randn(2, 100, 400)
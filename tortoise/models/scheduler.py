@@ -0,0 +1,361 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+import torch.nn.functional as F
+
+from tortoise.models.decoding import GPT2Decoder, PagedKVCache, sample_next
+from tortoise.models.tensor_parallel import TensorParallelDecoder
+
+
+class _Request:
+    def __init__(self, latent, text_tokens, num_sequences, max_new_tokens, params, return_latent, prompt_key):
+        self.latent = latent
+        self.text_tokens = text_tokens
+        self.num_sequences = num_sequences
+        self.max_new_tokens = max_new_tokens
+        self.params = params
+        self.return_latent = return_latent
+        self.prompt_key = prompt_key
+        self.future = Future()
+        self.to_admit = list(range(num_sequences))
+        self.started = False
+        self.results = [None] * num_sequences
+        self.done = 0
+
+
+class ARScheduler:
+    """
+    Continuous batching for the autoregressive model. Requests from any number of threads share a single running
+    decoding batch: at every step boundary the sequences of newly submitted requests are admitted into free slots of
+    the batch, and sequences that emitted the stop token (or reached their length limit) leave it. A request's result
+    is delivered to its future as soon as all of its sequences are done, so short requests don't wait behind long ones.
+
+    Every request brings its own prompt, voice latent and sampling parameters. Sampling follows generate(), see
+    sample_next(); typical sampling is not supported.
+
+    Keys and values live in a PagedKVCache, so sequences only take memory for the positions they actually reach. A
+    sequence is admitted when there are blocks for its prompt. When the pool runs out during decoding, the most
+    recently admitted sequences are preempted: their blocks are freed and they are started over once there is room.
+    With the default model in fp16 a position takes about 120KB across all layers, half of that when the decoder stores
+    keys and values in int8 (see GPT2Decoder's kv_dtype).
+
+    :param model: The UnifiedVoice to sample from. Its native decoder (and prompt cache) is used if it has one.
+    :param max_batch_size: Number of sequences decoded together.
+    :param kv_cache_memory: Memory (in GB) for keys and values. Defaults to what max_batch_size sequences of the longest
+                            possible prompt and output need, which never preempts. Since most sequences stop well before
+                            max_mel_tokens, a budget well below that typically fits a considerably larger batch.
+    :param block_size: Number of positions per block of the cache.
+    :param context_fn: Optional callable returning a context manager entered on the worker thread, e.g. for autocast,
+                       which is thread-local and so isn't inherited from the threads submitting requests.
+    """
+    def __init__(self, model, max_batch_size=16, context_fn=None, kv_cache_memory=None, block_size=16):
+        self.model = model
+        self.kv_cache_memory = kv_cache_memory
+        self.block_size = block_size
+        self.decoder = getattr(model, 'native_decoder', None)
+        if self.decoder is None or isinstance(self.decoder, TensorParallelDecoder):
+            # The workers of a tensor parallel decoder only keep static caches, not the scheduler's paged one.
+            self.decoder = GPT2Decoder(model.inference_model)
+        self.max_batch_size = max_batch_size
+        self.context_fn = context_fn
+        self.max_length = model.max_conditioning_inputs + model.max_text_tokens + 3 + model.max_mel_tokens
+        self.queue = queue.Queue()
+        self.pending = []
+        self.closing = False
+        self.state = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, speech_conditioning_latent, text_tokens, num_return_sequences=1, max_generate_length=None,
+               do_sample=True, temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, return_latent=False):
+        """
+        Queues num_return_sequences samples from the given prompt. Arguments are those of UnifiedVoice.inference_speech().
+        :return: A Future resolving to the (n,s) codes, padded with the stop token, or with return_latent to (codes,
+                 latents) like inference_speech() returns.
+        """
+        if self.closing:
+            raise RuntimeError("The scheduler has been shut down")
+        max_new_tokens = self.model.max_mel_tokens - 1 if max_generate_length is None else max_generate_length
+        params = {'do_sample': do_sample, 'temperature': temperature, 'top_k': top_k or 0, 'top_p': top_p,
+                  'repetition_penalty': repetition_penalty}
+        prompt_key = None
+        if self.decoder.prompt_cache is not None:
+            prompt_key = self.model.prompt_keys(speech_conditioning_latent.reshape(1, -1), [text_tokens])[0]
+        request = _Request(speech_conditioning_latent.reshape(1, -1), text_tokens.reshape(1, -1), num_return_sequences,
+                           max_new_tokens, params, return_latent, prompt_key)
+        self.queue.put(request)
+        return request.future
+
+    def shutdown(self, wait=True):
+        """
+        Stops accepting requests. Requests already submitted are still completed.
+        """
+        self.closing = True
+        self.queue.put(None)
+        if wait:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            block = not self.pending and (self.state is None or self.state['active'] == 0)
+            if block and self.closing:
+                return
+            try:
+                while True:
+                    request = self.queue.get(block=block)
+                    block = False
+                    if request is not None:
+                        self.pending.append(request)
+            except queue.Empty:
+                pass
+            try:
+                with torch.inference_mode():
+                    if self.context_fn is not None:
+                        with self.context_fn():
+                            self._iterate()
+                    else:
+                        self._iterate()
+            except Exception as e:
+                self._fail_all(e)
+
+    def _iterate(self):
+        self._admit()
+        if self.state is not None and self.state['active'] > 0:
+            self._step()
+
+    def min_kv_cache_memory(self, dtype):
+        """
+        Returns the smallest kv_cache_memory (in GB) that holds one sequence of the longest possible prompt and output,
+        for keys and values computed in dtype.
+        """
+        return -(-self.max_length // self.block_size) * self._block_bytes(dtype) / 1024 ** 3
+
+    def _block_bytes(self, dtype):
+        head_dim = self.decoder.dim // self.decoder.heads
+        return PagedKVCache.bytes_per_block(len(self.decoder.transformer.h), self.decoder.heads, head_dim, dtype,
+                                            self.block_size, kv_dtype=self.decoder.kv_dtype)
+
+    def _allocate(self, device):
+        n = self.max_batch_size
+        vocab = self.model.number_mel_codes
+        layers = len(self.decoder.transformer.h)
+        head_dim = self.decoder.dim // self.decoder.heads
+        dtype = self.decoder.transformer.ln_f.weight.dtype
+        if device.type == 'cuda' and torch.is_autocast_enabled():
+            dtype = torch.get_autocast_gpu_dtype()
+        num_blocks = None
+        if self.kv_cache_memory is not None:
+            if self.kv_cache_memory < self.min_kv_cache_memory(dtype):
+                raise ValueError(f'kv_cache_memory is too small for one sequence of {self.max_length} positions, '
+                                 f'which needs {self.min_kv_cache_memory(dtype):.3f}GB')
+            num_blocks = int(self.kv_cache_memory * 1024 ** 3) // self._block_bytes(dtype)
+        self.state = {
+            'active': 0,
+            'owners': [None] * n,
+            'positions': [0] * n,  # Host copy of lengths, for reserving blocks without syncing.
+            'cache': PagedKVCache(layers, n, self.max_length, self.decoder.heads, head_dim, dtype, device,
+                                  block_size=self.block_size, num_blocks=num_blocks, kv_dtype=self.decoder.kv_dtype),
+            'lengths': torch.zeros((n,), dtype=torch.long, device=device),
+            'steps': torch.zeros((n,), dtype=torch.long, device=device),
+            'max_new': torch.zeros((n,), dtype=torch.long, device=device),
+            'last_token': torch.zeros((n,), dtype=torch.long, device=device),
+            'seen': torch.zeros((n, vocab), dtype=torch.bool, device=device),
+            'do_sample': torch.zeros((n,), dtype=torch.bool, device=device),
+            'temperature': torch.ones((n, 1), device=device),
+            'top_k': torch.zeros((n, 1), dtype=torch.long, device=device),
+            'top_p': torch.ones((n, 1), device=device),
+            'repetition_penalty': torch.ones((n, 1), device=device),
+            'tokens': torch.full((n, self.model.max_mel_tokens), self.model.stop_mel_token, dtype=torch.long, device=device),
+            'latents': None,
+        }
+
+    def _admit(self):
+        while self.pending:
+            request = self.pending[0]
+            if not request.started:
+                if not request.future.set_running_or_notify_cancel():
+                    self.pending.pop(0)
+                    continue
+                request.started = True
+            if not request.to_admit:
+                self.pending.pop(0)
+                continue
+            if self.state is None:
+                self._allocate(request.latent.device)
+            free = self.max_batch_size - self.state['active']
+            if free == 0:
+                return
+            try:
+                admitted = self._admit_rows(request, min(free, len(request.to_admit)))
+            except Exception as e:
+                self.pending.pop(0)
+                request.future.set_exception(e)
+                continue
+            if not admitted:
+                return  # Not enough free blocks; wait for running sequences to finish.
+            if not request.to_admit:
+                self.pending.pop(0)
+
+    def _admit_rows(self, request, count):
+        """
+        Prefills count rows of the request into the free slots after the active ones.
+        :return: Whether they were admitted; False if the cache doesn't have enough free blocks for them.
+        """
+        state = self.state
+        start = state['active']
+        emb = self.decoder.embed_prompt(self.model.embed_prompt(request.latent, request.text_tokens), self.model.start_mel_token)
+        prompt_length = emb.shape[1]
+        if prompt_length + request.max_new_tokens > self.max_length or request.max_new_tokens > state['tokens'].shape[1]:
+            raise ValueError("The prompt and the requested number of tokens don't fit in the scheduler's cache")
+
+        cache = state['cache']
+        for i in range(count):
+            if not cache.reserve(start + i, prompt_length):
+                for j in range(i):
+                    cache.free_slot(start + j)
+                if start == 0:
+                    raise ValueError("The scheduler's cache is too small for the prompt")
+                return False
+
+        cache.offset = start
+        mask = torch.ones(emb.shape[:2], dtype=torch.bool, device=emb.device)
+        keys = None if request.prompt_key is None else [request.prompt_key]
+        hidden = self.decoder.prefill_prompts(emb, mask, cache, count, keys)
+        cache.offset = 0
+
+        rows = slice(start, start + count)
+        params = request.params
+        for i in range(count):
+            state['owners'][start + i] = (request, request.to_admit.pop(0))
+            state['positions'][start + i] = prompt_length
+        state['active'] = start + count
+        cache.active = state['active']
+        state['lengths'][rows] = prompt_length
+        state['steps'][rows] = 0
+        state['max_new'][rows] = request.max_new_tokens
+        state['seen'][rows] = False
+        state['seen'][rows, 1] = True
+        state['seen'][rows, self.model.start_mel_token] = True
+        state['do_sample'][rows] = bool(params['do_sample'])
+        state['temperature'][rows] = params['temperature']
+        state['top_k'][rows] = params['top_k']
+        state['top_p'][rows] = params['top_p']
+        state['repetition_penalty'][rows] = params['repetition_penalty']
+        state['tokens'][rows] = self.model.stop_mel_token
+
+        logits, latents = self.decoder.head(hidden)
+        self._sample(rows, logits, latents)
+        return True
+
+    def _step(self):
+        state = self.state
+        slot = 0
+        while slot < state['active']:
+            while not state['cache'].reserve(slot, state['positions'][slot] + 1):
+                if state['active'] == 1:
+                    # Preempting the only sequence would just admit it again, and fail again, forever.
+                    raise ValueError(f"kv_cache_memory is too small for one sequence of {state['positions'][slot] + 1} positions")
+                self._preempt(state['active'] - 1)
+                if slot >= state['active']:
+                    break
+            slot += 1
+        n = state['active']
+        if n == 0:
+            return
+        rows = slice(0, n)
+        steps = state['steps'][rows]
+        lengths = state['lengths'][rows]
+        x = self.model.inference_model.embeddings(state['last_token'][rows].unsqueeze(1))
+        # The token sampled at step s sits at mel position s+1, the start token being at 0.
+        x = x + self.model.inference_model.text_pos_embedding.emb(steps).unsqueeze(1)
+        end = int(lengths.max()) + 1
+        mask = (torch.arange(end, device=x.device).unsqueeze(0) <= lengths.unsqueeze(1))[:, None, None, :]
+        hidden = self.decoder.forward(x, lengths, state['cache'], mask, end)
+        state['lengths'][rows] += 1
+        for slot in range(n):
+            state['positions'][slot] += 1
+        logits, latents = self.decoder.head(hidden[:, -1])
+        self._sample(rows, logits, latents)
+
+    def _sample(self, rows, logits, latents):
+        """
+        Samples the next token of the given slots, then retires the slots whose sequence is done.
+        """
+        state = self.state
+        if state['latents'] is None:
+            state['latents'] = torch.zeros((self.max_batch_size, self.model.max_mel_tokens, latents.shape[-1]),
+                                           dtype=torch.float16, device=latents.device)
+        index = torch.arange(rows.start, rows.stop, device=logits.device)
+        steps = state['steps'][rows]
+        state['latents'][index, steps] = latents.to(torch.float16)
+
+        tokens = sample_next(logits, state['seen'][rows], temperature=state['temperature'][rows],
+                             top_k=state['top_k'][rows], top_p=state['top_p'][rows],
+                             repetition_penalty=state['repetition_penalty'][rows], do_sample=state['do_sample'][rows])
+        state['tokens'][index, steps] = tokens
+        state['seen'][rows].scatter_(1, tokens.unsqueeze(1), True)
+        state['last_token'][rows] = tokens
+        state['steps'][rows] += 1
+        done = (tokens == self.model.stop_mel_token) | (state['steps'][rows] >= state['max_new'][rows])
+
+        # Retire from the highest slot down, so the slot moved into a hole is always one that is still decoding.
+        for slot in sorted((done.nonzero().squeeze(1) + rows.start).tolist(), reverse=True):
+            self._retire(slot)
+
+    def _retire(self, slot):
+        state = self.state
+        request, sequence = state['owners'][slot]
+        length = int(state['steps'][slot])
+        latents = state['latents'][slot, :length].clone() if request.return_latent else None
+        request.results[sequence] = (state['tokens'][slot, :length].clone(), latents)
+        request.done += 1
+        if request.done == request.num_sequences:
+            self._complete(request)
+        self._vacate(slot)
+
+    def _preempt(self, slot):
+        """
+        Drops the sequence in the given slot to free its blocks. It is decoded again from the start later.
+        """
+        request, sequence = self.state['owners'][slot]
+        request.to_admit.insert(0, sequence)
+        if request not in self.pending:
+            self.pending.insert(0, request)
+        self._vacate(slot)
+
+    def _vacate(self, slot):
+        state = self.state
+        state['cache'].free_slot(slot)
+        last = state['active'] - 1
+        if slot != last:
+            state['owners'][slot] = state['owners'][last]
+            state['positions'][slot] = state['positions'][last]
+            for name in ('lengths', 'steps', 'max_new', 'last_token', 'seen', 'do_sample', 'temperature', 'top_k',
+                         'top_p', 'repetition_penalty', 'tokens', 'latents'):
+                state[name][slot] = state[name][last]
+            state['cache'].move(last, slot)
+        state['owners'][last] = None
+        state['active'] = last
+        state['cache'].active = last
+
+    def _complete(self, request):
+        length = max(codes.shape[0] for codes, _ in request.results)
+        codes = torch.stack([F.pad(c, (0, length - c.shape[0]), value=self.model.stop_mel_token) for c, _ in request.results])
+        if request.return_latent:
+            # Sequences that stopped early repeat their last latent, like the rows generate() drops from its batch.
+            latents = torch.stack([torch.cat([l, l[-1:].expand(length - l.shape[0], -1)]) for _, l in request.results])
+            request.future.set_result((codes, latents))
+        else:
+            request.future.set_result(codes)
+
+    def _fail_all(self, error):
+        requests = list(self.pending)
+        if self.state is not None:
+            requests += [owner[0] for owner in self.state['owners'][:self.state['active']] if owner is not None]
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(error)
+        self.pending = []
+        self.state = None
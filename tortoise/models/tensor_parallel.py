@@ -0,0 +1,301 @@
+import itertools
+import os
+import socket
+import weakref
+from datetime import timedelta
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from transformers.activations import ACT2FN
+
+from tortoise.models.decoding import GPT2Decoder, StaticKVCache, attention
+
+# Commands rank 0 sends the workers, as the first entry of a fixed size int64 header.
+_STOP, _RUN, _SELECT, _REORDER = 0, 1, 2, 3
+_HEADER_SIZE = 10
+_DTYPES = [torch.float32, torch.float16, torch.bfloat16]
+
+
+def shard_block(get, rank, world_size, heads):
+    """
+    Returns the part of a GPT-2 block that rank runs when its heads and MLP columns are split over world_size ranks: the
+    query, key and value columns and the c_proj rows of its heads, and the c_fc columns and MLP c_proj rows of its
+    share of the MLP. Layer norms and the output biases (added once, after the partial outputs are summed) are kept
+    whole.
+    :param get: Returns a parameter of the block by name, e.g. 'attn.c_attn.weight'. Weights are in the (in,out)
+                layout of transformers' Conv1D.
+    """
+    c_attn = get('attn.c_attn.weight')
+    dim = c_attn.shape[0]
+    if heads % world_size:
+        raise ValueError(f'{heads} heads can not be split evenly over {world_size} processes')
+    width = dim // world_size
+    lo, hi = rank * width, (rank + 1) * width
+    c_attn_bias = get('attn.c_attn.bias')
+    c_fc = get('mlp.c_fc.weight')
+    inner = c_fc.shape[1] // world_size
+    fc_lo, fc_hi = rank * inner, (rank + 1) * inner
+    # clone() so a shard of a memory mapped checkpoint doesn't keep the rest of it around.
+    return {
+        'ln_1.weight': get('ln_1.weight').clone(),
+        'ln_1.bias': get('ln_1.bias').clone(),
+        'attn.weight': torch.cat([c_attn[:, j * dim + lo:j * dim + hi] for j in range(3)], dim=1).contiguous(),
+        'attn.bias': torch.cat([c_attn_bias[j * dim + lo:j * dim + hi] for j in range(3)]).clone(),
+        'attn.proj_weight': get('attn.c_proj.weight')[lo:hi].clone(),
+        'attn.proj_bias': get('attn.c_proj.bias').clone(),
+        'ln_2.weight': get('ln_2.weight').clone(),
+        'ln_2.bias': get('ln_2.bias').clone(),
+        'mlp.weight': c_fc[:, fc_lo:fc_hi].contiguous(),
+        'mlp.bias': get('mlp.c_fc.bias')[fc_lo:fc_hi].clone(),
+        'mlp.proj_weight': get('mlp.c_proj.weight')[fc_lo:fc_hi].clone(),
+        'mlp.proj_bias': get('mlp.c_proj.bias').clone(),
+    }
+
+
+class ShardedGPT2Blocks:
+    """
+    One rank's share of the blocks of a GPT-2 transformer split over world_size ranks (Megatron style tensor
+    parallelism): it runs its heads of every attention and its columns of every MLP, and the ranks sum their partial
+    outputs with two all-reduces per block. Keys and values are only cached for the rank's own heads.
+
+    :param layers: List of the rank's shard_block() of every block.
+    :param heads: Number of heads of the whole transformer.
+    :param group: Process group the partial outputs are summed over.
+    """
+    def __init__(self, layers, heads, world_size, eps=1e-5, activation='gelu_new', group=None):
+        self.layers = layers
+        self.heads = heads // world_size
+        self.eps = eps
+        self.act = ACT2FN[activation]
+        self.group = group
+        self.dtype = layers[0]['attn.weight'].dtype
+
+    @staticmethod
+    def from_model(transformer, rank, world_size, group=None):
+        """
+        Shards the blocks of a loaded transformers GPT2Model.
+        """
+        config = transformer.config
+        layers = []
+        for block in transformer.h:
+            params = dict(block.named_parameters())
+            layers.append(shard_block(lambda name: params[name].detach(), rank, world_size, config.n_head))
+        return ShardedGPT2Blocks(layers, config.n_head, world_size, config.layer_norm_epsilon,
+                                 config.activation_function, group)
+
+    @staticmethod
+    def from_checkpoint(path, rank, world_size, layers, heads, eps=1e-5, activation='gelu_new', prefix='gpt.h.',
+                        group=None):
+        """
+        Loads only the rank's shard of the blocks from a UnifiedVoice checkpoint. Where torch supports it, the
+        checkpoint is memory mapped, so the rest of it is never read into memory.
+        """
+        try:
+            state = torch.load(path, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError):
+            state = torch.load(path, map_location='cpu')
+        shards = [shard_block(lambda name: state[f'{prefix}{i}.{name}'], rank, world_size, heads) for i in range(layers)]
+        del state
+        return ShardedGPT2Blocks(shards, heads, world_size, eps, activation, group)
+
+    def to(self, dtype):
+        self.layers = [{name: t.to(dtype) for name, t in layer.items()} for layer in self.layers]
+        self.dtype = dtype
+        return self
+
+    def _all_reduce(self, x):
+        self.group.allreduce([x]).wait()
+        return x
+
+    def run(self, x, pos, cache, mask, end, first=0, last=None):
+        """
+        Runs blocks [first, last) over the (b,t,d) embeddings x of positions [pos, pos+t), like
+        GPT2Decoder.run_layers(). Every rank must make the same call, with the same x.
+        """
+        if x.dtype != self.dtype:
+            self.to(x.dtype)
+        b, t, dim = x.shape
+        width = self.layers[0]['attn.proj_weight'].shape[0]
+        head_dim = width // self.heads
+        last = len(self.layers) if last is None else last
+        for i in range(first, last):
+            w = self.layers[i]
+            h = F.layer_norm(x, (dim,), w['ln_1.weight'], w['ln_1.bias'], self.eps)
+            h = torch.addmm(w['attn.bias'], h.reshape(-1, dim), w['attn.weight']).view(b, t, 3 * width)
+            q, k, v = [y.view(b, t, self.heads, head_dim).transpose(1, 2) for y in h.split(width, dim=2)]
+            cache.write(i, pos, k, v)
+            k, v = cache.read(i, end)
+            h = attention(q, k, v, mask).transpose(1, 2).reshape(-1, width)
+            x = x + self._all_reduce(torch.mm(h, w['attn.proj_weight'])).view(b, t, dim) + w['attn.proj_bias']
+            h = F.layer_norm(x, (dim,), w['ln_2.weight'], w['ln_2.bias'], self.eps)
+            h = self.act(torch.addmm(w['mlp.bias'], h.reshape(-1, dim), w['mlp.weight']))
+            x = x + self._all_reduce(torch.mm(h, w['mlp.proj_weight'])).view(b, t, dim) + w['mlp.proj_bias']
+        return x
+
+
+def _connect(port, rank, world_size):
+    timeout = timedelta(minutes=30)
+    store = dist.TCPStore('127.0.0.1', port, world_size, rank == 0, timeout)
+    return dist.ProcessGroupGloo(store, rank, world_size, timeout)
+
+
+def _limit_threads(rank, threads):
+    """
+    Gives the process of rank threads torch threads, pinned to cores [rank*threads, (rank+1)*threads) of the ones it
+    may run on when there are enough, so the ranks don't compete for cores (and, on multi-socket machines, each tends
+    to stay on the memory of one socket).
+    """
+    torch.set_num_threads(threads)
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= (rank + 1) * threads:
+            os.sched_setaffinity(0, cores[rank * threads:(rank + 1) * threads])
+
+
+def _stop_workers(group, context, threads):
+    group.broadcast(torch.tensor([_STOP] + [0] * (_HEADER_SIZE - 1), dtype=torch.long), 0).wait()
+    while not context.join():
+        pass
+    torch.set_num_threads(threads)
+
+
+def _receive(group, shape, dtype):
+    x = torch.empty(shape, dtype=dtype)
+    group.broadcast(x, 0).wait()
+    return x
+
+
+def _worker(index, world_size, port, checkpoint_path, config, kv_dtype, threads):
+    rank = index + 1
+    if threads:
+        _limit_threads(rank, threads)
+    blocks = ShardedGPT2Blocks.from_checkpoint(checkpoint_path, rank, world_size, **config)
+    blocks.group = _connect(port, rank, world_size)
+    dim = blocks.layers[0]['ln_1.weight'].shape[0]
+    header = torch.zeros(_HEADER_SIZE, dtype=torch.long)
+    cache, cache_id = None, None
+    with torch.inference_mode():
+        while True:
+            blocks.group.broadcast(header, 0).wait()
+            op, key, max_length, b, t, end, pos, first, last, dtype = header.tolist()
+            if op == _STOP:
+                break
+            if key != cache_id:
+                # Rank 0 has moved on to a new generate() call, whose cache replaces the previous one.
+                cache, cache_id = StaticKVCache(len(blocks.layers), max_length, kv_dtype=kv_dtype), key
+            if op == _SELECT:
+                cache.select_rows(_receive(blocks.group, (b,), torch.long))
+                continue
+            if op == _REORDER:
+                rows = _receive(blocks.group, (b,), torch.long)
+                cache.reorder_rows(rows, _receive(blocks.group, (b,), torch.long), pos, end)
+                continue
+            x = _receive(blocks.group, (b, t, dim), _DTYPES[dtype])
+            mask = _receive(blocks.group, (b, 1, t, end), torch.uint8).bool()
+            blocks.run(x, pos, cache, mask, end, first, last)
+
+
+class MirroredKVCache(StaticKVCache):
+    """
+    Rank 0's cache of a TensorParallelDecoder, holding the keys and values of its own heads. The workers keep the same
+    cache for theirs and repeat its row selections and reorderings.
+    """
+    def __init__(self, decoder, layers, max_length, kv_dtype=None):
+        super().__init__(layers, max_length, kv_dtype=kv_dtype)
+        self.decoder = decoder
+        self.id = next(decoder.cache_ids)
+
+    def select_rows(self, rows):
+        self.decoder.command(_SELECT, self, b=rows.shape[0], tensors=(rows.to(torch.long).cpu(),))
+        super().select_rows(rows)
+
+    def reorder_rows(self, rows, parents, start, end):
+        self.decoder.command(_REORDER, self, b=rows.shape[0], end=end, pos=start,
+                             tensors=(rows.to(torch.long).cpu(), parents.to(torch.long).cpu()))
+        super().reorder_rows(rows, parents, start, end)
+
+
+class TensorParallelDecoder(GPT2Decoder):
+    """
+    GPT2Decoder whose transformer blocks are split over world_size processes on this host (see ShardedGPT2Blocks), so
+    that every decoding step of even a single request uses the cores and memory bandwidth of all of them. This process
+    is rank 0: it embeds, samples and runs its own shard, and sends every call to the blocks to the workers, which
+    load their shards straight from the checkpoint. Sums of partial outputs go through gloo, so this runs on CPU only.
+
+    Prompts are not kept in a prompt cache, and neither speculative decoding nor compiling the decoding step is
+    supported. Summing partial outputs changes the order of some additions, so outputs can differ from GPT2Decoder's
+    by rounding.
+
+    :param model: The GPT2InferenceModel, on the CPU.
+    :param world_size: Number of processes, this one included. Must divide the number of heads.
+    :param checkpoint_path: The UnifiedVoice checkpoint the workers load their shards from.
+    :param threads: Number of torch threads of every worker, pinned to cores of their own when there are enough (see
+                    _limit_threads()). Defaults to splitting the cores evenly over the world_size processes. This
+                    process gets as many torch threads, but isn't pinned, until shutdown() gives it back the number
+                    it had before.
+    """
+    def __init__(self, model, world_size, checkpoint_path, compaction_threshold=.25, model_hash=None, kv_dtype=None,
+                 threads=None):
+        super().__init__(model, compaction_threshold=compaction_threshold, model_hash=model_hash, kv_dtype=kv_dtype)
+        config = self.transformer.config
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // world_size)
+        self.world_size = world_size
+        self.cache_ids = itertools.count(1)
+        self.blocks = ShardedGPT2Blocks.from_model(self.transformer, 0, world_size)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        worker_config = {'layers': config.n_layer, 'heads': config.n_head, 'eps': config.layer_norm_epsilon,
+                         'activation': config.activation_function}
+        self.context = mp.spawn(_worker, args=(world_size, port, checkpoint_path, worker_config, kv_dtype, threads),
+                                nprocs=world_size - 1, join=False)
+        self.blocks.group = _connect(port, 0, world_size)
+        # Rank 0 takes its share of the cores like the workers, so they don't compete for them. Its other threads may
+        # already be running, so they are left unpinned.
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(threads)
+        # The workers aren't daemons: stop them when the decoder is collected or at exit at the latest, so the
+        # interpreter doesn't wait on them.
+        self._finalizer = weakref.finalize(self, _stop_workers, self.blocks.group, self.context, previous_threads)
+
+    def command(self, op, cache=None, b=0, t=0, end=0, pos=0, first=0, last=0, dtype=0, tensors=()):
+        """
+        Sends a command, and the tensors it comes with, to the workers.
+        """
+        header = torch.tensor([op, cache.id if cache is not None else 0, cache.max_length if cache is not None else 0,
+                               b, t, end, pos, first, last, dtype], dtype=torch.long)
+        self.blocks.group.broadcast(header, 0).wait()
+        for x in tensors:
+            self.blocks.group.broadcast(x.contiguous(), 0).wait()
+
+    def new_cache(self, max_length, batch_size):
+        # The batch size is taken from the first write, see prefill_prompts().
+        return MirroredKVCache(self, len(self.transformer.h), max_length, kv_dtype=self.kv_dtype)
+
+    def run_layers(self, x, pos, cache, mask, end, first=0, last=None):
+        last = len(self.blocks.layers) if last is None else last
+        b, t, _ = x.shape
+        x = x.contiguous()
+        self.command(_RUN, cache, b, t, end, int(pos), first, last, _DTYPES.index(x.dtype),
+                     tensors=(x, mask.expand(b, 1, t, end).to(torch.uint8)))
+        return self.blocks.run(x, pos, cache, mask, end, first, last)
+
+    def prefill_prompts(self, x, prompt_mask, cache, num_return_sequences, prompt_keys=None):
+        """
+        Like GPT2Decoder.prefill_prompts(), without the prompt cache: the r prompts are run once into the first r rows of
+        the cache, which are then copied to the rows of each prompt.
+        """
+        n = num_return_sequences
+        hidden = self.prefill(x, prompt_mask, cache)
+        if n > 1:
+            cache.select_rows(torch.arange(x.shape[0], device=x.device).repeat_interleave(n))
+        return hidden.repeat_interleave(n, 0)
+
+    def shutdown(self):
+        """
+        Stops the workers and restores this process's number of torch threads. Does nothing if they are already stopped.
+        """
+        self._finalizer()
@@ -6,7 +6,7 @@ import torch
 import torchaudio
 
 from api import TextToSpeech, MODELS_DIR
-from utils.audio import load_audio, load_voices
+from utils.audio import load_audio, load_voices, CrossfadeStitcher
 from utils.text import split_and_recombine_text
 
 
@@ -24,6 +24,12 @@ if __name__ == '__main__':
                                                       'should only be specified if you have custom checkpoints.', default=MODELS_DIR)
     parser.add_argument('--seed', type=int, help='Random seed which can be used to reproduce results.', default=None)
     parser.add_argument('--produce_debug_state', type=bool, help='Whether or not to produce debug_state.pth, which can aid in reproducing problems. Defaults to true.', default=True)
+    parser.add_argument('--pipeline', action='store_true', help='Overlap the rendering of consecutive clips: the next clip is sampled while the previous one is being diffused and vocoded. '
+                                                               'Keeps all models loaded on the device for the whole run.')
+    parser.add_argument('--max_pending', type=int, help='With --pipeline, how many clips may wait between two stages. Higher values use more memory.', default=2)
+    parser.add_argument('--adaptive_threshold', type=float, help='Stop sampling a clip once a batch improves the mean CLVP score of the best candidates by no more than this fraction, e.g. .01. '
+                                                                 'The preset\'s number of samples is then the most taken per clip, or with --pipeline the average, the samples easy clips leave unused going to harder ones after them.', default=None)
+    parser.add_argument('--crossfade_ms', type=int, help='Length of the crossfade used when joining clips into the combined output, in milliseconds.', default=0)
 
     args = parser.parse_args()
     tts = TextToSpeech(models_dir=args.model_dir, use_deepspeed=args.use_deepspeed)
@@ -55,13 +61,8 @@ if __name__ == '__main__':
             voice_sel = [selected_voice]
 
         voice_samples, conditioning_latents = load_voices(voice_sel)
-        all_parts = []
-        for j, text in enumerate(texts):
-            if regenerate is not None and j not in regenerate:
-                all_parts.append(load_audio(os.path.join(voice_outpath, f'{j}.wav'), 24000))
-                continue
-            gen = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
-                                      preset=args.preset, k=args.candidates, use_deterministic_seed=seed)
+
+        def save_clip(j, gen):
             if args.candidates == 1:
                 gen = gen.squeeze(0).cpu()
                 torchaudio.save(os.path.join(voice_outpath, f'{j}.wav'), gen, 24000)
@@ -71,10 +72,33 @@ if __name__ == '__main__':
                 for k, g in enumerate(gen):
                     torchaudio.save(os.path.join(candidate_dir, f'{k}.wav'), g.squeeze(0).cpu(), 24000)
                 gen = gen[0].squeeze(0).cpu()
-            all_parts.append(gen)
+            return gen
+
+        all_parts = [None] * len(texts)
+        pending = []
+        for j, text in enumerate(texts):
+            if regenerate is not None and j not in regenerate:
+                all_parts[j] = load_audio(os.path.join(voice_outpath, f'{j}.wav'), 24000)
+                continue
+            if args.pipeline:
+                pending.append(j)
+                continue
+            gen = tts.tts_with_preset(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
+                                      preset=args.preset, k=args.candidates, use_deterministic_seed=seed,
+                                      adaptive_threshold=args.adaptive_threshold)
+            all_parts[j] = save_clip(j, gen)
+
+        if pending:
+            settings = tts.preset_settings(args.preset, k=args.candidates, use_deterministic_seed=seed, max_pending=args.max_pending,
+                                           adaptive_threshold=args.adaptive_threshold)
+            for result in tts.tts_pipelined([texts[j] for j in pending], voice_samples=voice_samples, conditioning_latents=conditioning_latents, **settings):
+                j = pending[result['index']]
+                gen = [c.unsqueeze(0) for c in result['candidates']] if args.candidates > 1 else result['wav'].unsqueeze(0)
+                all_parts[j] = save_clip(j, gen)
 
         if args.candidates == 1:
-            full_audio = torch.cat(all_parts, dim=-1)
+            stitcher = CrossfadeStitcher(args.crossfade_ms * 24000 // 1000)
+            full_audio = torch.cat([stitcher.push(part) for part in all_parts] + [stitcher.flush()], dim=-1)
             torchaudio.save(os.path.join(voice_outpath, 'combined.wav'), full_audio, 24000)
 
         if args.produce_debug_state:
@@ -265,3 +265,39 @@ def wav_to_univnet_mel(wav, do_normalization=False, device='cpu', sample_rate=24
     if do_normalization:
         mel = normalize_tacotron_mel(mel)
     return mel
+
+
+class CrossfadeStitcher:
+    """
+    Joins consecutive clips into one stream, overlapping each join by a linear crossfade of the given number of
+    samples. The tail of every clip is held back until the next one arrives, so push() can be fed clips as they are
+    rendered and only returns audio that is final.
+    """
+    def __init__(self, crossfade_samples=0):
+        self.crossfade_samples = crossfade_samples
+        self.tail = None
+
+    def push(self, wav):
+        """
+        :param wav: (1,S) clip to append.
+        :return: (1,S') audio that is ready to be written.
+        """
+        n = self.crossfade_samples
+        if self.tail is not None and n > 0:
+            n = min(n, self.tail.shape[-1], wav.shape[-1])
+            fade = torch.linspace(0, 1, n, device=wav.device, dtype=wav.dtype)
+            joined = self.tail[..., self.tail.shape[-1] - n:] * (1 - fade) + wav[..., :n] * fade
+            wav = torch.cat([self.tail[..., :self.tail.shape[-1] - n], joined, wav[..., n:]], dim=-1)
+        elif self.tail is not None:
+            wav = torch.cat([self.tail, wav], dim=-1)
+
+        hold = min(self.crossfade_samples, wav.shape[-1])
+        self.tail = wav[..., wav.shape[-1] - hold:]
+        return wav[..., :wav.shape[-1] - hold]
+
+    def flush(self):
+        """
+        :return: The held back tail of the last clip.
+        """
+        tail, self.tail = self.tail, None
+        return tail if tail is not None else torch.zeros((1, 0))
@@ -186,6 +186,11 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+    :param batch_conditioning_free: if True, the conditioned and the
+                                    conditioning-free passes of each sampling
+                                    step are run as one stacked batch of twice
+                                    the size, with a per-row conditioning_free
+                                    mask, instead of two model calls.
     """
 
     def __init__(
@@ -199,6 +204,7 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        batch_conditioning_free=False,
     ):
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
@@ -207,6 +213,7 @@ class GaussianDiffusion:
         self.conditioning_free = conditioning_free
         self.conditioning_free_k = conditioning_free_k
         self.ramp_conditioning_free = ramp_conditioning_free
+        self.batch_conditioning_free = batch_conditioning_free
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -336,9 +343,12 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,)
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
-        if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+        if self.conditioning_free and self.batch_conditioning_free:
+            model_output, model_output_no_conditioning = self._batched_conditioning_free_forward(model, x, t, model_kwargs)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+            if self.conditioning_free:
+                model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -375,7 +385,7 @@ class GaussianDiffusion:
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                assert (t == t[0]).all()  # This should only be used in inference, where the whole batch is at the same step.
                 cfk = self.conditioning_free_k * (1 - self._scale_timesteps(t)[0].item() / self.num_timesteps)
             else:
                 cfk = self.conditioning_free_k
@@ -416,6 +426,29 @@ class GaussianDiffusion:
             "pred_xstart": pred_xstart,
         }
 
+    def _batched_conditioning_free_forward(self, model, x, t, model_kwargs):
+        """
+        Runs the conditioned and conditioning-free model passes in a single
+        call by stacking x into a batch of 2N rows, the last N of which are
+        flagged conditioning-free. Per-row tensors in model_kwargs are stacked
+        along with x.
+
+        :return: a tuple (conditioned output, conditioning-free output).
+        """
+        B = x.shape[0]
+        stacked_kwargs = {
+            k: th.cat([v, v], dim=0) if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == B else v
+            for k, v in model_kwargs.items()
+        }
+        conditioning_free = th.arange(2 * B, device=x.device) >= B
+        model_output = model(
+            th.cat([x, x], dim=0),
+            self._scale_timesteps(th.cat([t, t], dim=0)),
+            conditioning_free=conditioning_free,
+            **stacked_kwargs
+        )
+        return model_output[:B], model_output[B:]
+
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
@@ -548,7 +581,8 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         verbose=False,
-        desc=None
+        desc=None,
+        mask=None,
     ):
         """
         Generate samples from the model.
@@ -567,6 +601,11 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param verbose: if True, show a tqdm progress bar.
+        :param mask: if specified, an [N x T] tensor marking the valid positions of
+                     each sample along the last axis with 1, for batches of samples
+                     of different lengths padded to a common one. It is passed to
+                     the model as the 'mask' keyword argument, and padded positions
+                     are kept at 0 throughout sampling.
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -580,7 +619,8 @@ class GaussianDiffusion:
             model_kwargs=model_kwargs,
             device=device,
             verbose=verbose,
-            desc=desc
+            desc=desc,
+            mask=mask,
         ):
             final = sample
         return final["sample"]
@@ -596,7 +636,8 @@ class GaussianDiffusion:
         model_kwargs=None,
         device=None,
         verbose=False,
-        desc=None
+        desc=None,
+        mask=None,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -613,6 +654,9 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        model_kwargs, mask = _apply_sample_mask(model_kwargs, mask)
+        if mask is not None:
+            img = img * mask
         indices = list(range(self.num_timesteps))[::-1]
 
         for i in tqdm(indices, desc=desc):
@@ -627,6 +671,8 @@ class GaussianDiffusion:
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
                 )
+                if mask is not None:
+                    out["sample"] = out["sample"] * mask
                 yield out
                 img = out["sample"]
 
@@ -731,6 +777,7 @@ class GaussianDiffusion:
         verbose=False,
         eta=0.0,
         desc=None,
+        mask=None,
     ):
         """
         Generate samples from the model using DDIM.
@@ -749,7 +796,8 @@ class GaussianDiffusion:
             device=device,
             verbose=verbose,
             eta=eta,
-            desc=desc
+            desc=desc,
+            mask=mask,
         ):
             final = sample
         return final["sample"]
@@ -767,6 +815,7 @@ class GaussianDiffusion:
         verbose=False,
         eta=0.0,
         desc=None,
+        mask=None,
     ):
         """
         Use DDIM to sample from the model and yield intermediate samples from
@@ -781,6 +830,9 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        model_kwargs, mask = _apply_sample_mask(model_kwargs, mask)
+        if mask is not None:
+            img = img * mask
         indices = list(range(self.num_timesteps))[::-1]
 
         if verbose:
@@ -799,6 +851,8 @@ class GaussianDiffusion:
                     model_kwargs=model_kwargs,
                     eta=eta,
                 )
+                if mask is not None:
+                    out["sample"] = out["sample"] * mask
                 yield out
                 img = out["sample"]
 
@@ -1244,6 +1298,18 @@ class _WrappedAutoregressiveModel:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, x0, new_ts, **kwargs)
 
+def _apply_sample_mask(model_kwargs, mask):
+    """
+    Adds a per-row [N x T] validity mask to the model kwargs, and returns it
+    reshaped to [N x 1 x T] so it broadcasts against the samples.
+    """
+    if mask is None:
+        return model_kwargs, None
+    model_kwargs = dict(model_kwargs) if model_kwargs is not None else {}
+    model_kwargs["mask"] = mask
+    return model_kwargs, mask.unsqueeze(1).float()
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
@@ -0,0 +1,132 @@
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from tortoise.models.decoding import seeded_generators
+from tortoise.utils.scoring import RunningTopK
+
+
+def candidate_seed(seed, index):
+    """
+    Returns the seed of autoregressive candidate number index of a run seeded with seed. Every candidate is sampled
+    with a generator of its own (see GPT2Decoder.generate()), so it can be sampled again on its own, on any worker.
+    """
+    return (seed * 1000003 + index) % (2 ** 63)
+
+
+def sample_shard(tts, job, candidates):
+    """
+    Samples the given candidates of a job on tts, in batches of the job's batch size, and scores them with CLVP/CVVP.
+    :return: (codes, scores, candidates) of the job's k best of them, best first, on the CPU.
+    """
+    model = tts.autoregressive
+    tts.acquire_models('autoregressive')
+    text_tokens = job['text_tokens'].to(tts.device)
+    auto_conditioning = job['auto_conditioning'].to(tts.device)
+    score_fn = tts.acquire_scoring(text_tokens, auto_conds=job['auto_conds'], cvvp_amount=job['cvvp_amount'])
+    topk = RunningTopK(job['k'])
+    with torch.inference_mode():
+        for start in range(0, len(candidates), job['batch_size']):
+            batch = candidates[start:start + job['batch_size']]
+            generators = seeded_generators([candidate_seed(job['seed'], i) for i in batch], tts.device)
+            codes = model.inference_speech(auto_conditioning, text_tokens, num_return_sequences=len(batch),
+                                           max_generate_length=job['max_mel_tokens'], generators=generators,
+                                           **job['sampling'])
+            codes = F.pad(codes, (0, job['max_mel_tokens'] - codes.shape[1]), value=model.stop_mel_token)
+            topk.update(score_fn(codes).float(), codes)
+    tts.release_models('autoregressive', 'clvp', 'cvvp')
+    rows, indices = topk.result()
+    scores = torch.sort(topk.scores, descending=True).values
+    return rows.cpu(), scores.cpu(), torch.tensor(candidates)[indices.cpu()]
+
+
+def _worker(index, world_size, init_method, tts_kwargs, threads):
+    if threads:
+        torch.set_num_threads(threads)
+    dist.init_process_group('gloo', init_method=init_method, rank=index + 1, world_size=world_size)
+    from tortoise.api import TextToSpeech
+    tts = TextToSpeech(**tts_kwargs)
+    dist.barrier()
+    while True:
+        box = [None]
+        dist.broadcast_object_list(box, src=0)
+        job = box[0]
+        if job is None:
+            break
+        try:
+            result = sample_shard(tts, job, job['shards'][index]) if job['shards'][index] else None
+        except Exception as e:
+            result = e
+        dist.gather_object(result, None, dst=0)
+    dist.destroy_process_group()
+
+
+class DistributedSampler:
+    """
+    Samples autoregressive candidates on a number of local worker processes, each with its own copy of the models,
+    joined with the calling process in a torch.distributed group with the gloo backend (so it works on CPU only
+    machines). A job's candidates are split into contiguous shards, one per worker; every worker samples and scores
+    its shard and sends back its k best, and the calling process keeps the k best overall.
+
+    The calling process joins the default process group, so it can't already be in one.
+
+    :param num_workers: Number of worker processes.
+    :param tts_kwargs: Arguments of the TextToSpeech each worker builds.
+    :param threads_per_worker: Number of torch threads of every worker. Defaults to torch's default.
+    """
+    def __init__(self, num_workers, tts_kwargs, threads_per_worker=None):
+        if dist.is_initialized():
+            raise RuntimeError("DistributedSampler needs the default process group for itself")
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            init_method = f'tcp://127.0.0.1:{s.getsockname()[1]}'
+        self.num_workers = num_workers
+        self.context = mp.spawn(_worker, args=(num_workers + 1, init_method, tts_kwargs, threads_per_worker),
+                                nprocs=num_workers, join=False)
+        dist.init_process_group('gloo', init_method=init_method, rank=0, world_size=num_workers + 1)
+        dist.barrier()  # Every worker has loaded its models.
+
+    def sample(self, text_tokens, auto_conditioning, num_samples, k, seed, batch_size, max_mel_tokens, sampling,
+               auto_conds=None, cvvp_amount=.0):
+        """
+        Samples candidates 0 to num_samples-1 of the given prompt, candidate i with seed candidate_seed(seed, i).
+        :param sampling: Sampling arguments of inference_speech().
+        :return: (codes, scores, candidates) of the k best candidates, best first.
+        """
+        bounds = [num_samples * w // self.num_workers for w in range(self.num_workers + 1)]
+        job = {
+            'text_tokens': text_tokens.cpu(),
+            'auto_conditioning': auto_conditioning.cpu(),
+            'auto_conds': None if auto_conds is None else auto_conds.cpu(),
+            'cvvp_amount': cvvp_amount,
+            'seed': seed,
+            'k': k,
+            'batch_size': batch_size,
+            'max_mel_tokens': max_mel_tokens,
+            'sampling': sampling,
+            'shards': [list(range(bounds[w], bounds[w + 1])) for w in range(self.num_workers)],
+        }
+        dist.broadcast_object_list([job], src=0)
+        results = [None] * (self.num_workers + 1)
+        dist.gather_object(None, results, dst=0)
+        results = [r for r in results[1:] if r is not None]
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+        codes = torch.cat([r[0] for r in results], dim=0)
+        scores = torch.cat([r[1] for r in results], dim=0)
+        candidates = torch.cat([r[2] for r in results], dim=0)
+        best = torch.topk(scores, k=min(k, scores.shape[0])).indices
+        return codes[best], scores[best], candidates[best]
+
+    def shutdown(self):
+        """
+        Stops the workers and leaves the process group.
+        """
+        dist.broadcast_object_list([None], src=0)
+        while not self.context.join():
+            pass
+        dist.destroy_process_group()
@@ -0,0 +1,54 @@
+import math
+
+
+# Mel codes per second of audio: the autoregressive model emits one code per 1024 samples at 22.05kHz.
+CODES_PER_SECOND = 22050 / 1024
+
+
+class LengthPredictor:
+    """
+    Estimates how many mel codes speaking a text can take, so that sampling can be capped well below max_mel_tokens:
+    samples that never emit the stop token then stop at the cap rather than running (and being padded) to
+    max_mel_tokens. The estimate is the duration of the text at the voice's speaking rate, stretched by a safety
+    margin, plus some slack for silence at the start and end.
+
+    Lengths are counted in characters rather than BPE tokens, whose length varies, since the speaking rate of a voice
+    is measured in characters per second: wav2vec2's CTC transcription of its reference clips (see speaking_rate()).
+
+    :param chars_per_second: Speaking rate assumed for voices whose rate isn't measured. On the slow side of typical
+                             speech, so that unmeasured voices get a generous cap.
+    :param margin: Factor the estimated duration is stretched by.
+    :param slack: Codes added to every estimate.
+    """
+    def __init__(self, chars_per_second=12.0, margin=1.5, slack=40):
+        self.chars_per_second = chars_per_second
+        self.margin = margin
+        self.slack = slack
+        self.rates = {}  # Voice key -> measured speaking rate
+
+    def speaking_rate(self, voice_samples, aligner, key=None, sample_rate=22050):
+        """
+        Measures the speaking rate, in characters per second, of the given reference clips.
+        :param aligner: The Wav2VecAlignment used to transcribe the clips.
+        :param key: Optional key identifying the voice, under which the rate is remembered.
+        :return: The rate, or None if nothing was heard.
+        """
+        if key is not None and key in self.rates:
+            return self.rates[key]
+        chars, seconds = 0, 0
+        for clip in voice_samples:
+            clip = clip.reshape(1, -1)
+            chars += len(aligner.transcribe(clip, sample_rate).strip())
+            seconds += clip.shape[-1] / sample_rate
+        rate = chars / seconds if chars and seconds else None
+        if key is not None:
+            self.rates[key] = rate
+        return rate
+
+    def max_codes(self, num_chars, speaking_rate=None, limit=600):
+        """
+        Returns the cap on the number of codes for a text of num_chars characters, at most limit.
+        :param speaking_rate: Measured rate of the voice in characters per second, see speaking_rate().
+        """
+        rate = speaking_rate or self.chars_per_second
+        return max(1, min(limit, math.ceil(num_chars / rate * CODES_PER_SECOND * self.margin) + self.slack))
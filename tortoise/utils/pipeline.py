@@ -0,0 +1,99 @@
+import queue
+import threading
+
+import torch
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Pipeline:
+    """
+    Runs a chain of stages on worker threads, connected by bounded queues. Each stage takes the output of the previous
+    one, so while a stage works on one item the stages before it can already work on the next ones. A stage blocks once
+    max_pending of its outputs are waiting downstream, which bounds the memory held by items in flight.
+
+    On CUDA every stage issues its work on its own stream and waits for it to finish before handing the result on.
+
+    :param stages: List of callables, each taking one item and returning the item for the next stage.
+    :param max_pending: Size of each queue between two stages.
+    """
+    def __init__(self, stages, max_pending=2):
+        self.stages = stages
+        self.max_pending = max_pending
+
+    def run(self, items):
+        """
+        Feeds items through the stages, yielding the output of the last stage in order. Exceptions raised by a stage are
+        re-raised here. Closing the generator early stops all stages.
+        """
+        queues = [queue.Queue(maxsize=self.max_pending) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+
+        def feed():
+            for item in items:
+                if not self._put(queues[0], item, stop):
+                    return
+            self._put(queues[0], _DONE, stop)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1], stop), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _work(self, stage, inputs, outputs, stop):
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        while True:
+            item = self._get(inputs, stop)
+            if item is None:
+                return
+            if item is not _DONE and not isinstance(item, _Failure):
+                try:
+                    with torch.inference_mode():
+                        if stream is not None:
+                            with torch.cuda.stream(stream):
+                                item = stage(item)
+                            stream.synchronize()
+                        else:
+                            item = stage(item)
+                except Exception as e:
+                    item = _Failure(e)
+            if not self._put(outputs, item, stop) or item is _DONE or isinstance(item, _Failure):
+                return
+
+    @staticmethod
+    def _put(q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _get(q, stop):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=.1)
+            except queue.Empty:
+                pass
+        return None
@@ -0,0 +1,72 @@
+import os
+
+import torch
+import torch.nn as nn
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:
+    from transformers.modeling_utils import Conv1D
+
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:
+    from torch.quantization import quantize_dynamic
+
+
+def conv1d_to_linear(module):
+    """
+    Replaces, in place, every transformers Conv1D in module (which GPT-2 uses for its projections) with the equivalent
+    nn.Linear, which dynamic quantization knows how to handle. Conv1D stores its weight transposed.
+    :return: The module.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            linear = nn.Linear(child.weight.shape[0], child.weight.shape[1])
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+
+def quantize_autoregressive(model):
+    """
+    Quantizes the transformer blocks, mel_head and text_head of a UnifiedVoice to int8 with dynamic quantization:
+    weights are stored in int8 and activations are quantized on the fly, which speeds up the matrix multiplications
+    that dominate autoregressive sampling on CPU. Embeddings and layer norms are left in fp32. The quantized model only
+    runs on CPU.
+    :return: The model, modified in place.
+    """
+    model = model.cpu().eval()
+    conv1d_to_linear(model.gpt.h)
+    model.gpt.h = quantize_dynamic(model.gpt.h, {nn.Linear}, dtype=torch.qint8)
+    model.mel_head = quantize_dynamic(nn.Sequential(model.mel_head), {nn.Linear}, dtype=torch.qint8)[0]
+    model.text_head = quantize_dynamic(nn.Sequential(model.text_head), {nn.Linear}, dtype=torch.qint8)[0]
+    return model
+
+
+def load_quantized_autoregressive(build_fn, model_hash, cache_dir):
+    """
+    Returns the int8 version of an autoregressive model (see quantize_autoregressive()), from a cache of quantized
+    weights keyed by the hash of the original checkpoint. Only the state dict is cached: on a hit, the model is built
+    without its weights, quantized to get the same modules, and the cached weights are loaded into it. On a miss, the
+    model is built with its weights, quantized and its state dict added to the cache.
+    :param build_fn: Returns the fp32 UnifiedVoice; build_fn(load_weights=False) may skip loading its weights.
+    :param model_hash: Hash of the fp32 checkpoint.
+    :param cache_dir: Where quantized weights are kept.
+    """
+    path = os.path.join(cache_dir, f'autoregressive-{model_hash}-int8.pth')
+    if os.path.exists(path):
+        try:
+            model = quantize_autoregressive(build_fn(load_weights=False))
+            model.load_state_dict(torch.load(path, map_location='cpu'))
+            return model
+        except Exception as e:
+            print(f"Failed to load quantized autoregressive model {path}, quantizing again: {e}")
+
+    model = quantize_autoregressive(build_fn())
+    os.makedirs(cache_dir, exist_ok=True)
+    torch.save(model.state_dict(), path)
+    return model
@@ -0,0 +1,160 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from tortoise.utils.device import do_gc
+
+
+def model_footprint(model):
+    """
+    Returns the number of bytes taken by the parameters and buffers of the given module.
+    """
+    if model is None:
+        return 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def same_device(a, b):
+    """
+    Whether two torch devices are the same, a device without an index (e.g. 'cuda') standing for the current one.
+    """
+    a, b = torch.device(a), torch.device(b)
+    if a.type != b.type:
+        return False
+    if a.type == 'cuda':
+        current = torch.cuda.current_device() if torch.cuda.is_available() else 0
+        return (current if a.index is None else a.index) == (current if b.index is None else b.index)
+    return a.index == b.index or a.index is None or b.index is None
+
+
+class ModelResidency:
+    """
+    Decides which of an owner's models are kept on the device, within a memory budget.
+
+    Models are referred to by the name of the attribute of owner holding them, so models that get swapped out by the
+    owner (e.g. by loading another checkpoint) are picked up automatically. A model that is acquired is moved to the
+    device and stays there after it is released, until room is needed for another model: then the least recently
+    acquired models that are not in use are moved back to the offload device. Garbage is only collected when an
+    eviction happened and the device does not have enough free memory for the incoming model.
+
+    :param owner: Object holding the models as attributes.
+    :param device: Device models are used on.
+    :param budget: Number of bytes the resident models may take on the device. None for no limit.
+    :param offload_device: Where models are kept while they are not resident.
+    :param move_fn: Callable (model, device) -> model used to move models, e.g. migrate_to_device without collection.
+    """
+    def __init__(self, owner, device, budget=None, offload_device='cpu', move_fn=None):
+        self.owner = owner
+        self.device = torch.device(device)
+        self.budget = budget
+        self.offload_device = torch.device(offload_device)
+        self.move_fn = move_fn if move_fn is not None else (lambda model, device: model.to(device))
+        self.resident = OrderedDict()  # name -> footprint, least recently acquired first
+        self.in_use = set()
+        self.prefetches = {}
+        self.lock = threading.RLock()
+
+    def acquire(self, name):
+        """
+        Makes sure the named model is on the device and marks it as in use, so it won't be evicted until released.
+        :return: The model.
+        """
+        self._wait_for_prefetch(name)
+        with self.lock:
+            model = self._load(name)
+            if model is not None:
+                self.in_use.add(name)
+            return model
+
+    def release(self, name):
+        """
+        Marks the named model as no longer in use. It stays on the device until the room is needed.
+        """
+        with self.lock:
+            self.in_use.discard(name)
+
+    def prefetch(self, name):
+        """
+        Starts moving the named model to the device on a background thread, so it is ready by the time it is acquired.
+        """
+        with self.lock:
+            if name in self.prefetches or self._is_resident(getattr(self.owner, name, None)):
+                return
+            thread = threading.Thread(target=self._prefetch, args=(name,), daemon=True)
+            self.prefetches[name] = thread
+        thread.start()
+
+    def evict(self, name):
+        """
+        Moves the named model off the device, regardless of the budget.
+        """
+        self._wait_for_prefetch(name)
+        with self.lock:
+            self.in_use.discard(name)
+            self._offload(name)
+
+    def resident_bytes(self):
+        with self.lock:
+            return sum(self.resident.values())
+
+    def _prefetch(self, name):
+        try:
+            with self.lock:
+                self._load(name)
+        finally:
+            with self.lock:
+                self.prefetches.pop(name, None)
+
+    def _wait_for_prefetch(self, name):
+        thread = self.prefetches.get(name)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _is_resident(self, model):
+        if model is None:
+            return False
+        tensor = next(iter(model.parameters()), None)
+        if tensor is None:
+            tensor = next(iter(model.buffers()), None)
+        return tensor is not None and same_device(tensor.device, self.device)
+
+    def _load(self, name):
+        model = getattr(self.owner, name, None)
+        if model is None:
+            return None
+        footprint = model_footprint(model)
+        if self._is_resident(model):
+            self.resident[name] = footprint
+            self.resident.move_to_end(name)
+            return model
+
+        self._make_room(name, footprint)
+        model = self.move_fn(model, self.device)
+        setattr(self.owner, name, model)
+        self.resident[name] = footprint
+        self.resident.move_to_end(name)
+        return model
+
+    def _offload(self, name):
+        self.resident.pop(name, None)
+        model = getattr(self.owner, name, None)
+        if model is not None and self._is_resident(model):
+            setattr(self.owner, name, self.move_fn(model, self.offload_device))
+
+    def _make_room(self, name, footprint):
+        evicted = False
+        if self.budget is not None:
+            for other in list(self.resident.keys()):
+                if sum(self.resident.values()) + footprint <= self.budget:
+                    break
+                if other == name or other in self.in_use:
+                    continue
+                self._offload(other)
+                evicted = True
+
+        if evicted and self.device.type == 'cuda':
+            free, _ = torch.cuda.mem_get_info(self.device)
+            if free < footprint:
+                do_gc()
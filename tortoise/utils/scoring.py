@@ -0,0 +1,150 @@
+import queue
+import threading
+
+import torch
+
+
+class RunningTopK:
+    """
+    Keeps the k best rows seen so far out of a stream of scored batches, so the batches themselves don't have to be
+    kept around until every one of them has been scored.
+    """
+    def __init__(self, k):
+        self.k = k
+        self.scores = None
+        self.rows = None
+        self.indices = None
+        self.seen = 0
+
+    def update(self, scores, rows):
+        indices = torch.arange(self.seen, self.seen + rows.shape[0], device=scores.device)
+        self.seen += rows.shape[0]
+        if self.scores is not None:
+            scores = torch.cat([self.scores, scores], dim=0)
+            rows = torch.cat([self.rows, rows.to(self.rows.device)], dim=0)
+            indices = torch.cat([self.indices, indices], dim=0)
+        if scores.shape[0] > self.k:
+            keep = torch.topk(scores, k=self.k).indices
+            scores, rows, indices = scores[keep], rows[keep], indices[keep]
+        self.scores, self.rows, self.indices = scores, rows, indices
+
+    def result(self):
+        """
+        :return: (rows, indices) of the best rows, best first. indices count rows in the order they were submitted.
+        """
+        order = torch.argsort(self.scores, descending=True)
+        return self.rows[order], self.indices[order]
+
+
+class BackgroundScorer:
+    """
+    Scores batches on a worker thread while the caller keeps producing new ones, feeding the results into a RunningTopK.
+    On CUDA the work is issued on its own stream so it can overlap with kernels launched by the producer.
+
+    Note that torch's intra-op thread pool is shared by the whole process: on CPU the worker competes with the producer
+    for the same threads, and the overlap comes from the time either side spends outside of those kernels.
+
+    :param score_fn: Called with a batch, returns a 1-D tensor of scores (higher is better). May modify the batch in place.
+    :param k: Number of rows to keep.
+    :param max_pending: Number of batches that may wait to be scored before submit() blocks.
+    :param context_fn: Optional callable returning a context manager entered on the worker thread, e.g. for autocast,
+                       which is thread-local and so isn't inherited from the producer.
+    """
+    def __init__(self, score_fn, k, max_pending=2, context_fn=None):
+        self.score_fn = score_fn
+        self.topk = RunningTopK(k)
+        self.context_fn = context_fn
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.closed = False
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, batch):
+        if self.error is not None:
+            raise self.error
+        ready = None
+        if self.stream is not None and batch.is_cuda:
+            ready = torch.cuda.Event()
+            ready.record()
+        self.queue.put((batch, ready))
+
+    def finish(self):
+        """
+        Waits for every submitted batch to be scored.
+        :return: (rows, indices) of the k best rows, see RunningTopK.result().
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.topk.result()
+
+    def close(self):
+        """
+        Stops the worker thread without scoring the batches still waiting, e.g. when the producer fails.
+        """
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None or self.closed:
+                continue
+            batch, ready = item
+            try:
+                with torch.inference_mode():
+                    if ready is not None:
+                        with torch.cuda.stream(self.stream):
+                            self.stream.wait_event(ready)
+                            self._score(batch)
+                        self.stream.synchronize()
+                    else:
+                        self._score(batch)
+            except Exception as e:
+                self.error = e
+
+    def _score(self, batch):
+        if self.context_fn is not None:
+            with self.context_fn():
+                scores = self.score_fn(batch)
+        else:
+            scores = self.score_fn(batch)
+        self.topk.update(scores.float(), batch)
+
+
+class SampleBudget:
+    """
+    Autoregressive batches shared by the segments of a document when sampling adaptively (see adaptive_threshold in
+    TextToSpeech.tts()). Every segment may use its own share plus whatever the segments before it left unused, so the
+    batches easy segments don't need go to the harder ones after them, while no segment takes from those still to come.
+    Unused batches are only carried over up to max_banked, so a hard segment after a run of easy ones can't take an
+    unbounded number of them.
+
+    :param batches_per_segment: Share of every segment.
+    :param max_banked: Most batches carried over to later segments. Defaults to twice batches_per_segment, so no
+                       segment uses more than three times its share.
+    """
+    def __init__(self, batches_per_segment, max_banked=None):
+        self.batches_per_segment = batches_per_segment
+        self.max_banked = 2 * batches_per_segment if max_banked is None else max_banked
+        self.banked = 0
+        self.used = []
+
+    def allowance(self):
+        """
+        Returns the number of batches the next segment may use.
+        """
+        return self.batches_per_segment + self.banked
+
+    def spend(self, batches):
+        """
+        Records that the next segment used the given number of batches, banking the rest of its allowance.
+        """
+        self.banked = min(max(0, self.allowance() - batches), self.max_banked)
+        self.used.append(batches)
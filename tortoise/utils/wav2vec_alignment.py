@@ -60,9 +60,10 @@ class Wav2VecAlignment:
         self.tokenizer = Wav2Vec2CTCTokenizer.from_pretrained('jbetker/tacotron-symbols')
         self.device = device
 
-    def align(self, audio, expected_text, audio_sample_rate=24000):
-        orig_len = audio.shape[-1]
-
+    def ctc_logits(self, audio, audio_sample_rate=24000):
+        """
+        Returns the (frames,symbols) CTC logits of wav2vec2 for the given (1,S) clip.
+        """
         with torch.no_grad():
             if torch.cuda.is_available(): # This is unneccessary technically, but it's a placebo
                 self.model = self.model.to(self.device)
@@ -74,8 +75,17 @@ class Wav2VecAlignment:
 
             if torch.cuda.is_available():
                 self.model = self.model.cpu()
+        return logits[0]
 
-        logits = logits[0]
+    def transcribe(self, audio, audio_sample_rate=24000):
+        """
+        Returns the characters wav2vec2 hears in the given (1,S) clip, with greedy CTC decoding.
+        """
+        return self.tokenizer.decode(self.ctc_logits(audio, audio_sample_rate).argmax(-1).tolist())
+
+    def align(self, audio, expected_text, audio_sample_rate=24000):
+        orig_len = audio.shape[-1]
+        logits = self.ctc_logits(audio, audio_sample_rate)
         pred_string = self.tokenizer.decode(logits.argmax(-1).tolist())
 
         fixed_expectation = max_alignment(expected_text.lower(), pred_string)